@@ -96,3 +96,75 @@ def test_load_list_of_amplicon_sets():
     assert got_list == expect_list
     assert got_dict == expect_dict
     os.unlink(tmp_tsv)
+
+
+def test_load_amplicon_set_uses_compiled_scheme():
+    scheme_tsv = data_dir / "load_list_of_amplicon_sets.scheme.tsv"
+    tmp_tsv = Path("tmp.load_amplicon_set.tsv")
+    cache_dir = Path("tmp.load_amplicon_set.cache")
+    subprocess.check_output(f"rm -rf {tmp_tsv} {cache_dir}", shell=True)
+    subprocess.check_output(f"cp {scheme_tsv} {tmp_tsv}", shell=True)
+    expect = primers.AmpliconSet.from_tsv(tmp_tsv, name="Scheme1")
+
+    got = amplicon_schemes.load_amplicon_set(tmp_tsv, "Scheme1", cache_dir=cache_dir)
+    assert got == expect
+    compiled = list(cache_dir.iterdir())
+    assert len(compiled) == 1
+
+    # second load comes from the compiled scheme, and builds the interval
+    # tree only when it is used
+    with mock.patch.object(primers.AmpliconSet, "from_tsv") as from_tsv:
+        got = amplicon_schemes.load_amplicon_set(
+            tmp_tsv, "Scheme1", cache_dir=cache_dir
+        )
+        from_tsv.assert_not_called()
+    assert got == expect
+    assert got._tree is None
+    for amplicon in expect:
+        assert got.tree[amplicon.start] == expect.tree[amplicon.start]
+    assert got._tree is not None
+
+    # editing the scheme compiles it again
+    with open(tmp_tsv) as f:
+        lines = f.readlines()
+    with open(tmp_tsv, "w") as f:
+        f.writelines(lines[:-1])
+    got = amplicon_schemes.load_amplicon_set(tmp_tsv, "Scheme1", cache_dir=cache_dir)
+    assert got == primers.AmpliconSet.from_tsv(tmp_tsv, name="Scheme1")
+    assert got != expect
+    assert len(list(cache_dir.iterdir())) == 2
+
+    # the same scheme somewhere else uses the same compiled copy
+    moved_tsv = Path("tmp.load_amplicon_set.moved.tsv")
+    subprocess.check_output(f"cp {tmp_tsv} {moved_tsv}", shell=True)
+    got = amplicon_schemes.load_amplicon_set(moved_tsv, "Scheme1", cache_dir=cache_dir)
+    assert got.fn == moved_tsv
+    assert len(list(cache_dir.iterdir())) == 2
+
+    # a compiled scheme that cannot be unpickled is rebuilt
+    for compiled in cache_dir.iterdir():
+        with open(compiled, "wb") as f:
+            f.write(b"cno_such_module\nAmpliconSet\n.")
+    got = amplicon_schemes.load_amplicon_set(tmp_tsv, "Scheme1", cache_dir=cache_dir)
+    assert got == primers.AmpliconSet.from_tsv(tmp_tsv, name="Scheme1")
+    subprocess.check_output(f"rm -rf {tmp_tsv} {moved_tsv} {cache_dir}", shell=True)
+
+
+def test_default_scheme_cache_dir(monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", "tmp.xdg_cache")
+    assert amplicon_schemes.default_scheme_cache_dir() == Path(
+        "tmp.xdg_cache", "viridian_workflow", "schemes"
+    )
+    monkeypatch.delenv("XDG_CACHE_HOME")
+    monkeypatch.setenv("HOME", "tmp.home")
+    assert amplicon_schemes.default_scheme_cache_dir() == Path(
+        "tmp.home", ".cache", "viridian_workflow", "schemes"
+    )
+
+
+def test_tests_use_a_temporary_scheme_cache(scheme_cache_dir):
+    # see the autouse fixture in conftest.py
+    amplicon_schemes.load_list_of_amplicon_sets(
+        built_in_names_to_use=["COVID-ARTIC-V3"]
+    )
+    assert len(list(scheme_cache_dir.iterdir())) == 1
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def scheme_cache_dir(tmp_path, monkeypatch):
+    """Compile amplicon schemes into a temporary cache, not the user's
+    ~/.cache
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return tmp_path / "cache" / "viridian_workflow" / "schemes"
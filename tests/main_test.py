@@ -0,0 +1,83 @@
+import json
+import subprocess
+import sys
+
+# native and numeric libraries, and the pipeline itself, that the command
+# line must not load just to print help or reject bad options
+HEAVY_MODULES = [
+    "pysam",
+    "mappy",
+    "pyfastaq",
+    "intervaltree",
+    "numpy",
+    "viridian_workflow.run",
+]
+
+
+def heavy_modules_imported(script):
+    """Run a script in a new interpreter, returning the names of the heavy
+    modules it imported
+    """
+    script += f"""
+import json, sys
+heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+print(json.dumps(heavy), file=sys.stderr)
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stderr.strip().split("\n")[-1])
+
+
+def test_import_does_not_import_pipeline():
+    assert heavy_modules_imported("import viridian_workflow.__main__") == []
+
+
+def run_main(args):
+    """Run main() in a new interpreter, returning the names of the heavy
+    modules it imported
+    """
+    return heavy_modules_imported(
+        f"""
+from viridian_workflow.__main__ import main
+try:
+    main({args!r})
+except (SystemExit, Exception):
+    pass
+"""
+    )
+
+
+def test_startup_does_not_import_pipeline():
+    for args in [
+        ["--help"],
+        ["--version"],
+        ["run_one_sample", "--help"],
+        # missing required options
+        ["run_one_sample", "--tech", "ont"],
+        # rejected by check_reads_args
+        [
+            "run_one_sample",
+            "--tech",
+            "ont",
+            "--reads1",
+            "reads.fq",
+            "--ref_fasta",
+            "ref.fa",
+            "--outdir",
+            "tmp.main_test",
+        ],
+    ]:
+        assert run_main(args) == [], args
+
+
+def test_bam_compression_level_is_unset_by_default():
+    from viridian_workflow.__main__ import make_parser
+
+    args = ["run_one_sample", "--tech", "ont", "--reads", "reads.fq"]
+    args += ["--ref_fasta", "ref.fa", "--outdir", "out", "--keep_bam"]
+    options = make_parser().parse_args(args)
+    # left to run_pipeline, which uses samtools' own default
+    assert options.bam_compression_level is None
+    options = make_parser().parse_args(args + ["--bam_compression_level", "1"])
+    assert options.bam_compression_level == 1
@@ -2,9 +2,11 @@ import os
 import pytest
 import subprocess
 
+import mappy
 import pysam
 
 from viridian_workflow.subtasks import Minimap
+from viridian_workflow.subtasks.minimap import cached_index
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "minimap")
@@ -69,3 +71,65 @@ def test_unpaired_sorted():
     assert bam_is_sorted_and_indexed(bam)
     os.unlink(bam)
     os.unlink(f"{bam}.bai")
+
+
+def test_paired_stream():
+    ref = os.path.join(data_dir, "ref.fa")
+    reads1 = os.path.join(data_dir, "reads_1.fq")
+    reads2 = os.path.join(data_dir, "reads_2.fq")
+    bam = "tmp.minimap_paired_stream.bam"
+    subprocess.check_output(f"rm -f {bam}", shell=True)
+    Minimap(bam, ref, reads1, fq2=reads2, sort=False).run()
+    expect = [(r.query_name, r.reference_start) for r in pysam.AlignmentFile(bam)]
+
+    minimap = Minimap(bam, ref, reads1, fq2=reads2, sort=False)
+    os.unlink(bam)
+    with minimap.stream() as alignments:
+        got = [(r.query_name, r.reference_start) for r in alignments]
+    assert got == expect
+    assert minimap.log["Success"]
+    assert not os.path.exists(bam)
+
+
+def test_cached_index():
+    ref = os.path.join(data_dir, "ref.fa")
+    cache = "tmp.minimap_index_cache"
+    subprocess.check_output(f"rm -rf {cache}", shell=True)
+
+    sr = cached_index(ref, "sr", cache)
+    ont = cached_index(ref, "map-ont", cache)
+    assert sr != ont
+    assert sorted(os.listdir(cache)) == sorted([sr.name, ont.name])
+    mtime = os.path.getmtime(sr)
+    assert cached_index(ref, "sr", cache) == sr
+    assert os.path.getmtime(sr) == mtime
+    assert mappy.Aligner(str(sr), preset="sr").seq_names == ["ref.fa"]
+
+    # a changed reference gets a new index
+    changed_ref = os.path.join(cache, "ref.fa")
+    with open(ref) as f_in, open(changed_ref, "w") as f_out:
+        print(f_in.read().rstrip() + "A", file=f_out)
+    assert cached_index(changed_ref, "sr", cache) != sr
+
+    minimap = Minimap("out.bam", ref, "reads.fq", index_cache=cache)
+    assert minimap.cmd[-2] == str(ont)
+    minimap = Minimap("out.bam", ref, "reads.fq", minimap_x_opt="-x map-ont -k 9")
+    assert minimap.cmd[-2] == ref
+    subprocess.check_output(f"rm -rf {cache}", shell=True)
+
+
+def test_paired_unsorted_uncompressed():
+    ref = os.path.join(data_dir, "ref.fa")
+    reads1 = os.path.join(data_dir, "reads_1.fq")
+    reads2 = os.path.join(data_dir, "reads_2.fq")
+    sizes = {}
+    for level in [0, 6]:
+        bam = f"tmp.minimap_paired_unsorted.{level}.bam"
+        subprocess.check_output(f"rm -f {bam}", shell=True)
+        Minimap(bam, ref, reads1, fq2=reads2, sort=False, compression_level=level).run()
+        with pysam.AlignmentFile(bam, "rb", threads=2) as f:
+            assert f.is_bam
+            assert len(list(f)) > 0
+        sizes[level] = os.path.getsize(bam)
+        os.unlink(bam)
+    assert sizes[0] > sizes[6]
@@ -1,4 +1,5 @@
 import copy
+import gc
 import os
 import pytest
 import random
@@ -6,7 +7,7 @@ import subprocess
 
 import pyfastaq
 
-from viridian_workflow import utils, run, primers
+from viridian_workflow import utils, run, primers, readstore
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "one_sample_pipeline")
@@ -400,3 +401,80 @@ def _test_not_expected_amplicons(test_data):
         pass
     # TODO: check that we got the expected output
     subprocess.check_output(f"rm -rf {pre_out}*", shell=True)
+
+
+def test_allocate_threads():
+    assert run.allocate_threads(1) == {
+        "minimap2": 1,
+        "bam_decompression": 1,
+        "mappy": 1,
+        "cylon": 1,
+        "varifier": 1,
+        "self_qc": 1,
+    }
+    for threads in [2, 4, 8, 16, 64]:
+        budget = run.allocate_threads(threads)
+        # the kept bam is only decompressed after minimap2 has finished
+        assert budget["minimap2"] == threads
+        assert budget["bam_decompression"] == min(4, threads)
+        assert budget["self_qc"] == budget["varifier"] == threads
+
+
+def test_pipeline_stops_early_when_too_many_amplicons_fail(test_data):
+    # reads for only two of the five amplicons. mappy is used so that this
+    # stage runs without minimap2, and the pipeline must stop before cylon
+    pre_out = "tmp.pipeline_stops_early"
+    subprocess.check_output(f"rm -rf {pre_out}*", shell=True)
+    fq1 = f"{pre_out}.1.fq"
+    fq2 = f"{pre_out}.2.fq"
+    make_catted_paired_reads_for_amplicon_set(
+        test_data, {"amplicon1", "amplicon2"}, fq1, fq2
+    )
+    amplicon_set = primers.AmpliconSet.from_tsv(test_data["amplicons_tsv"], name="s")
+    # a second candidate, so that a losing scheme's sample is made too
+    other_set = primers.AmpliconSet.from_tsv(test_data["amplicons_tsv"], name="t")
+    log = {"Summary": {"Progress": []}}
+    with pytest.raises(utils.PipelineAbort) as abort:
+        run.run_pipeline(
+            f"{pre_out}.out",
+            "illumina",
+            [fq1, fq2],
+            [amplicon_set, other_set],
+            ref=test_data["ref_fasta"],
+            mapper="mappy",
+            profile=True,
+            global_log=log,
+        )
+    stages = {stage["Task"]: stage for stage in log["Summary"]["Progress"]}
+    assert stages["amplicon_detection"]["Success"]
+    assert stages["mappy_index"]["Success"]
+    # mapping is measured by the stages, not logged separately
+    for stage in log["Summary"]["Progress"]:
+        assert "wall_time" in stage and "peak_rss_mb" in stage, stage["Task"]
+    assert stages["readstore"]["wall_time"] >= 0
+    assert "peak_rss_mb" in stages["readstore"]
+    profile_dir = os.path.join(f"{pre_out}.out", "profile")
+    assert os.path.exists(os.path.join(profile_dir, "readstore.prof"))
+    assert os.path.exists(os.path.join(profile_dir, "readstore.tracemalloc.txt"))
+    assert abort.value.results["Amplicons"]["Failed_amplicons"] == [
+        "amplicon3",
+        "amplicon4",
+        "amplicon5",
+    ]
+    assert not os.path.exists(os.path.join(f"{pre_out}.out", "amplicons"))
+    # the traceback keeps run_pipeline's variables alive, but no fragment
+    # reservoirs are left once the readstore is built
+    assert not [
+        o
+        for o in gc.get_objects()
+        if isinstance(o, readstore.FragmentSample) and o.fragments
+    ]
+    subprocess.check_output(f"rm -rf {pre_out}*", shell=True)
+
+
+def test_percent_n():
+    fasta = "tmp.percent_n.fa"
+    with open(fasta, "w") as f:
+        print(">seq", "ACGTNNnnAC", sep="\n", file=f)
+    assert run.percent_n(fasta) == 40.0
+    os.unlink(fasta)
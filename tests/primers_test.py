@@ -1,10 +1,11 @@
 import os
 import pytest
+import random
 
 from collections import defaultdict
 
 from intervaltree import Interval
-from viridian_workflow import primers, readstore
+from viridian_workflow import amplicon_schemes, primers, readstore
 
 import pysam
 
@@ -152,6 +153,48 @@ def test_AmpliconSet_match():
             assert matches == truth  # None matches
 
 
+def test_AmpliconMatcher():
+    tsv_file = os.path.join(data_dir, "AmpliconSet_match.amplicons.tsv")
+    amplicon_set = primers.AmpliconSet.from_tsv(tsv_file, name="NAME", tolerance=5)
+    # a set where one amplicon lies inside another, which is not tiled
+    nested = primers.AmpliconSet.from_tsv(tsv_file, name="nested", tolerance=5)
+    inner = primers.Amplicon("inner", shortname=2)
+    inner.add(primers.Primer("inner_left", "ACGT", True, True, 120, 123))
+    inner.add(primers.Primer("inner_right", "ACGT", False, False, 200, 203))
+    nested.amplicons["inner"] = inner
+    amplicon_sets = [amplicon_set, nested]
+    matcher = primers.AmpliconMatcher(amplicon_sets)
+    assert matcher.tiled == [0]
+    assert matcher.nested == [1]
+
+    fragments = []
+    for start in range(-10, 500, 7):
+        for end in range(start, 520, 11):
+            fragment = readstore.Fragment([])
+            fragment.ref_start = start
+            fragment.ref_end = end
+            fragments.append(fragment)
+
+    ids = matcher.match(
+        [f.ref_start for f in fragments], [f.ref_end for f in fragments]
+    )
+    assert ids.shape == (2, len(fragments))
+    matched = matcher.match_fragments(fragments)
+    assert len(matched) == len(fragments)
+    for i, (fragment, hits) in enumerate(matched):
+        for k, (amplicon_set, hit) in enumerate(zip(amplicon_sets, hits)):
+            expect = amplicon_set.match(fragment)
+            assert hit is expect
+            if expect is None:
+                assert ids[k, i] == -1
+            else:
+                assert matcher.amplicons[k][ids[k, i]] is expect
+    assert any(hits[0] is not None for _, hits in matched)
+    # fragments inside the inner amplicon are also inside amp1, and so are
+    # ambiguous in the nested set
+    assert any(hits[0] is not None and hits[1] is None for _, hits in matched)
+
+
 def test_fragment_syncronisation_position_sorted():
     # this case should raise an exception now
     # actually has 38 read pairs and 1 unmated
@@ -201,3 +244,41 @@ def test_fragment_syncronisation():
         names = qns_for_r1s[r1.seq]
         assert r2.seq in map(lambda x: r2_for_qn[x], names)
     assert count == 18
+
+
+def test_PrimerIndex_detect():
+    _, amplicon_sets = amplicon_schemes.load_list_of_amplicon_sets(
+        built_in_names_to_use=["COVID-ARTIC-V3", "COVID-ARTIC-V4.1", "COVID-AMPLISEQ-V1"]
+    )
+    v3 = [s for s in amplicon_sets if s.name == "COVID-ARTIC-V3"][0]
+    index = primers.PrimerIndex(amplicon_sets)
+    assert index.k == 20
+
+    rng = random.Random(42)
+
+    def random_seq(length):
+        return "".join(rng.choices("ACGT", k=length))
+
+    v3_primers = [p for amplicon in v3 for p in amplicon.left + amplicon.right]
+    reads = []
+    for _ in range(500):
+        primer = rng.choice(v3_primers)
+        # reads start with the primer, possibly after an adapter
+        adapter = random_seq(rng.randint(0, 30))
+        reads.append(adapter + primer.seq + random_seq(100))
+    reads += [random_seq(150) for _ in range(500)]
+
+    assert amplicon_sets.index(v3) in index.lookup(reads[0])
+    assert index.lookup(reads[-1]) == set()
+    winner, summary = index.detect(reads)
+    assert winner == v3
+    assert summary["reads_scanned"] == 1000
+    assert summary["chosen_scheme"] == "COVID-ARTIC-V3"
+    counts = summary["reads_with_primer"]
+    assert counts["COVID-ARTIC-V3"] == 500
+    assert counts["COVID-ARTIC-V3"] > 2 * counts["COVID-ARTIC-V4.1"]
+
+    # too few reads with primers to choose a scheme
+    winner, summary = index.detect(reads[:10] + reads[500:])
+    assert winner is None
+    assert summary["chosen_scheme"] is None
@@ -0,0 +1,50 @@
+import os
+import pstats
+import subprocess
+import time
+
+from viridian_workflow import profiling, utils
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def test_profile_stage():
+    outdir = "tmp.profile_stage"
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+    with profiling.profile_stage("outer", outdir, trace_memory=True):
+        data = [list(range(100)) for _ in range(1000)]
+        busy(0.1)
+        # nested stages are profiled as part of the outer one
+        with profiling.profile_stage("inner", outdir):
+            busy(0.05)
+    assert len(data) == 1000
+    assert not os.path.exists(os.path.join(outdir, "inner.prof"))
+
+    stats = pstats.Stats(os.path.join(outdir, "outer.prof"))
+    assert any(func[2] == "busy" for func in stats.stats)
+
+    with open(os.path.join(outdir, "outer.collapsed")) as f:
+        lines = f.read().splitlines()
+    assert len(lines) > 0
+    for line in lines:
+        stack, count = line.rsplit(" ", maxsplit=1)
+        assert int(count) > 0
+    assert any("busy (profiling_test.py" in line for line in lines)
+
+    with open(os.path.join(outdir, "outer.tracemalloc.txt")) as f:
+        report = f.read()
+    assert "Peak traced memory" in report
+    assert "profiling_test.py" in report
+
+    # the lock is released, so later stages are profiled
+    progress = []
+    with utils.stage("later", progress, profile_dir=outdir):
+        busy(0.01)
+    assert progress[0]["Success"]
+    assert os.path.exists(os.path.join(outdir, "later.prof"))
+    assert not os.path.exists(os.path.join(outdir, "later.tracemalloc.txt"))
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
@@ -1,11 +1,16 @@
 import filecmp
+import gc
 import json
 import os
 import pytest
+import random
 import subprocess
 from unittest import mock
 
-from viridian_workflow import primers, readstore
+import pysam
+
+from viridian_workflow import amplicon_schemes, primers, readstore
+from viridian_workflow.utils import revcomp
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "readstore")
@@ -99,3 +104,484 @@ def test_make_reads_dir_for_cylon_paired():
     #    assert filecmp.cmp(got_amp3, expect_amp3, shallow=False)
 
     subprocess.check_output(f"rm -rf {outdir}", shell=True)
+
+
+class CountingBam(Bam):
+    def __init__(self, fragments, infile_is_paired=None):
+        super().__init__(infile_is_paired=infile_is_paired)
+        self.fragments = fragments
+        self.passes = 0
+
+    def syncronise_fragments(self):
+        self.passes += 1
+        for fragment in self.fragments:
+            yield fragment
+
+
+def test_fragment_sample_reservoir():
+    amplicons_tsv = os.path.join(data_dir, "make_reads_dir_for_cylon.amplicons.tsv")
+    amplicon_set = primers.AmpliconSet.from_tsv(amplicons_tsv)
+    amp1, amp2, _ = list(amplicon_set)
+    sample = readstore.FragmentSample(amplicon_set, target_depth=100)
+
+    def fragment(start):
+        read = readstore.Read("A" * 100, start, start + 99, 0, 99, False)
+        return readstore.SingleRead(read)
+
+    # fragments are told apart by their start, which is their position here
+    for start in range(5000):
+        sample.push(fragment(start), amp1)
+    few = [fragment(start) for start in range(10)]
+    for f in few:
+        sample.push(f, amp2)
+    sample.push(fragment(0), None)
+
+    assert sample.reads_per_amplicon == {amp1: 5000, amp2: 10}
+    assert sample.mapped_bases[amp1] == 5000 * 99
+    assert sample.unmatched_reads == 1
+    starts = [f.ref_start for f in sample.fragments[amp1]]
+    assert len(set(starts)) == 100
+    # later fragments must have a chance of being sampled
+    assert max(starts) >= 100
+    assert [f.reads for f in sample.fragments[amp2]] == [f.reads for f in few]
+    # replaced fragments do not pile up in the store
+    assert len(sample.store) < 2 * 110 + 100
+
+    sample.clear()
+    assert len(sample.fragments) == 0 and len(sample.store) == 0
+    assert sample.reads_per_amplicon == {amp1: 5000, amp2: 10}
+
+
+def test_readstore_single_pass():
+    amplicons_tsv = os.path.join(data_dir, "make_reads_dir_for_cylon.amplicons.tsv")
+    amplicon_set = primers.AmpliconSet.from_tsv(amplicons_tsv)
+    amp1 = list(amplicon_set)[0]
+    read = readstore.Read("A" * 100, amp1.start, amp1.end, 0, 99, False)
+    bam = CountingBam([readstore.SingleRead(read) for _ in range(50)])
+    read_store = readstore.ReadStore(amplicon_set, bam, target_depth=20)
+    assert bam.passes == 1
+    assert read_store.reads_per_amplicon[amp1] == 50
+    assert len(read_store[amp1]) == 20
+    assert read_store.summary["amp1"]["total_depth"] == 50
+    assert read_store.summary["amp1"]["sampled_depth"] == 20
+
+
+def test_bam_ingest():
+    bam_file = os.path.join(
+        this_dir, "data", "primers", "truncated_name_sorted_40_reads.bam"
+    )
+    _, amplicon_sets = amplicon_schemes.load_list_of_amplicon_sets(
+        built_in_names_to_use=["COVID-ARTIC-V3", "COVID-AMPLISEQ-V1"]
+    )
+    bam = readstore.Bam(bam_file)
+    chosen, samples = bam.ingest(amplicon_sets)
+    assert chosen.name == "COVID-ARTIC-V3"
+    assert bam.stats["chosen_scheme_matches"] == 18
+    assert set(samples) == set(amplicon_sets)
+
+    from_sample = readstore.ReadStore(chosen, bam, sample=samples[chosen])
+    from_bam = readstore.ReadStore(chosen, readstore.Bam(bam_file))
+    assert from_sample.reads_per_amplicon == from_bam.reads_per_amplicon
+    assert from_sample.summary == from_bam.summary
+    # the sampled fragments are moved into the readstore, not copied
+    assert len(samples[chosen].fragments) == 0
+    assert len(from_sample.store) == 18
+
+
+class FragmentsBam(readstore.Bam):
+    """A readstore.Bam that yields given fragments, counting those read"""
+
+    def __init__(self, fragments):
+        self.stats = readstore.Bam.new_stats()
+        self.infile_is_paired = False
+        self.fragments = fragments
+        self.consumed = 0
+
+    def syncronise_fragments(self):
+        for fragment in self.fragments:
+            self.consumed += 1
+            yield fragment
+
+
+def test_sequential_scheme_detection():
+    _, amplicon_sets = amplicon_schemes.load_list_of_amplicon_sets(
+        built_in_names_to_use=["COVID-ARTIC-V3", "COVID-ARTIC-V4.1", "COVID-AMPLISEQ-V1"]
+    )
+    v3 = [s for s in amplicon_sets if s.name == "COVID-ARTIC-V3"][0]
+    rng = random.Random(42)
+    fragments = []
+    for _ in range(20000):
+        amplicon = rng.choice(list(v3))
+        start = amplicon.start + rng.randint(-2, 2)
+        read = readstore.Read("A" * 100, start, amplicon.end - 2, 0, 99, False)
+        fragments.append(readstore.SingleRead(read))
+
+    bam = FragmentsBam(fragments)
+    assert bam.detect_amplicon_set(amplicon_sets) == v3
+    assert bam.consumed == len(fragments)
+    detection = bam.stats["scheme_detection"]
+    assert detection["fragments_consumed"] == len(fragments)
+    assert detection["decided_after"] is None
+    all_matches = bam.stats["chosen_scheme_matches"]
+
+    bam = FragmentsBam(fragments)
+    assert bam.detect_amplicon_set(amplicon_sets, sequential=True) == v3
+    detection = bam.stats["scheme_detection"]
+    assert detection["winner"] == "COVID-ARTIC-V3"
+    assert bam.consumed == detection["fragments_consumed"] < len(fragments)
+    assert detection["decided_after"] == detection["fragments_consumed"]
+    for name, scheme in detection["schemes"].items():
+        assert 0 <= scheme["match_proportion_low"] <= scheme["match_proportion_high"]
+        if name == "COVID-ARTIC-V3":
+            assert scheme["match_proportion_low"] > 0.5
+        else:
+            assert scheme["match_proportion_high"] < 0.5
+
+    # ingest still reads every fragment, sampling only the winner and the
+    # schemes it is told to keep once the winner is known
+    bam = FragmentsBam(fragments)
+    ampliseq = [s for s in amplicon_sets if s.name == "COVID-AMPLISEQ-V1"][0]
+    chosen, samples = bam.ingest(amplicon_sets, sequential=True, keep=[ampliseq])
+    assert chosen == v3
+    assert bam.consumed == len(fragments)
+    assert bam.stats["chosen_scheme_matches"] == all_matches
+    assert sum(samples[v3].reads_per_amplicon.values()) == all_matches
+    assert (
+        sum(samples[ampliseq].reads_per_amplicon.values())
+        + samples[ampliseq].unmatched_reads
+        == len(fragments)
+    )
+
+    # a scheme only in keep is sampled, but is not a candidate for detection
+    candidates = [s for s in amplicon_sets if s != ampliseq]
+    bam = FragmentsBam(fragments)
+    chosen, samples = bam.ingest(candidates, sequential=True, keep=[ampliseq])
+    assert chosen == v3
+    assert "COVID-AMPLISEQ-V1" not in bam.stats["scheme_detection"]["schemes"]
+    assert "COVID-AMPLISEQ-V1" not in bam.stats["amplicon_scheme_set_matches"]
+    assert set(samples) == set(amplicon_sets)
+    assert (
+        sum(samples[ampliseq].reads_per_amplicon.values())
+        + samples[ampliseq].unmatched_reads
+        == len(fragments)
+    )
+
+
+class GeneratedBam(FragmentsBam):
+    """A FragmentsBam that makes its fragments as they are read and records
+    how many Fragment objects are alive at a checkpoint
+    """
+
+    def __init__(self, amplicon_set, count, checkpoint):
+        super().__init__(None)
+        self.amplicon_set = amplicon_set
+        self.count = count
+        self.checkpoint = checkpoint
+        self.live_fragments = None
+        self.samples = None
+
+    def syncronise_fragments(self):
+        rng = random.Random(42)
+        amplicons = list(self.amplicon_set)
+        for i in range(self.count):
+            if i == self.checkpoint:
+                objects = gc.get_objects()
+                self.live_fragments = sum(
+                    isinstance(o, readstore.Fragment) for o in objects
+                )
+                self.samples = [
+                    o for o in objects if isinstance(o, readstore.FragmentSample)
+                ]
+                del objects
+            amplicon = rng.choice(amplicons)
+            read = readstore.Read(
+                "A" * 100, amplicon.start, amplicon.end - 2, 0, 99, False
+            )
+            self.consumed += 1
+            yield readstore.SingleRead(read)
+
+
+def test_ingest_memory_is_bounded():
+    _, amplicon_sets = amplicon_schemes.load_list_of_amplicon_sets(
+        built_in_names_to_use=["COVID-ARTIC-V3", "COVID-AMPLISEQ-V1"]
+    )
+    v3 = [s for s in amplicon_sets if s.name == "COVID-ARTIC-V3"][0]
+    count = 30000
+    bam = GeneratedBam(v3, count, checkpoint=count - 100)
+    chosen, samples = bam.ingest(amplicon_sets, target_depth=50)
+    assert chosen == v3
+    assert bam.consumed == count
+
+    # only the fragments of the batch being matched are alive, the sampled
+    # ones are packed into each scheme's store
+    assert bam.live_fragments < 2 * readstore.MATCH_BATCH_SIZE
+    assert bam.samples
+    for sample in bam.samples:
+        assert len(sample.store) < 2 * sample.sampled + sample.target_depth
+        # 100 bases and a few columns per fragment, past the empty offsets
+        assert sample.store.nbytes <= 200 * len(sample.store) + 24
+    sample = samples[v3]
+    assert sample.sampled == 50 * len(list(v3))
+    assert sum(sample.reads_per_amplicon.values()) == count
+
+
+def test_fragment_store():
+    store = readstore.FragmentStore()
+    read_fwd = readstore.Read("ACGT" * 25, 100, 199, 0, 99, False)
+    read_rev = readstore.Read("GGC" * 30, 150, 240, 2, 90, True)
+    single = readstore.SingleRead(read_rev)
+    paired = readstore.PairedReads(read_fwd, read_rev)
+    store.append(paired, 3)
+    store.append(single, 1)
+    store.append(paired, 3)
+    assert len(store) == 3
+
+    assert list(store.select(3)) == [0, 2]
+    assert list(store.select(1)) == [1]
+    assert len(store.select(2)) == 0
+
+    got = store.fragment(0)
+    assert isinstance(got, readstore.PairedReads)
+    assert got.reads == [read_fwd, read_rev]
+    assert (got.ref_start, got.ref_end, got.strand) == (100, 240, True)
+    got = store.fragment(1)
+    assert isinstance(got, readstore.SingleRead)
+    assert got.reads == [read_rev]
+    assert got.strand is False
+
+    indices = store.select(3)
+    assert list(store.strands(indices)) == [True, True]
+    assert list(store.total_mapped_bases(store.select(1))) == [88]
+    assert list(store.total_mapped_bases(indices)) == [99 + 88] * 2
+
+
+def test_readstore_amplicons_are_stored_columnar():
+    amplicons_tsv = os.path.join(data_dir, "make_reads_dir_for_cylon.amplicons.tsv")
+    amplicon_set = primers.AmpliconSet.from_tsv(amplicons_tsv)
+    amp1, amp2, amp3 = list(amplicon_set)
+    read_store = readstore.ReadStore(amplicon_set, Bam())
+    read = readstore.Read("A" * 100, 100, 199, 0, 99, False)
+    read_store.amplicons = {amp1: [readstore.SingleRead(read)] * 3, amp3: []}
+
+    assert len(read_store.store) == 3
+    assert set(read_store.amplicons) == {amp1, amp2, amp3}
+    assert len(read_store[amp1]) == 3
+    assert len(read_store[amp2]) == 0
+    assert [f.reads for f in read_store[amp1]] == [[read]] * 3
+    assert read_store[amp1][1].reads == [read]
+
+
+def test_fetch():
+    amplicons_tsv = os.path.join(data_dir, "make_reads_dir_for_cylon.amplicons.tsv")
+    amplicon_set = primers.AmpliconSet.from_tsv(amplicons_tsv)
+    amplicons = list(amplicon_set)
+    read_store = readstore.ReadStore(amplicon_set, Bam())
+    assert len(read_store.fetch(0, 1000)) == 0
+
+    def read(start, length, is_reverse=False):
+        return readstore.Read(
+            "A" * length, start, start + length, 0, length, is_reverse
+        )
+
+    rng = random.Random(1)
+    fragments = {amplicon: [] for amplicon in amplicons}
+    for _ in range(300):
+        start = rng.randrange(0, 800)
+        if rng.random() < 0.5:
+            fragment = readstore.SingleRead(read(start, rng.randrange(1, 150)))
+        else:
+            mate_start = start + rng.randrange(0, 200)
+            fragment = readstore.PairedReads(
+                read(start, rng.randrange(1, 150)),
+                read(mate_start, rng.randrange(1, 150), is_reverse=True),
+            )
+        fragments[rng.choice(amplicons)].append(fragment)
+    read_store.amplicons = fragments
+    store = read_store.store
+    stored = [store.fragment(i).reads for i in range(len(store))]
+
+    for start, end in [(0, 1), (100, 101), (149, 300), (500, 900), (950, 1000)]:
+        got = [f.reads for f in read_store.fetch(start, end)]
+        expect = [
+            reads
+            for reads in stored
+            if any(r.ref_start < end and r.ref_end > start for r in reads)
+        ]
+        assert got == expect
+
+    # a window in the insert of a pair, which neither mate overlaps
+    read_store.amplicons = {
+        amplicons[0]: [readstore.PairedReads(read(100, 100), read(300, 100, True))]
+    }
+    assert len(read_store.fetch(220, 280)) == 0
+    assert len(read_store.fetch(199, 201)) == 1
+    assert len(read_store.fetch(399, 500)) == 1
+    assert len(read_store.fetch(400, 500)) == 0
+
+
+def write_reordered_bam(bam_in, bam_out, order):
+    """Write the reads of a BAM in a new order, setting the sort order in the
+    header to match
+    """
+    with pysam.AlignmentFile(bam_in, "rb") as f:
+        header = f.header.to_dict()
+        reads = list(f)
+    if order == "coordinate":
+        reads.sort(key=lambda r: (r.reference_id, r.reference_start))
+    else:
+        random.Random(3).shuffle(reads)
+    header["HD"]["SO"] = order
+    with pysam.AlignmentFile(bam_out, "wb", header=header) as f:
+        for read in reads:
+            f.write(read)
+
+
+def test_syncronise_fragments_in_any_order():
+    bam_file = os.path.join(
+        this_dir, "data", "primers", "truncated_name_sorted_40_reads.bam"
+    )
+
+    def fragments(bam):
+        return sorted(
+            tuple((r.seq, r.ref_start, r.is_reverse) for r in f.reads)
+            for f in bam.syncronise_fragments()
+        )
+
+    name_sorted = readstore.Bam(bam_file)
+    expect = fragments(name_sorted)
+    assert len(expect) > 0
+    assert fragments(readstore.Bam(bam_file, threads=3)) == expect
+    for order in ["coordinate", "unsorted"]:
+        bam_out = f"tmp.syncronise_fragments.{order}.bam"
+        write_reordered_bam(bam_file, bam_out, order)
+        bam = readstore.Bam(bam_out)
+        assert fragments(bam) == expect
+        assert bam.stats == name_sorted.stats
+        assert bam.stats["mates_evicted"] == 0
+        # a full buffer loses pairs, which is recorded in the stats
+        small = readstore.Bam(bam_out, max_buffered_mates=1)
+        lost = fragments(small)
+        evicted = small.stats["mates_evicted"]
+        if order == "coordinate":
+            assert lost == expect and evicted == 0
+        else:
+            assert len(lost) < len(expect) and evicted > 0
+        os.unlink(bam_out)
+
+
+def test_mate_buffer():
+    read = readstore.Read("A", 0, 1, 0, 1, False)
+
+    mates = readstore.MateBuffer(coordinate_sorted=True, max_size=1)
+    mates.push("a", read, (0, 100))
+    mates.push("b", read, (0, 200))
+    mates.advance((0, 100))
+    # sorted input is only dropped by position, not by size
+    assert len(mates) == 2 and mates.evicted == 0
+    mates.advance((0, 150))
+    assert len(mates) == 1 and mates.dropped == 1
+    assert mates.pop("a") is None
+    assert mates.pop("b") is read
+    mates.advance((1, 0))
+    assert mates.dropped == 1
+
+    mates = readstore.MateBuffer(max_size=2)
+    for name in "abc":
+        mates.push(name, read, (0, 0))
+    mates.advance((1, 0))
+    assert len(mates) == 2 and mates.dropped == mates.evicted == 1
+    assert mates.pop("a") is None
+
+
+def test_bam_from_stream():
+    bam_file = os.path.join(
+        this_dir, "data", "primers", "truncated_name_sorted_40_reads.bam"
+    )
+    _, amplicon_sets = amplicon_schemes.load_list_of_amplicon_sets(
+        built_in_names_to_use=["COVID-ARTIC-V3", "COVID-AMPLISEQ-V1"]
+    )
+    from_file = readstore.Bam(bam_file)
+    chosen, _ = from_file.ingest(amplicon_sets)
+
+    # stream the reads as SAM text through a pipe, like minimap2's stdout
+    sam = "tmp.bam_from_stream.sam"
+    with open(sam, "w") as f:
+        print(pysam.view("-h", bam_file), end="", file=f)
+    view = subprocess.Popen(["cat", sam], stdout=subprocess.PIPE)
+    with pysam.AlignmentFile(view.stdout, "r") as alignments:
+        from_stream = readstore.Bam(stream=alignments)
+        streamed_chosen, _ = from_stream.ingest(amplicon_sets)
+    view.wait()
+    os.unlink(sam)
+    assert streamed_chosen == chosen
+    assert from_stream.stats == from_file.stats
+
+    with pytest.raises(Exception):
+        list(from_stream.syncronise_fragments())
+
+
+def test_mapped_fastqs():
+    rng = random.Random(5)
+    outdir = "tmp.mapped_fastqs"
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+    os.mkdir(outdir)
+    ref = "".join(rng.choices("ACGT", k=1000))
+    ref_fasta = os.path.join(outdir, "ref.fa")
+    with open(ref_fasta, "w") as f:
+        print(">ref", ref, sep="\n", file=f)
+
+    coords = [(rng.randrange(0, 600), rng.randrange(250, 400)) for _ in range(30)]
+    fq1, fq2, fq = [os.path.join(outdir, f"{x}.fq") for x in ["1", "2", "unpaired"]]
+    with open(fq1, "w") as f1, open(fq2, "w") as f2, open(fq, "w") as f:
+        for i, (start, length) in enumerate(coords):
+            end = start + length
+            for out, name, seq in [
+                (f1, f"{i}/1", ref[start : start + 100]),
+                (f2, f"{i}/2", revcomp(ref[end - 100 : end])),
+                (f, f"{i}", ref[start:end] if i % 2 else revcomp(ref[start:end])),
+            ]:
+                print(f"@{name}", seq, "+", "I" * len(seq), sep="\n", file=out)
+
+    expect = sorted(coords)
+    for threads in [1, 2]:
+        paired = readstore.MappedFastqs(ref_fasta, fq1, fq2=fq2, threads=threads)
+        fragments = list(paired.syncronise_fragments())
+        assert paired.infile_is_paired
+        assert paired.stats["reads1"] == paired.stats["reads2"] == 30
+        assert paired.stats["mapped"] == 60
+        got = sorted((f.ref_start, f.ref_end - f.ref_start) for f in fragments)
+        assert got == expect
+        for fragment in fragments:
+            for read in fragment.reads:
+                assert read.seq == ref[read.ref_start : read.ref_end]
+                assert read.cigar == ((len(read.seq), 0),)
+
+        unpaired = readstore.MappedFastqs(
+            ref_fasta, fq, template_length_threshold=0, threads=threads
+        )
+        fragments = list(unpaired.syncronise_fragments())
+        assert not unpaired.infile_is_paired
+        assert unpaired.stats["unpaired_reads"] == 30
+        got = sorted((f.ref_start, f.ref_end - f.ref_start) for f in fragments)
+        assert got == expect
+        assert {f.reads[0].is_reverse for f in fragments} == {True, False}
+        assert all(f.reads[0].seq == ref[f.ref_start : f.ref_end] for f in fragments)
+
+    # a chimeric read also gets a supplementary alignment, which mappy marks
+    # as primary too. The first (primary) alignment is the one used
+    chimera = os.path.join(outdir, "chimera.fq")
+    with open(chimera, "w") as f:
+        seq = ref[100:400] + revcomp(ref[700:900])
+        print("@chimera", seq, "+", "I" * len(seq), sep="\n", file=f)
+    hits = list(readstore.load_aligner(ref_fasta, "map-ont").map(seq))
+    assert len(hits) == 2 and all(hit.is_primary for hit in hits)
+    fragments = list(readstore.MappedFastqs(ref_fasta, chimera).syncronise_fragments())
+    assert [(f.ref_start, f.ref_end) for f in fragments] == [(100, 400)]
+
+    with open(fq2, "a") as f:
+        print("@extra", ref[:100], "+", "I" * 100, sep="\n", file=f)
+    with pytest.raises(Exception, match="different numbers of reads"):
+        list(readstore.MappedFastqs(ref_fasta, fq1, fq2=fq2).syncronise_fragments())
+    with pytest.raises(Exception, match="does not exist"):
+        readstore.MappedFastqs(ref_fasta, os.path.join(outdir, "missing.fq"))
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
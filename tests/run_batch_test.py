@@ -0,0 +1,135 @@
+import json
+import os
+import pytest
+import subprocess
+
+from viridian_workflow.__main__ import make_parser
+from viridian_workflow.tasks import run_batch
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_sample_sheet(outfile, rows):
+    with open(outfile, "w") as f:
+        for row in rows:
+            print(*row, sep="\t", file=f)
+
+
+def batch_options(outdir, sample_sheet, workers=2, threads=4):
+    return make_parser().parse_args(
+        [
+            "run_batch",
+            "--outdir",
+            outdir,
+            "--sample_sheet",
+            sample_sheet,
+            "--ref_fasta",
+            os.path.join(this_dir, "data", "minimap", "ref.fa"),
+            "--workers",
+            str(workers),
+            "--threads",
+            str(threads),
+        ]
+    )
+
+
+def test_load_sample_sheet():
+    sheet = "tmp.load_sample_sheet.tsv"
+    write_sample_sheet(
+        sheet,
+        [
+            ["Name", "Tech", "Reads1", "Reads2"],
+            ["s1", "illumina", "s1_1.fq", "s1_2.fq"],
+            ["s2", "ont", "s2.fq", ""],
+        ],
+    )
+    samples = run_batch.load_sample_sheet(sheet)
+    assert samples == [
+        {"Name": "s1", "Tech": "illumina", "Reads1": "s1_1.fq", "Reads2": "s1_2.fq"},
+        {"Name": "s2", "Tech": "ont", "Reads1": "s2.fq", "Reads2": None},
+    ]
+
+    options = batch_options("tmp.out", sheet)
+    s1 = run_batch.sample_options(options, samples[0], 2)
+    assert (s1.outdir, s1.sample_name, s1.threads) == (
+        os.path.join("tmp.out", "s1"),
+        "s1",
+        2,
+    )
+    assert (s1.tech, s1.reads, s1.reads1, s1.reads2) == (
+        "illumina",
+        None,
+        "s1_1.fq",
+        "s1_2.fq",
+    )
+    assert s1.consensus is None
+    s2 = run_batch.sample_options(options, samples[1], 2)
+    assert (s2.tech, s2.reads, s2.reads1, s2.reads2) == ("ont", "s2.fq", None, None)
+    assert options.outdir == "tmp.out"
+
+    write_sample_sheet(sheet, [["Name", "Reads1"], ["s1", "s1.fq"]])
+    with pytest.raises(Exception):
+        run_batch.load_sample_sheet(sheet)
+
+    write_sample_sheet(
+        sheet, [["Name", "Tech", "Reads1"], ["s1", "ont", "a.fq"], ["s1", "ont", "b.fq"]]
+    )
+    with pytest.raises(Exception):
+        run_batch.load_sample_sheet(sheet)
+
+    for name in ["..", ".", "a/b", "../s1", ""]:
+        write_sample_sheet(sheet, [["Name", "Tech", "Reads1"], [name, "ont", "a.fq"]])
+        with pytest.raises(Exception):
+            run_batch.load_sample_sheet(sheet)
+    os.unlink(sheet)
+
+
+def test_run_batch_sample_records_errors():
+    # an existing output directory fails only that sample
+    outdir = "tmp.run_batch_sample"
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+    os.makedirs(os.path.join(outdir, "s1"))
+    sample = {"Name": "s1", "Tech": "ont", "Reads1": "tmp.does_not_exist.fq"}
+    options = run_batch.sample_options(batch_options(outdir, "samples.tsv"), sample, 1)
+    summary = run_batch.run_batch_sample(options)
+    assert summary["Success"] is False
+    assert "exists" in summary["error"]
+    assert summary["Outdir"] == os.path.join(outdir, "s1")
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+
+
+def test_run_batch_writes_summary():
+    # The reads files do not exist, so every sample fails, but each still
+    # gets its own output directory and a line in the summary
+    outdir = "tmp.run_batch"
+    sheet = "tmp.run_batch.tsv"
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+    write_sample_sheet(
+        sheet,
+        [
+            ["Name", "Tech", "Reads1", "Reads2"],
+            ["s1", "illumina", "tmp.does_not_exist_1.fq", "tmp.does_not_exist_2.fq"],
+            ["s2", "ont", "tmp.does_not_exist.fq", ""],
+            ["s3", "ont", "tmp.does_not_exist.fq", ""],
+        ],
+    )
+    run_batch.run(batch_options(outdir, sheet))
+
+    with open(os.path.join(outdir, "summary.json")) as f:
+        summary = json.load(f)
+    assert summary["workers"] == 2
+    assert summary["threads_per_sample"] == 2
+    assert summary["Succeeded"] == 0
+    assert summary["Failed"] == 3
+    assert list(summary["Samples"]) == ["s1", "s2", "s3"]
+    for name in ["s1", "s2", "s3"]:
+        assert summary["Samples"][name]["Outdir"] == os.path.join(outdir, name)
+        with open(os.path.join(outdir, name, "log.json")) as f:
+            log = json.load(f)
+        assert log["Summary"]["options"]["sample_name"] == name
+        assert log["Summary"]["options"]["threads"] == 2
+        assert not log["Summary"]["Success"]
+
+    with pytest.raises(Exception):
+        run_batch.run(batch_options(outdir, sheet))
+    subprocess.check_output(f"rm -rf {outdir} {sheet}", shell=True)
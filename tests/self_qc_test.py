@@ -3,8 +3,12 @@ from pathlib import Path
 import pytest
 from collections import namedtuple, defaultdict
 
+import random
+import subprocess
+
+import numpy as np
 from intervaltree import Interval
-from viridian_workflow import self_qc, primers
+from viridian_workflow import self_qc, primers, readstore
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(this_dir, "data", "self_qc")
@@ -20,6 +24,198 @@ class StatsTest:
         return self.fail
 
 
+class MockBam:
+    infile_is_paired = False
+
+    def syncronise_fragments(self):
+        return []
+
+
+def make_remapping_test_data(outdir, reads_per_amplicon=50):
+    """Write a random consensus and an identity MSA, and build a readstore
+    of two amplicons with reads sampled from the consensus with errors
+    """
+    rng = random.Random(42)
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+    os.mkdir(outdir)
+    consensus = "".join(rng.choices("ACGT", k=1000))
+    consensus_fasta = Path(outdir) / "consensus.fa"
+    with open(consensus_fasta, "w") as f:
+        print(">consensus", consensus, sep="\n", file=f)
+    msa = Path(outdir) / "msa"
+    with open(msa, "w") as f:
+        print(consensus, consensus, sep="\n", file=f)
+
+    amplicons = {}
+    for i, (start, end) in enumerate([(100, 500), (450, 900)]):
+        amplicon = primers.Amplicon(f"amp{i + 1}", shortname=i)
+        left = consensus[start : start + 20]
+        right = consensus[end - 20 : end]
+        amplicon.add(
+            primers.Primer(f"amp{i + 1}_l", left, True, True, start, start + 20)
+        )
+        amplicon.add(
+            primers.Primer(f"amp{i + 1}_r", right, False, False, end - 20, end)
+        )
+        amplicons[amplicon.name] = amplicon
+    amplicon_set = primers.AmpliconSet("test", amplicons, fn=msa)
+
+    fragments = {}
+    for amplicon in amplicon_set:
+        fragments[amplicon] = []
+        for _ in range(reads_per_amplicon):
+            seq = list(consensus[amplicon.start : amplicon.end])
+            for _ in range(5):
+                seq[rng.randrange(len(seq))] = rng.choice("ACGT")
+            cigar = ((len(seq), 0),)
+            if rng.random() < 0.3:
+                deleted = rng.randrange(30, len(seq) - 30)
+                del seq[deleted]
+                cigar = ((deleted, 0), (1, 2), (len(seq) - deleted, 0))
+            seq = "".join(seq)
+            read = readstore.Read(
+                seq,
+                amplicon.start,
+                amplicon.end,
+                0,
+                len(seq),
+                rng.random() < 0.5,
+                cigar=cigar,
+            )
+            fragments[amplicon].append(readstore.SingleRead(read))
+    reads = readstore.ReadStore(amplicon_set, MockBam())
+    reads.amplicons = fragments
+    return consensus_fasta, msa, reads
+
+
+def pileup_summary(pileup):
+    return [(str(stats), stats.info()) for stats in pileup.seq]
+
+
+def test_parallel_remapping_matches_serial():
+    outdir = "tmp.parallel_remapping"
+    consensus_fasta, msa, reads = make_remapping_test_data(outdir)
+    serial = self_qc.Pileup(consensus_fasta, reads, msa=msa)
+    parallel = self_qc.Pileup(consensus_fasta, reads, msa=msa, threads=3)
+    assert serial.seq[300].depth > 0
+    assert pileup_summary(serial) == pileup_summary(parallel)
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+
+
+def test_liftover_matches_remapping():
+    outdir = "tmp.liftover"
+    consensus_fasta, msa, reads = make_remapping_test_data(outdir)
+    remapped = self_qc.Pileup(consensus_fasta, reads, msa=msa)
+    lifted = self_qc.Pileup(consensus_fasta, reads, msa=msa, liftover=True)
+    assert remapped.summary["Remapping"]["lifted_over"] == 0
+    assert remapped.summary["Remapping"]["remapped"] == 100
+    assert lifted.summary["Remapping"]["lifted_over"] == 100
+    assert lifted.summary["Remapping"]["remapped"] == 0
+
+    # minimap2 may soft clip mismatches at read ends, or place a deletion
+    # differently in a repeat, so only expect the pileups to mostly agree
+    differences = sum(
+        a != b for a, b in zip(pileup_summary(remapped), pileup_summary(lifted))
+    )
+    assert differences < 0.05 * len(remapped.seq)
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+
+
+def test_liftover_remaps_reads_overlapping_indels():
+    outdir = "tmp.liftover_indels"
+    consensus_fasta, msa, reads = make_remapping_test_data(outdir)
+    with open(msa) as f:
+        consensus = f.readline().strip()
+    # the consensus has an insertion at 700, which is in amplicon 2 only
+    with open(msa, "w") as f:
+        print(consensus[:700] + "-" + consensus[701:], consensus, sep="\n", file=f)
+
+    m = self_qc.Msa(msa)
+    assert not m.has_indel(0, 699)
+    assert m.has_indel(650, 750)
+    assert m.has_indel(699, 700)
+    assert m.has_indel(700, 701)
+    assert not m.has_indel(701, 800)
+
+    lifted = self_qc.Pileup(consensus_fasta, reads, msa=msa, liftover=True)
+    assert lifted.summary["Remapping"]["lifted_over"] == 50
+    assert lifted.summary["Remapping"]["remapped"] == 50
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+
+
+def test_duplicate_reads_are_mapped_once():
+    outdir = "tmp.duplicate_reads"
+    consensus_fasta, msa, reads = make_remapping_test_data(outdir)
+    single = self_qc.Pileup(consensus_fasta, reads, msa=msa)
+    reads.amplicons = {
+        amplicon: list(fragments) * 3
+        for amplicon, fragments in reads.amplicons.items()
+    }
+    tripled = self_qc.Pileup(consensus_fasta, reads, msa=msa)
+    assert tripled.summary["Remapping"] == {
+        "lifted_over": 0,
+        "remapped": 300,
+        "distinct_sequences": 100,
+        "cache_hits": 200,
+        "cache_hit_rate": 200 / 300,
+    }
+    for a, b in zip(single.seq, tripled.seq):
+        assert b.depth == 3 * a.depth
+        assert b.total.refs == 3 * a.total.refs
+        assert b.total.alts == 3 * a.total.alts
+    subprocess.check_output(f"rm -rf {outdir}", shell=True)
+
+
+def test_weighted_pileup_counts():
+    consensus = "ACGTACGTAC"
+    amplicon = primers.Amplicon("amp1", shortname=0)
+    calls = self_qc.encode_bases("ACGAA")
+    in_primer = np.array([True, False, False, False, True])
+    repeated = self_qc.PileupCounts(len(consensus))
+    weighted = self_qc.PileupCounts(len(consensus))
+    for _ in range(4):
+        repeated.add(amplicon, np.arange(2, 7), calls, in_primer, False)
+    weighted.add(amplicon, np.arange(2, 7), calls, in_primer, False, weight=4)
+    repeated.flush()
+    weighted.flush()
+    assert np.array_equal(repeated.windows[amplicon][1], weighted.windows[amplicon][1])
+
+
+def test_pileup_counts_match_stats():
+    consensus = "ACGTACGTAC"
+    amp1 = primers.Amplicon("amp1", shortname=0)
+    amp2 = primers.Amplicon("amp2", shortname=1)
+    rng = random.Random(7)
+    stats = [self_qc.Stats(i, base, base) for i, base in enumerate(consensus)]
+    counts = self_qc.PileupCounts(len(consensus), batch_size=5)
+    for amplicon, start, end in [(amp1, 0, 7), (amp2, 5, 10), (amp1, 1, 6)] * 4:
+        calls = "".join(rng.choice("ACGT-N") for _ in range(start, end))
+        in_primer = [rng.random() < 0.3 for _ in calls]
+        forward = rng.random() < 0.5
+        for i, call in enumerate(calls):
+            stats[start + i].update(
+                self_qc.BaseProfile(call, in_primer[i], forward, amplicon)
+            )
+        counts.add(
+            amplicon,
+            np.arange(start, end),
+            self_qc.encode_bases(calls),
+            np.array(in_primer),
+            forward,
+        )
+
+    got = counts.evaluate(consensus, list(range(10)), list(consensus))
+    for position, evaluated in zip(stats, got):
+        expect = self_qc.EvaluatedStats(position)
+        assert evaluated.info() == expect.info()
+        assert evaluated.tsv_row() == expect.tsv_row()
+        assert evaluated.total == expect.total
+        assert dict(evaluated.alt_bases) == dict(expect.alt_bases)
+        assert (
+            evaluated.multiple_amplicon_support == expect.multiple_amplicon_support
+        )
+
+
 def test_cigar_tuple_construction():
 
     Alignment = namedtuple("Alignment", ["r_st", "cigar", "q_st"])
@@ -117,6 +313,36 @@ def test_mappy_cigar_liftover():
     assert ref[-54:] == "".join(map(lambda x: x[1], a))[-54:]
 
 
+def test_parse_cigar_arrays():
+    Alignment = namedtuple("Alignment", ["r_st", "cigar", "q_st"])
+    cases = [
+        ("AAA", Alignment(0, [(3, 0)], 0)),
+        ("ATTAA", Alignment(0, [(1, 0), (2, 1), (2, 0)], 0)),
+        ("AAA", Alignment(0, [(1, 0), (2, 2), (2, 0)], 0)),
+        ("GGGAAAA", Alignment(3, [(3, 4), (4, 0)], 3)),
+        # match runs past the end of the query are truncated
+        ("ACGT", Alignment(5, [(3, 0), (2, 2), (4, 0), (1, 2)], 0)),
+        ("ACGTN", Alignment(0, [], 0)),
+    ]
+    rng = random.Random(3)
+    for _ in range(50):
+        query = "".join(rng.choices("ACGTN", k=100))
+        cigar = [(rng.randrange(1, 10), rng.choice([0, 0, 1, 2, 3, 4, 5]))]
+        cigar += [(rng.randrange(1, 10), rng.choice([0, 1, 2])) for _ in range(8)]
+        cases.append((query, Alignment(rng.randrange(50), cigar, rng.randrange(5))))
+
+    for query, alignment in cases:
+        positions, calls = self_qc.parse_cigar_arrays(query, alignment)
+        expect = self_qc.parse_cigar(query, alignment)
+        assert list(positions) == [position for position, _ in expect]
+        assert "".join(self_qc.BASES[c] for c in calls) == "".join(
+            call for _, call in expect
+        )
+
+    with pytest.raises(Exception):
+        self_qc.parse_cigar_arrays("A", Alignment(0, [(1, 7)], 0))
+
+
 def test_stat_evaluation():
     return True  # resolve
 
@@ -186,6 +412,27 @@ def test_ref_cons_position_translation():
     assert msa._ref_to_consensus[8] == 7
 
 
+def test_bulk_position_translation():
+    msa = self_qc.Msa(Path(data_dir) / "ref_first.msa")
+    ref_positions = np.arange(-1, 27)
+    assert list(msa.ref_to_consensus_array(ref_positions)) == [
+        msa.ref_to_consensus(p) for p in ref_positions
+    ]
+    cons_positions = np.array([0, 1, 4, 7, 10, 16, 17, 100])
+    assert list(msa.consensus_to_ref_array(cons_positions)) == [
+        0,
+        4,
+        7,
+        8,
+        13,
+        19,
+        0,
+        0,
+    ]
+    assert msa.ref == "ACTGACTATCGATCGATCGATCAG"
+    assert msa.cons == "GACTGCAGCTCGCACG"
+
+
 def test_position_table_cons_shorter():
     """
              1      1     2
@@ -0,0 +1,83 @@
+import json
+import os
+import socket
+import subprocess
+import threading
+
+import pytest
+
+from viridian_workflow import readstore
+from viridian_workflow.__main__ import make_parser
+from viridian_workflow.tasks import serve
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_serve_runs_submitted_jobs():
+    outdir = "tmp.serve"
+    socket_path = "tmp.serve.sock"
+    subprocess.check_output(f"rm -rf {outdir} {socket_path}", shell=True)
+    ref = os.path.join(this_dir, "data", "minimap", "ref.fa")
+    options = make_parser().parse_args(
+        [
+            "serve",
+            "--outdir",
+            outdir,
+            "--socket",
+            socket_path,
+            "--ref_fasta",
+            ref,
+            "--mapper",
+            "mappy",
+        ]
+    )
+
+    server = serve.Server(socket_path, options)
+    # the reference is indexed when the server starts, not for each job
+    assert readstore.load_aligner(ref, "sr") is readstore.load_aligner(ref, "sr")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # the reads do not exist, so the sample fails, but is still run in
+        # its own directory with a log like run_one_sample
+        job = {"Name": "s1", "Tech": "ont", "Reads1": "tmp.does_not_exist.fq"}
+        summary = serve.submit(socket_path, job)
+        assert summary["Success"] is False
+        assert summary["Outdir"] == os.path.join(outdir, "s1")
+        with open(os.path.join(outdir, "s1", "log.json")) as f:
+            log = json.load(f)
+        assert log["Summary"]["options"]["sample_name"] == "s1"
+
+        # the output directory already exists
+        summary = serve.submit(socket_path, job)
+        assert summary["Success"] is False
+        assert "exists" in summary["error"]
+
+        summary = serve.submit(socket_path, {"Name": "s2", "Tech": "ont"})
+        assert summary == {"Success": False, "error": "Job is missing Reads1"}
+        job = {"Name": "../s3", "Tech": "ont", "Reads1": "s3.fq"}
+        assert serve.submit(socket_path, job)["Success"] is False
+        assert not os.path.exists("s3")
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    subprocess.check_output(f"rm -rf {outdir} {socket_path}", shell=True)
+
+
+def test_remove_socket():
+    path = "tmp.serve_remove_socket"
+    subprocess.check_output(f"rm -rf {path}", shell=True)
+    serve.remove_socket(path)
+
+    with open(path, "w") as f:
+        f.write("not a socket\n")
+    with pytest.raises(Exception, match="not a socket"):
+        serve.remove_socket(path)
+    assert os.path.exists(path)
+    os.unlink(path)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+    serve.remove_socket(path)
+    assert not os.path.exists(path)
@@ -3,6 +3,7 @@ import filecmp
 import os
 import pytest
 import subprocess
+import threading
 from unittest import mock
 
 import pyfastaq
@@ -29,6 +30,69 @@ def test_load_single_seq_fasta():
         utils.load_single_seq_fasta(infile)
 
 
+def test_read_seqs():
+    fq1 = "tmp.read_seqs.1.fq"
+    fq2 = "tmp.read_seqs.2.fq"
+    for filename, seqs in [(fq1, ["A", "C", "G"]), (fq2, ["T"])]:
+        with open(filename, "w") as f:
+            for i, seq in enumerate(seqs):
+                print(f"@{i}", seq, "+", "I", sep="\n", file=f)
+    assert list(utils.read_seqs([fq1, fq2], 2)) == ["A", "C", "T"]
+    os.unlink(fq1)
+    os.unlink(fq2)
+
+
+def test_resource_usage():
+    progress = []
+    with utils.stage("outer", progress) as outer:
+        with utils.stage("inner", progress):
+            memory = bytearray(50_000_000)
+            subprocess.check_output("sleep 0.1", shell=True)
+        del memory
+    inner = progress[1]
+    assert [log["Task"] for log in progress] == ["outer", "inner"]
+    for log in progress:
+        assert log["Success"]
+        for key in [
+            "wall_time",
+            "user_cpu",
+            "sys_cpu",
+            "children_user_cpu",
+            "children_sys_cpu",
+            "peak_rss_mb",
+            "children_peak_rss_mb",
+        ]:
+            assert log[key] >= 0
+    assert inner["wall_time"] >= 0.1
+    assert outer["wall_time"] >= inner["wall_time"]
+    # the inner stage's memory counts towards the outer stage's peak
+    assert inner["peak_rss_mb"] >= 45
+    assert outer["peak_rss_mb"] >= inner["peak_rss_mb"]
+
+    progress = []
+    with pytest.raises(ZeroDivisionError):
+        with utils.stage("fails", progress):
+            1 / 0
+    assert not progress[0]["Success"]
+    assert progress[0]["wall_time"] >= 0
+
+    # a stage in another thread waits for the open stage to finish
+    events = []
+
+    def second_stage():
+        with utils.stage("second", []):
+            events.append("second started")
+
+    with utils.stage("first", []):
+        thread = threading.Thread(target=second_stage)
+        thread.start()
+        thread.join(timeout=0.2)
+        assert thread.is_alive()
+        events.append("first finished")
+    thread.join()
+    assert events == ["first finished", "second started"]
+
+
 def test_amplicons_json_to_bed_and_range():
     json_in = os.path.join(data_dir, "amplicons_json_to_bed.json")
     expect_bed = os.path.join(data_dir, "amplicons_json_to_bed.bed")
@@ -3,18 +3,10 @@ Viridian Workflow
 
 Wrapper around cylon
 """
-from pkg_resources import get_distribution
-from viridian_workflow import (
-    amplicon_schemes,
-    primers,
-    self_qc,
-    readstore,
-    tasks,
-    utils,
-    reads,
-)
+from importlib import import_module
+from importlib.metadata import version
 
-__version__ = get_distribution("viridian_workflow").version
+__version__ = version("viridian_workflow")
 
 __all__ = [
     "amplicon_schemes",
@@ -25,3 +17,11 @@ __all__ = [
     "utils",
     "reads",
 ]
+
+
+def __getattr__(name):
+    # submodules are imported on first use, so that the command line can
+    # start (eg for --help) without loading pysam, mappy, numpy and friends
+    if name in __all__:
+        return import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
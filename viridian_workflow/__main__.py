@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+from functools import partial
+from importlib import import_module
 import logging
 import sys
 import viridian_workflow
+from viridian_workflow import amplicon_schemes
+
+
+def run_task(task, function, options):
+    """Run a function of a module in viridian_workflow.tasks. Tasks are only
+    imported when they are run, so that the heavy dependencies of the
+    pipeline are not loaded for --help, --version, or bad options
+    """
+    getattr(import_module(f"viridian_workflow.tasks.{task}"), function)(options)
 
 
 def check_reads_args(args):
@@ -21,7 +32,8 @@ def check_reads_args(args):
         raise NotImplementedError(f"tech {args.tech} not implemented")
 
 
-def main(args=None):
+def make_parser() -> argparse.ArgumentParser:
+    """The command line parser, with a subparser for each command"""
     parser = argparse.ArgumentParser(
         prog="viridian_workflow",
         usage="viridian_workflow <command> <options>",
@@ -51,7 +63,7 @@ def main(args=None):
     # -------------- amplicons options ---------------------------------------
     amplicons_parser = argparse.ArgumentParser(add_help=False)
     scheme_names = ",".join(
-        sorted(list(viridian_workflow.amplicon_schemes.get_built_in_schemes().keys()))
+        sorted(list(amplicon_schemes.get_built_in_schemes().keys()))
     )
     amplicons_parser.add_argument(
         "--built_in_amp_schemes",
@@ -114,6 +126,13 @@ def main(args=None):
         action="store_true",
         help="Keep BAM file of reads mapped to reference genome (it is deleted by default)",
     )
+    run_one_sample_parser.add_argument(
+        "--bam_compression_level",
+        type=int,
+        choices=range(10),
+        help="Compression level (0-9) of the BAM file kept with --keep_bam. Low levels are quicker to write and to read back, but make a larger file [samtools default, 6]",
+        metavar="INT",
+    )
     run_one_sample_parser.add_argument(
         "--dump_tsv",
         action="store_true",
@@ -151,6 +170,44 @@ def main(args=None):
         help="Maximum allowed percentage of Ns in the consensus sequence. The pipeline is stopped as soon as too many Ns are detected [%(default)s]",
         metavar="FLOAT",
     )
+    run_one_sample_parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads to use, shared between the pipeline stages [%(default)s]",
+        metavar="INT",
+    )
+    run_one_sample_parser.add_argument(
+        "--mapper",
+        choices=["minimap2", "mappy"],
+        default="minimap2",
+        help="Map reads to the reference with the minimap2 program, or in-process with mappy. mappy avoids writing and parsing SAM, but cannot make a BAM file, so minimap2 is always used with --keep_bam [%(default)s]",
+    )
+    run_one_sample_parser.add_argument(
+        "--index_cache",
+        help="Directory of minimap2 indexes of the reference, reused between runs. Indexes are built there when missing, and rebuilt when the reference changes",
+        metavar="DIRNAME",
+    )
+    run_one_sample_parser.add_argument(
+        "--liftover",
+        action="store_true",
+        help="Project reads onto the consensus through the reference/consensus alignment instead of remapping them. Reads overlapping an indel between the two are still remapped",
+    )
+    run_one_sample_parser.add_argument(
+        "--sequential_detection",
+        action="store_true",
+        help="Choose the amplicon scheme as soon as one wins with high confidence, instead of after matching every read against every scheme. Only the chosen scheme is matched against the remaining reads",
+    )
+    run_one_sample_parser.add_argument(
+        "--primer_detection",
+        action="store_true",
+        help="Before mapping, look for each amplicon scheme's primers at the start of the first reads. If one scheme is a clear winner, only that scheme is matched against the mapped reads",
+    )
+    run_one_sample_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile each in-process stage of the pipeline, writing a cProfile .prof file and a collapsed stack file (for flamegraph.pl or speedscope) per stage to a 'profile' directory in the output directory. The readstore and self_qc stages also get a tracemalloc report of their top allocations. This slows the pipeline down",
+    )
     subparser_run_one_sample = subparsers.add_parser(
         "run_one_sample",
         parents=[
@@ -165,7 +222,7 @@ def main(args=None):
         epilog=reads_ref_epilog,
     )
     subparser_run_one_sample.set_defaults(
-        func=viridian_workflow.tasks.run_one_sample.run
+        func=partial(run_task, "run_one_sample", "run")
     )
     # cuckoo mode
 
@@ -179,13 +236,79 @@ def main(args=None):
         ],
     )
     subparser_cuckoo.add_argument("--consensus", required=True, metavar="FILENAME")
-    subparser_cuckoo.set_defaults(func=viridian_workflow.tasks.run_one_sample.cuckoo)
+    subparser_cuckoo.set_defaults(func=partial(run_task, "run_one_sample", "cuckoo"))
+
+    # ------------------------ run_batch ---------------------------------
+    subparser_run_batch = subparsers.add_parser(
+        "run_batch",
+        parents=[run_one_sample_parser, amplicons_parser],
+        help="Run the complete pipeline on a batch of samples",
+        usage="viridian_workflow run_batch [options] --sample_sheet samples.tsv --ref_fasta ref.fasta --outdir out",
+        description="Run the complete pipeline on a batch of samples, several at a time. Each sample is written to a directory named after it inside the output directory, and a summary of all samples to summary.json",
+    )
+    subparser_run_batch.add_argument(
+        "--sample_sheet",
+        help="REQUIRED. Tab-delimited file of samples, with a header line. Must have columns 'Name', 'Tech' (illumina or ont) and 'Reads1'. Illumina samples also need 'Reads2'. An optional 'Consensus' column runs a sample in cuckoo mode",
+        required=True,
+        metavar="FILENAME",
+    )
+    subparser_run_batch.add_argument(
+        "--ref_fasta",
+        help="REQUIRED. FASTA file of reference genome",
+        required=True,
+        metavar="FILENAME",
+    )
+    subparser_run_batch.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of samples to run at the same time. The --threads are shared between them [%(default)s]",
+        metavar="INT",
+    )
+    subparser_run_batch.add_argument(
+        "--debug",
+        help="More verbose logging, and less file cleaning",
+        action="store_true",
+    )
+    subparser_run_batch.set_defaults(func=partial(run_task, "run_batch", "run"))
+
+    # ------------------------ serve -------------------------------------
+    subparser_serve = subparsers.add_parser(
+        "serve",
+        parents=[run_one_sample_parser, amplicons_parser],
+        help="Run samples sent to a UNIX socket, keeping schemes and indexes loaded",
+        usage="viridian_workflow serve [options] --socket viridian.sock --ref_fasta ref.fasta --outdir out",
+        description="Run samples sent to a UNIX socket, one at a time. Amplicon schemes and the reference index are loaded once, when the server starts. Each job is a line of JSON with the same fields as a run_batch sample sheet row, and is written to a directory named after it inside the output directory",
+    )
+    subparser_serve.add_argument(
+        "--socket",
+        help="REQUIRED. Path of the UNIX socket to listen on",
+        required=True,
+        metavar="FILENAME",
+    )
+    subparser_serve.add_argument(
+        "--ref_fasta",
+        help="REQUIRED. FASTA file of reference genome",
+        required=True,
+        metavar="FILENAME",
+    )
+    subparser_serve.add_argument(
+        "--debug",
+        help="More verbose logging, and less file cleaning",
+        action="store_true",
+    )
+    subparser_serve.set_defaults(func=partial(run_task, "serve", "run"))
+    return parser
+
 
-    args = parser.parse_args()
+def main(args=None):
+    parser = make_parser()
+    args = parser.parse_args(args)
     if not hasattr(args, "func"):
         parser.print_help()
         sys.exit()
-    check_reads_args(args)
+    if hasattr(args, "tech"):
+        check_reads_args(args)
 
     logging.basicConfig(
         format="[%(asctime)s viridian_workflow %(levelname)s] %(message)s",
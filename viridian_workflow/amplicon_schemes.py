@@ -4,14 +4,24 @@ Collect the built-in amplicon scheme files
 from __future__ import annotations
 
 import csv
-from typing import Optional
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Optional, TYPE_CHECKING
 from pathlib import Path
 
-from viridian_workflow import primers
+if TYPE_CHECKING:
+    # primers pulls in numpy and intervaltree, which the command line does
+    # not need just to list the built-in schemes
+    from viridian_workflow import primers
 
 this_dir = Path(__file__).resolve().parent
 DATA_DIR = this_dir / "amplicon_scheme_data"
 
+# bump when AmpliconSet, Amplicon or Primer change, to recompile schemes
+COMPILED_SCHEME_VERSION = 1
+
 
 def get_built_in_schemes() -> dict[str, Path]:
     """Read list of built-in schemes from schemes.tsv"""
@@ -38,6 +48,60 @@ def get_built_in_schemes() -> dict[str, Path]:
     return schemes
 
 
+def default_scheme_cache_dir() -> Path:
+    """The user's cache directory for compiled schemes, following the XDG
+    base directory spec
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "viridian_workflow" / "schemes"
+
+
+def load_amplicon_set(
+    tsv: Path, name: str, cache_dir: Optional[Path] = None
+) -> primers.AmpliconSet:
+    """Load an amplicon scheme TSV, using a compiled copy if there is one
+
+    Compiled schemes are pickled AmpliconSets, kept in the user's cache
+    directory (see default_scheme_cache_dir), or in cache_dir. They are
+    named only by a hash of the TSV's contents and the scheme's name, so an
+    edited TSV is compiled again wherever it is. A compiled scheme that
+    cannot be loaded is rebuilt, and if the cache cannot be written the TSV
+    is just parsed.
+    """
+    tsv = Path(tsv)
+    with open(tsv, "rb") as f:
+        digest = hashlib.sha256(f.read() + name.encode()).hexdigest()
+    cache_dir = default_scheme_cache_dir() if cache_dir is None else Path(cache_dir)
+    compiled = cache_dir / f"{digest}.v{COMPILED_SCHEME_VERSION}.pickle"
+
+    try:
+        with open(compiled, "rb") as f:
+            amplicon_set = pickle.load(f)
+        amplicon_set.fn = tsv
+        return amplicon_set
+    except Exception:
+        # missing, or unreadable by this version of the code
+        pass
+
+    from viridian_workflow import primers
+
+    amplicon_set = primers.AmpliconSet.from_tsv(tsv, name=name)
+    try:
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd, tmp_compiled = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(amplicon_set, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_compiled, compiled)
+        finally:
+            if os.path.exists(tmp_compiled):
+                os.unlink(tmp_compiled)
+    except OSError:
+        # eg a read-only install
+        pass
+    return amplicon_set
+
+
 def load_amplicon_index(
     index_tsv: Path, scheme_dir: Path, subset: dict[str, Path] = None
 ) -> dict[str, Path]:
@@ -99,5 +163,5 @@ def load_list_of_amplicon_sets(
     assert len(schemes) > 0
     return (
         schemes,
-        [primers.AmpliconSet.from_tsv(v, name=k) for k, v in sorted(schemes.items())],
+        [load_amplicon_set(v, k) for k, v in sorted(schemes.items())],
     )
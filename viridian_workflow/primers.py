@@ -3,13 +3,16 @@ AmpliconSets are collections of Amplicons.
 
 Amplicons may have multiple associated primers.
 """
+
 from __future__ import annotations
 
-from typing import Optional
+from typing import Any, Iterable, Optional
+from collections import defaultdict
 import csv
 from pathlib import Path
 from dataclasses import dataclass
 from intervaltree import IntervalTree  # type: ignore
+import numpy as np
 from viridian_workflow.utils import Index0, Index1, in_range
 from viridian_workflow.reads import Fragment
 
@@ -71,12 +74,20 @@ class Amplicon:
         self, fragment: Fragment, primer_match_threshold: int = 5
     ) -> tuple[Optional[Primer], Optional[Primer]]:
         """Attempt to match either end of a fragment against the amplicon's primers"""
+        return self.match_primers_to_span(
+            fragment.ref_start, fragment.ref_end, primer_match_threshold
+        )
+
+    def match_primers_to_span(
+        self, ref_start: Index0, ref_end: Index0, primer_match_threshold: int = 5
+    ) -> tuple[Optional[Primer], Optional[Primer]]:
+        """match_primers for a fragment's reference start and end"""
         p1, p2 = None, None
 
         min_dist = primer_match_threshold
         # closest leftmost position
         for primer in self.left:
-            dist = abs(fragment.ref_start - primer.ref_start)
+            dist = abs(ref_start - primer.ref_start)
             if dist < primer_match_threshold:
                 if dist <= min_dist:
                     min_dist = dist
@@ -85,7 +96,7 @@ class Amplicon:
         min_dist = primer_match_threshold
         # closest rightmost position
         for primer in self.right:
-            dist = abs(primer.ref_end - fragment.ref_end)
+            dist = abs(primer.ref_end - ref_end)
             if dist < primer_match_threshold:
                 if dist <= min_dist:
                     min_dist = dist
@@ -140,7 +151,8 @@ class AmpliconSet:
             # base-54 hash for packing annotations into bam file fields
             # (not used)
             self.shortname = chr(((sum(map(ord, name)) - ord("A")) % 54) + 65)
-        self.tree = IntervalTree()
+        self.tolerance: int = tolerance
+        self._tree: Optional[IntervalTree] = None
         self.name: str = name
         self.seqs = {}
         self.amplicons = amplicons
@@ -162,18 +174,15 @@ class AmpliconSet:
                 sequences[primer.seq] = amplicon
                 primer_lengths.add(len(primer.seq))
 
-            # interval containment tolerance
-            start = amplicon.start - tolerance
-            end = amplicon.end + tolerance
-            self.tree[start:end] = amplicon
-
         self.min_primer_length = min(primer_lengths)
         # the internal sequences table allows lookup by primer sequence
         for k, v in sequences.items():
             self.seqs[k[: self.min_primer_length]] = v
 
     def __eq__(self, other):
-        return type(other) is type(self) and self.__dict__ == other.__dict__
+        # the interval tree is derived from the amplicons, and may not be
+        # built yet
+        return type(other) is type(self) and self.__getstate__() == other.__getstate__()
 
     def __hash__(self):
         return hash(self.name)
@@ -182,6 +191,25 @@ class AmpliconSet:
         for amplicon in self.amplicons.values():
             yield amplicon
 
+    def __getstate__(self):
+        """Pickle without the interval tree, which is rebuilt when needed"""
+        state = self.__dict__.copy()
+        state["_tree"] = None
+        return state
+
+    @property
+    def tree(self) -> IntervalTree:
+        """Amplicon intervals, widened by the containment tolerance. Built on
+        first use, so that loading a scheme that is never matched is cheap
+        """
+        if self._tree is None:
+            self._tree = IntervalTree()
+            for amplicon in self.amplicons.values():
+                start = amplicon.start - self.tolerance
+                end = amplicon.end + self.tolerance
+                self._tree[start:end] = amplicon
+        return self._tree
+
     @classmethod
     def from_json(cls, fn: Path, tolerance=5):
         raise NotImplementedError
@@ -259,3 +287,193 @@ class AmpliconSet:
     def get_pos(self, pos: Index1) -> list[Amplicon]:
         """Get amplicons overlapping at a position"""
         return self.tree[pos - 1]
+
+
+class AmpliconMatcher:
+    """Match batches of fragments against several AmpliconSets at once
+
+    Gives the same answers as AmpliconSet.match, but for arrays of fragment
+    start and end positions. Each set's widened amplicon intervals are
+    sorted by start. In tiled schemes, where no amplicon lies inside
+    another, the ends are then sorted too. So the amplicons containing a
+    position, or starting after it, are a contiguous run found with
+    np.searchsorted. The tiled sets are laid end to end on one axis, so that
+    a single set of searchsorted calls answers every fragment against every
+    set. Any set with nested amplicons is instead compared against every
+    fragment directly.
+    """
+
+    def __init__(self, amplicon_sets: list[AmpliconSet]):
+        self.amplicon_sets: list[AmpliconSet] = list(amplicon_sets)
+        # amplicon ids are positions in each set's iteration order, as used
+        # by ReadStore.amplicon_ids
+        self.amplicons: list[list[Amplicon]] = [
+            list(amplicon_set) for amplicon_set in self.amplicon_sets
+        ]
+
+        self.tiled: list[int] = []
+        self.nested: list[int] = []
+        intervals = []
+        for i, (amplicon_set, amplicons) in enumerate(
+            zip(self.amplicon_sets, self.amplicons)
+        ):
+            # half-open, as in AmpliconSet.tree
+            starts = np.array(
+                [a.start - amplicon_set.tolerance for a in amplicons], dtype=np.int64
+            )
+            ends = np.array(
+                [a.end + amplicon_set.tolerance for a in amplicons], dtype=np.int64
+            )
+            order = np.lexsort((ends, starts))
+            intervals.append((starts[order], ends[order], order))
+            if np.all(np.diff(ends[order]) >= 0):
+                self.tiled.append(i)
+            else:
+                self.nested.append(i)
+        self._intervals = intervals
+
+        # positions outside [low, high] are clamped, which changes no
+        # comparison, so each tiled set gets its own stride of the axis
+        all_starts = [starts for starts, _, _ in intervals if len(starts)]
+        all_ends = [ends for _, ends, _ in intervals if len(ends)]
+        self._low = min((int(s.min()) for s in all_starts), default=0) - 1
+        self._high = max((int(e.max()) for e in all_ends), default=0) + 1
+        stride = self._high - self._low + 1
+        self._offsets = np.array(self.tiled, dtype=np.int64) * stride
+        self._starts = np.concatenate(
+            [intervals[i][0] + offset for i, offset in zip(self.tiled, self._offsets)]
+            or [np.empty(0, dtype=np.int64)]
+        )
+        self._ends = np.concatenate(
+            [intervals[i][1] + offset for i, offset in zip(self.tiled, self._offsets)]
+            or [np.empty(0, dtype=np.int64)]
+        )
+        self._ids = np.concatenate(
+            [intervals[i][2] for i in self.tiled] or [np.empty(0, dtype=np.int64)]
+        )
+
+    def match(self, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """Amplicon ids of fragments with the given reference start and end
+        positions, with a row for each AmpliconSet and a column for each
+        fragment. Fragments that do not match an amplicon are -1.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        result = np.full((len(self.amplicon_sets), len(starts)), -1, dtype=np.int64)
+
+        if self.tiled:
+            fs = np.clip(starts, self._low, self._high) + self._offsets[:, None]
+            fe = np.clip(ends, self._low, self._high) + self._offsets[:, None]
+            # amplicons starting at or before both ends of the fragment
+            first_after = np.minimum(
+                np.searchsorted(self._starts, fs, side="right"),
+                np.searchsorted(self._starts, fe, side="right"),
+            )
+            # amplicons ending after both ends of the fragment
+            first_containing = np.maximum(
+                np.searchsorted(self._ends, fs, side="right"),
+                np.searchsorted(self._ends, fe, side="right"),
+            )
+            # amplicons enveloped by the fragment
+            enveloped = np.searchsorted(self._ends, fe, side="right") > np.searchsorted(
+                self._starts, fs, side="left"
+            )
+            hit = (first_after - first_containing == 1) & ~enveloped
+            result[self.tiled] = np.where(
+                hit, self._ids[np.minimum(first_containing, len(self._ids) - 1)], -1
+            )
+
+        for i in self.nested:
+            amplicon_starts, amplicon_ends, order = self._intervals[i]
+            s = amplicon_starts[:, None]
+            e = amplicon_ends[:, None]
+            contains = (s <= starts) & (starts < e) & (s <= ends) & (ends < e)
+            enveloped = ((starts <= s) & (e <= ends)).any(axis=0)
+            hit = (contains.sum(axis=0) == 1) & ~enveloped
+            result[i] = np.where(hit, order[contains.argmax(axis=0)], -1)
+
+        return result
+
+    def match_fragments(
+        self, fragments: list[Fragment]
+    ) -> list[tuple[Fragment, list[Optional[Amplicon]]]]:
+        """Pair each fragment with its matching amplicon in each AmpliconSet,
+        or None where there is no match
+        """
+        ids = self.match(
+            np.fromiter((f.ref_start for f in fragments), np.int64, len(fragments)),
+            np.fromiter((f.ref_end for f in fragments), np.int64, len(fragments)),
+        )
+        return [
+            (
+                fragment,
+                [None if i < 0 else self.amplicons[k][i] for k, i in enumerate(row)],
+            )
+            for fragment, row in zip(fragments, ids.T.tolist())
+        ]
+
+
+class PrimerIndex:
+    """Merged lookup from primer prefixes to the AmpliconSets using them, for
+    detecting the scheme from raw reads before they are mapped
+
+    Each set's seqs table is keyed on primer prefixes of its own minimum
+    primer length. They are cut to the shortest of these, so that one
+    lookup covers every set. Reads of amplicons start with a primer, in its
+    given orientation for left and right primers alike, after up to window
+    bases of adapter or barcode.
+    """
+
+    def __init__(self, amplicon_sets: list[AmpliconSet], window: int = 60):
+        self.amplicon_sets: list[AmpliconSet] = list(amplicon_sets)
+        self.window: int = window
+        self.k: int = min(s.min_primer_length for s in self.amplicon_sets)
+        index: defaultdict[str, set[int]] = defaultdict(set)
+        for i, amplicon_set in enumerate(self.amplicon_sets):
+            for prefix in amplicon_set.seqs:
+                index[prefix[: self.k].upper()].add(i)
+        self.index: dict[str, tuple[int, ...]] = {
+            prefix: tuple(sorted(ids)) for prefix, ids in index.items()
+        }
+
+    def lookup(self, seq: str) -> set[int]:
+        """Indexes of the AmpliconSets with a primer at the start of a read.
+        Every offset in the window is tried, because primers of different
+        schemes can overlap on the genome
+        """
+        seq = seq[: self.window + self.k].upper()
+        hits: set[int] = set()
+        for i in range(len(seq) - self.k + 1):
+            hits.update(self.index.get(seq[i : i + self.k], ()))
+        return hits
+
+    def detect(
+        self, seqs: Iterable[str], min_hits: int = 50, min_ratio: float = 2.0
+    ) -> tuple[Optional[AmpliconSet], dict[str, Any]]:
+        """Count the reads starting with each set's primers. The set with the
+        most wins if it has at least min_hits reads, and min_ratio times as
+        many as any other set. Otherwise there is no winner, and the scheme
+        must be detected from mapped reads. Returns the winner and a summary
+        of the counts
+        """
+        counts = [0] * len(self.amplicon_sets)
+        reads = 0
+        for seq in seqs:
+            reads += 1
+            for i in self.lookup(seq):
+                counts[i] += 1
+
+        ranked = sorted(range(len(counts)), key=lambda i: counts[i], reverse=True)
+        winner = None
+        if ranked and counts[ranked[0]] >= min_hits:
+            runner_up = counts[ranked[1]] if len(ranked) > 1 else 0
+            if counts[ranked[0]] >= min_ratio * runner_up:
+                winner = self.amplicon_sets[ranked[0]]
+        summary = {
+            "reads_scanned": reads,
+            "reads_with_primer": {
+                s.name: count for s, count in zip(self.amplicon_sets, counts)
+            },
+            "chosen_scheme": None if winner is None else winner.name,
+        }
+        return winner, summary
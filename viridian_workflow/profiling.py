@@ -0,0 +1,115 @@
+"""Profiling of in-process pipeline stages, for the --profile option
+"""
+from __future__ import annotations
+
+import cProfile
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+import sys
+import threading
+import tracemalloc
+from typing import Iterator
+
+# cProfile cannot profile two stages at once, so nested stages are left to
+# the outermost one
+_profiling = threading.Lock()
+
+
+class StackSampler(threading.Thread):
+    """Samples the Python stacks of every other thread at a fixed interval,
+    counting them in the collapsed format read by flamegraph.pl and
+    speedscope. Time spent in C extensions (eg pysam, mappy) is counted
+    against the Python function that called them
+    """
+
+    def __init__(self, interval: float = 0.005):
+        super().__init__(daemon=True)
+        self.interval: float = interval
+        self.stacks: defaultdict[str, int] = defaultdict(int)
+        self._stop_sampling = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self._stop_sampling.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = Path(code.co_filename).name
+                    stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_sampling.set()
+        self.join()
+
+    def write_collapsed(self, outfile: Path):
+        with open(outfile, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                print(stack, count, file=f)
+
+
+def write_tracemalloc_report(
+    snapshot: tracemalloc.Snapshot, outfile: Path, top: int = 25
+):
+    """Write the lines that allocated the most memory still held at the end
+    of the stage, and the peak traced memory
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    with open(outfile, "w", encoding="utf-8") as f:
+        print(f"Traced memory at end of stage: {current / 2**20:.1f} MiB", file=f)
+        print(f"Peak traced memory: {peak / 2**20:.1f} MiB", file=f)
+        print(f"Top {top} allocations by line:", file=f)
+        for stat in snapshot.statistics("lineno")[:top]:
+            print(stat, file=f)
+
+
+@contextmanager
+def profile_stage(
+    name: str, outdir: Path, trace_memory: bool = False
+) -> Iterator[None]:
+    """Profile a stage, writing to outdir:
+
+        <name>.prof: cProfile stats, for pstats or snakeviz
+        <name>.collapsed: sampled stacks, for flamegraph.pl or speedscope
+        <name>.tracemalloc.txt: top allocations (only with trace_memory)
+
+    cProfile only sees the thread running the stage, but the sampled stacks
+    include worker threads too. tracemalloc slows allocation heavily, so it
+    is only used for stages where memory matters
+    """
+    if not _profiling.acquire(blocking=False):
+        yield
+        return
+
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    if trace_memory:
+        tracemalloc.start()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        try:
+            profiler.dump_stats(outdir / f"{name}.prof")
+            sampler.write_collapsed(outdir / f"{name}.collapsed")
+            if trace_memory:
+                write_tracemalloc_report(
+                    tracemalloc.take_snapshot(), outdir / f"{name}.tracemalloc.txt"
+                )
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+            _profiling.release()
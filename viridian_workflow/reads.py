@@ -6,7 +6,13 @@ is always assumed unless otherwise indicated
 """
 from __future__ import annotations
 
+from array import array
+from collections.abc import Sequence
 from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import numpy as np
+
 from viridian_workflow.utils import Index0
 
 
@@ -21,6 +27,9 @@ class Read:
     can use is_reverse to resolve the direction of the read.
     qry_end and ref_end one past the position, so slicing and subtracting
     coords follow the python string convention.
+
+    "cigar" is the original alignment to the reference as (length, op)
+    pairs (mappy order), if it was kept.
     """
 
     seq: str
@@ -29,6 +38,7 @@ class Read:
     qry_start: Index0
     qry_end: Index0
     is_reverse: bool
+    cigar: Optional[tuple[tuple[int, int], ...]] = None
 
 
 class Fragment:
@@ -83,3 +93,232 @@ class SingleRead(Fragment):
         self.ref_start: Index0 = Index0(read.ref_start)
         self.ref_end: Index0 = Index0(read.ref_end)
         self.strand: bool = not read.is_reverse
+
+
+class FragmentStore:
+    """Columnar storage for many fragments
+
+    Each read is a row in a set of parallel arrays, and the reads of a
+    fragment are stored next to each other. Sequences are packed into a
+    single byte buffer and sliced out by offset. Every fragment carries an
+    integer group id (the ReadStore uses amplicon ids) so that the fragments
+    of one group can be selected without scanning Python objects.
+
+    Fragment objects are only rebuilt when they are asked for.
+    """
+
+    def __init__(self):
+        self._ref_start: array = array("i")
+        self._ref_end: array = array("i")
+        self._qry_start: array = array("i")
+        self._qry_end: array = array("i")
+        self._is_reverse: array = array("b")
+        self._seq_offsets: array = array("q", [0])
+        self._seqs: bytearray = bytearray()
+        self._cigar_lengths: array = array("I")
+        self._cigar_ops: array = array("B")
+        self._cigar_offsets: array = array("q", [0])
+
+        # per fragment: group id and offset of the first read
+        self._group: array = array("i")
+        self._read_offsets: array = array("q", [0])
+
+        self._columns: Optional[dict[str, np.ndarray]] = None
+        self._groups: Optional[dict[int, np.ndarray]] = None
+        self._index: Optional[tuple[np.ndarray, np.ndarray, np.ndarray, int]] = None
+
+    def __len__(self) -> int:
+        """Number of fragments in the store"""
+        return len(self._group)
+
+    def append(self, fragment: Fragment, group: int):
+        """Pack a fragment into the store"""
+        for read in fragment.reads:
+            self._ref_start.append(read.ref_start)
+            self._ref_end.append(read.ref_end)
+            self._qry_start.append(read.qry_start)
+            self._qry_end.append(read.qry_end)
+            self._is_reverse.append(read.is_reverse)
+            self._seqs += read.seq.encode("ascii")
+            self._seq_offsets.append(len(self._seqs))
+            if read.cigar is not None:
+                for length, op in read.cigar:
+                    self._cigar_lengths.append(length)
+                    self._cigar_ops.append(op)
+            self._cigar_offsets.append(len(self._cigar_ops))
+        self._group.append(group)
+        self._read_offsets.append(len(self._ref_start))
+        self._columns = None
+        self._groups = None
+        self._index = None
+
+    def copy_from(self, other: FragmentStore, i: int, group: int):
+        """Append fragment i of another store, without rebuilding it"""
+        for j in range(other._read_offsets[i], other._read_offsets[i + 1]):
+            self._ref_start.append(other._ref_start[j])
+            self._ref_end.append(other._ref_end[j])
+            self._qry_start.append(other._qry_start[j])
+            self._qry_end.append(other._qry_end[j])
+            self._is_reverse.append(other._is_reverse[j])
+            seq_start, seq_end = other._seq_offsets[j], other._seq_offsets[j + 1]
+            self._seqs += other._seqs[seq_start:seq_end]
+            self._seq_offsets.append(len(self._seqs))
+            first, last = other._cigar_offsets[j], other._cigar_offsets[j + 1]
+            self._cigar_lengths.extend(other._cigar_lengths[first:last])
+            self._cigar_ops.extend(other._cigar_ops[first:last])
+            self._cigar_offsets.append(len(self._cigar_ops))
+        self._group.append(group)
+        self._read_offsets.append(len(self._ref_start))
+        self._columns = None
+        self._groups = None
+        self._index = None
+
+    def span(self, i: int) -> tuple[Index0, Index0]:
+        """Reference start and end of fragment i, as in its Fragment"""
+        first, last = self._read_offsets[i], self._read_offsets[i + 1]
+        if last - first == 1 or self._ref_start[first] < self._ref_start[first + 1]:
+            return Index0(self._ref_start[first]), Index0(self._ref_end[last - 1])
+        return Index0(self._ref_start[first + 1]), Index0(self._ref_end[first])
+
+    def mapped_bases(self, i: int) -> int:
+        """Fragment.total_mapped_bases of fragment i"""
+        return sum(
+            self._qry_end[j] - self._qry_start[j]
+            for j in range(self._read_offsets[i], self._read_offsets[i + 1])
+        )
+
+    @property
+    def columns(self) -> dict[str, np.ndarray]:
+        """NumPy views of the per-read and per-fragment arrays"""
+        if self._columns is None:
+            self._columns = {
+                "ref_start": np.array(self._ref_start, dtype=np.int32),
+                "ref_end": np.array(self._ref_end, dtype=np.int32),
+                "qry_start": np.array(self._qry_start, dtype=np.int32),
+                "qry_end": np.array(self._qry_end, dtype=np.int32),
+                "is_reverse": np.array(self._is_reverse, dtype=bool),
+                "seq_offsets": np.array(self._seq_offsets, dtype=np.int64),
+                "group": np.array(self._group, dtype=np.int32),
+                "read_offsets": np.array(self._read_offsets, dtype=np.int64),
+            }
+        return self._columns
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the packed columns"""
+        return len(self._seqs) + sum(
+            a.itemsize * len(a)
+            for a in [
+                self._ref_start,
+                self._ref_end,
+                self._qry_start,
+                self._qry_end,
+                self._is_reverse,
+                self._seq_offsets,
+                self._cigar_lengths,
+                self._cigar_ops,
+                self._cigar_offsets,
+                self._group,
+                self._read_offsets,
+            ]
+        )
+
+    def select(self, group: int) -> np.ndarray:
+        """Indices of the fragments in a group, in insertion order"""
+        if self._groups is None:
+            groups = self.columns["group"]
+            order = np.argsort(groups, kind="stable")
+            ids, starts = np.unique(groups[order], return_index=True)
+            self._groups = {
+                int(i): indices for i, indices in zip(ids, np.split(order, starts[1:]))
+            }
+        return self._groups.get(group, np.empty(0, dtype=np.int64))
+
+    def overlapping(self, start: Index0, end: Index0) -> np.ndarray:
+        """Indices of the fragments with a read overlapping the half-open
+        interval [start, end), in insertion order
+
+        Reads are indexed by sorted start position. As no read is longer than
+        the longest read in the store, only reads starting in
+        [start - longest read, end) need their end position checked. A pair
+        whose insert spans the interval without either mate touching it is
+        not returned.
+        """
+        if self._index is None:
+            columns = self.columns
+            starts, ends = columns["ref_start"], columns["ref_end"]
+            order = np.argsort(starts, kind="stable")
+            fragments = np.repeat(
+                np.arange(len(self), dtype=np.int64),
+                np.diff(columns["read_offsets"]),
+            )
+            longest = int((ends - starts).max()) if len(starts) else 0
+            self._index = (starts[order], ends[order], fragments[order], longest)
+        starts, ends, fragments, longest = self._index
+
+        first = np.searchsorted(starts, start - longest, side="left")
+        last = np.searchsorted(starts, end, side="left")
+        hits = np.flatnonzero(ends[first:last] > start) + first
+        return np.unique(fragments[hits])
+
+    def read(self, i: int) -> Read:
+        """Rebuild the read stored at row i"""
+        first, last = self._cigar_offsets[i], self._cigar_offsets[i + 1]
+        cigar = (
+            tuple(zip(self._cigar_lengths[first:last], self._cigar_ops[first:last]))
+            if last > first
+            else None
+        )
+        return Read(
+            self._seqs[self._seq_offsets[i] : self._seq_offsets[i + 1]].decode(
+                "ascii"
+            ),
+            Index0(self._ref_start[i]),
+            Index0(self._ref_end[i]),
+            Index0(self._qry_start[i]),
+            Index0(self._qry_end[i]),
+            bool(self._is_reverse[i]),
+            cigar,
+        )
+
+    def fragment(self, i: int) -> Fragment:
+        """Rebuild the fragment stored at index i"""
+        first, last = self._read_offsets[i], self._read_offsets[i + 1]
+        reads = [self.read(j) for j in range(first, last)]
+        if len(reads) == 2:
+            return PairedReads(*reads)
+        return SingleRead(*reads)
+
+    def strands(self, indices: np.ndarray) -> np.ndarray:
+        """Fragment strands (True is forward), taken from the first read"""
+        columns = self.columns
+        return ~columns["is_reverse"][columns["read_offsets"][indices]]
+
+    def total_mapped_bases(self, indices: np.ndarray) -> np.ndarray:
+        """Vectorised Fragment.total_mapped_bases over several fragments"""
+        columns = self.columns
+        lengths = np.concatenate(
+            [[0], np.cumsum(columns["qry_end"] - columns["qry_start"])]
+        )
+        offsets = columns["read_offsets"]
+        return lengths[offsets[indices + 1]] - lengths[offsets[indices]]
+
+
+class StoredFragments(Sequence):
+    """Read-only list of fragments backed by a FragmentStore"""
+
+    def __init__(self, store: FragmentStore, indices: np.ndarray):
+        self.store: FragmentStore = store
+        self.indices: np.ndarray = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return StoredFragments(self.store, self.indices[i])
+        return self.store.fragment(int(self.indices[i]))
+
+    def __iter__(self) -> Iterator[Fragment]:
+        for i in self.indices:
+            yield self.store.fragment(int(i))
@@ -2,18 +2,38 @@
 """
 from __future__ import annotations
 
-from typing import Optional, Any
-from collections import defaultdict
+from typing import Iterator, Optional, Any
+from collections import defaultdict, OrderedDict
+from collections.abc import Sequence
+import functools
+import heapq
+from itertools import islice, zip_longest
+from math import sqrt
+from statistics import NormalDist
 import sys
+import threading
 from pathlib import Path
 import os
 import random
 
+import mappy as mp  # type: ignore
+import numpy as np
 import pysam  # type: ignore
 
-from viridian_workflow.utils import Index0, revcomp
-from viridian_workflow.primers import Amplicon, AmpliconSet, Primer
-from viridian_workflow.reads import Read, Fragment, PairedReads, SingleRead
+from viridian_workflow.utils import Index0, map_batches, revcomp
+from viridian_workflow.primers import Amplicon, AmpliconMatcher, AmpliconSet, Primer
+from viridian_workflow.subtasks.minimap import cached_index
+from viridian_workflow.reads import (
+    Read,
+    Fragment,
+    FragmentStore,
+    PairedReads,
+    SingleRead,
+    StoredFragments,
+)
+
+# fragments matched against the amplicon sets in one call to AmpliconMatcher
+MATCH_BATCH_SIZE = 4096
 
 
 def score(
@@ -48,6 +68,243 @@ def score(
     return winner
 
 
+def wilson_interval(successes: int, trials: int, z: float) -> tuple[float, float]:
+    """Wilson score interval for a binomial proportion"""
+    if trials == 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z**2 / trials
+    centre = (p + z**2 / (2 * trials)) / denominator
+    half_width = z * sqrt(p * (1 - p) / trials + z**2 / (4 * trials**2)) / denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+
+class SchemeDetector:
+    """Match counts for candidate amplicon schemes, with a sequential test
+    to decide on a scheme before all fragments have been seen
+
+    After min_fragments, each check drops schemes whose mismatch proportion
+    is above the disqualification threshold with the given confidence. The
+    leading scheme wins once its match proportion is confidently below the
+    threshold, and above every other remaining scheme's. Each proportion is
+    bounded with a Wilson score interval.
+    """
+
+    def __init__(
+        self,
+        amplicon_sets: list[AmpliconSet],
+        disqualification_threshold: float = 0.5,
+        confidence: float = 0.999,
+        min_fragments: int = 1000,
+    ):
+        self.candidates: list[AmpliconSet] = list(amplicon_sets)
+        self.amplicon_sets: list[AmpliconSet] = list(amplicon_sets)
+        self.disqualification_threshold: float = disqualification_threshold
+        self.confidence: float = confidence
+        self.z: float = NormalDist().inv_cdf(confidence)
+        self.min_fragments: int = min_fragments
+        self.fragments: int = 0
+        self.matches: defaultdict[AmpliconSet, int] = defaultdict(int)
+        self.mismatches: defaultdict[AmpliconSet, int] = defaultdict(int)
+        self.disqualified_after: dict[AmpliconSet, int] = {}
+        self.winner: Optional[AmpliconSet] = None
+        self.decided_after: Optional[int] = None
+
+    def push(self, hits: dict[AmpliconSet, Optional[Amplicon]]):
+        """Count a fragment's matches against the remaining candidates"""
+        self.fragments += 1
+        for amplicon_set in self.candidates:
+            if hits[amplicon_set]:
+                self.matches[amplicon_set] += 1
+            else:
+                self.mismatches[amplicon_set] += 1
+
+    def total(self, amplicon_set: AmpliconSet) -> int:
+        return self.matches[amplicon_set] + self.mismatches[amplicon_set]
+
+    def check(self):
+        """Drop disqualified schemes, and pick a winner if there is one"""
+        if self.winner is not None or self.fragments < self.min_fragments:
+            return
+
+        for amplicon_set in list(self.candidates):
+            low, _ = wilson_interval(
+                self.mismatches[amplicon_set], self.total(amplicon_set), self.z
+            )
+            if low > self.disqualification_threshold:
+                self.candidates.remove(amplicon_set)
+                self.disqualified_after[amplicon_set] = self.fragments
+
+        if not self.candidates:
+            return
+        ranked = sorted(self.candidates, key=lambda s: self.matches[s], reverse=True)
+        leader = ranked[0]
+        leader_low, _ = wilson_interval(
+            self.matches[leader], self.total(leader), self.z
+        )
+        if 1 - leader_low > self.disqualification_threshold:
+            return
+        for amplicon_set in ranked[1:]:
+            _, high = wilson_interval(
+                self.matches[amplicon_set], self.total(amplicon_set), self.z
+            )
+            if high >= leader_low:
+                return
+        self.winner = leader
+        self.decided_after = self.fragments
+        self.candidates = [leader]
+
+    def summary(self) -> dict[str, Any]:
+        """Fragments consumed and per-scheme match proportion bounds, for
+        the bam stats
+        """
+        schemes = {}
+        for amplicon_set in self.amplicon_sets:
+            low, high = wilson_interval(
+                self.matches[amplicon_set], self.total(amplicon_set), self.z
+            )
+            schemes[amplicon_set.name] = {
+                "matches": self.matches[amplicon_set],
+                "mismatches": self.mismatches[amplicon_set],
+                "match_proportion_low": low,
+                "match_proportion_high": high,
+                "disqualified_after": self.disqualified_after.get(amplicon_set),
+            }
+        return {
+            "fragments_consumed": self.fragments,
+            "confidence": self.confidence,
+            "winner": None if self.winner is None else self.winner.name,
+            "decided_after": self.decided_after,
+            "schemes": schemes,
+        }
+
+
+class FragmentSample:
+    """Per-amplicon fragment counts and a downsampled set of fragments for
+    one AmpliconSet, accumulated in a single pass over the reads
+
+    Fragments are downsampled to at most target_depth per amplicon with
+    reservoir sampling, so every matching fragment has the same
+    target_depth / total chance of being kept without needing to know the
+    total in advance.
+
+    Sampled fragments are packed into a FragmentStore as they arrive, and
+    each amplicon's reservoir is a list of slots indexing into it, so no
+    Fragment objects are held. A fragment that replaces another is appended
+    and takes over its slot. Replaced rows are dropped by compacting the
+    store once they outnumber the sampled ones.
+    """
+
+    def __init__(self, amplicon_set: AmpliconSet, target_depth: int = 1000, seed: int = 42):
+        self.amplicon_set: AmpliconSet = amplicon_set
+        self.target_depth: int = target_depth
+        self.reads_per_amplicon: defaultdict[Amplicon, int] = defaultdict(int)
+        self.mapped_bases: defaultdict[Amplicon, int] = defaultdict(int)
+        self.store: FragmentStore = FragmentStore()
+        self.slots: defaultdict[Amplicon, list[int]] = defaultdict(list)
+        self.sampled: int = 0
+        self.unmatched_reads: int = 0
+        self.random: random.Random = random.Random(seed)
+
+    @property
+    def fragments(self) -> dict[Amplicon, Sequence[Fragment]]:
+        """The sampled fragments of each amplicon"""
+        return {
+            amplicon: StoredFragments(self.store, np.array(slots, dtype=np.int64))
+            for amplicon, slots in self.slots.items()
+        }
+
+    def push(self, fragment: Fragment, amplicon: Optional[Amplicon]):
+        """Count a fragment against its matched amplicon and offer it to that
+        amplicon's reservoir
+        """
+        if amplicon is None:
+            self.unmatched_reads += 1
+            return
+
+        self.reads_per_amplicon[amplicon] += 1
+        self.mapped_bases[amplicon] += fragment.total_mapped_bases()
+
+        reservoir = self.slots[amplicon]
+        if len(reservoir) < self.target_depth:
+            reservoir.append(len(self.store))
+            self.store.append(fragment, 0)
+            self.sampled += 1
+            return
+
+        i = self.random.randrange(self.reads_per_amplicon[amplicon])
+        if i < self.target_depth:
+            reservoir[i] = len(self.store)
+            self.store.append(fragment, 0)
+            if len(self.store) >= 2 * self.sampled + self.target_depth:
+                self.compact()
+
+    def compact(self):
+        """Drop the replaced fragments from the store"""
+        store = FragmentStore()
+        for reservoir in self.slots.values():
+            for k, i in enumerate(reservoir):
+                reservoir[k] = len(store)
+                store.copy_from(self.store, i, 0)
+        self.store = store
+
+    def clear(self):
+        """Release the sampled fragments, keeping the counts"""
+        self.slots = defaultdict(list)
+        self.store = FragmentStore()
+        self.sampled = 0
+
+
+class MateBuffer:
+    """Reads waiting for their mate
+
+    For coordinate sorted input a read is dropped as soon as the input has
+    moved past its mate's position, since the mate can no longer arrive.
+    Reads are only dropped by position, so the buffer holds every read
+    whose mate is still ahead, however deep the coverage.
+
+    Otherwise the buffer is bounded: the oldest reads are evicted once
+    max_size reads are waiting. Their mates may still arrive, so evictions
+    are counted separately as lost pairs. Name sorted input never holds
+    more than one read.
+    """
+
+    def __init__(self, coordinate_sorted: bool = False, max_size: int = 100_000):
+        self.coordinate_sorted: bool = coordinate_sorted
+        self.max_size: int = max_size
+        self.reads: OrderedDict[str, Read] = OrderedDict()
+        self.mate_positions: list[tuple[int, int, str]] = []
+        self.dropped: int = 0
+        self.evicted: int = 0
+
+    def __len__(self):
+        return len(self.reads)
+
+    def pop(self, name: str) -> Optional[Read]:
+        """Take the waiting mate of a read, if there is one"""
+        return self.reads.pop(name, None)
+
+    def push(self, name: str, read: Read, mate_position: tuple[int, int]):
+        """Hold a read until its mate, at (reference id, start), arrives"""
+        self.reads[name] = read
+        if self.coordinate_sorted:
+            heapq.heappush(self.mate_positions, (*mate_position, name))
+            return
+        while len(self.reads) > self.max_size:
+            self.reads.popitem(last=False)
+            self.dropped += 1
+            self.evicted += 1
+
+    def advance(self, position: tuple[int, int]):
+        """Drop reads whose mate is before the current input position"""
+        if not self.coordinate_sorted:
+            return
+        while self.mate_positions and self.mate_positions[0][:2] < position:
+            _, _, name = heapq.heappop(self.mate_positions)
+            if self.reads.pop(name, None) is not None:
+                self.dropped += 1
+
+
 def amplicon_set_counts_to_naive_total_counts(scheme_counts):
     """Amplicon count summary"""
     counts = defaultdict(int)
@@ -71,20 +328,41 @@ class Bam:
 
     def __init__(
         self,
-        bam: Path,
+        bam: Optional[Path] = None,
         infile_is_paired: Optional[bool] = None,
         template_length_threshold: int = 150,
+        max_buffered_mates: int = 100_000,
+        stream: Optional[pysam.AlignmentFile] = None,
+        threads: int = 1,
     ):
+        """Reads come from a bam file, or from a stream of alignments as they
+        are produced (eg by minimap2). A stream can only be read once, so
+        should be consumed with Bam.ingest.
+
+        threads is the number of threads pysam uses to decompress the bam.
+        """
         self.infile_is_paired: Optional[bool] = infile_is_paired
-        if not Path(bam).is_file():
-            raise Exception(f"bam file {bam} does not exist")
-        self.bam: Path = bam
+        self.bam: Optional[Path] = bam
+        self.stream: Optional[pysam.AlignmentFile] = stream
+        self.check_input()
+        self.stream_consumed: bool = False
+        self.threads: int = threads
         self.template_length_threshold: int = template_length_threshold
+        self.max_buffered_mates: int = max_buffered_mates
         self.stats: dict[str, Any] = {}
 
+    def check_input(self):
+        """Raise if there are no reads to open"""
+        if self.stream is None and (self.bam is None or not Path(self.bam).is_file()):
+            raise Exception(f"bam file {self.bam} does not exist")
+
     @staticmethod
     def read_from_pysam(read):
-        """Pack pysam reads into a virdian Read object"""
+        """Pack pysam reads into a virdian Read object
+
+        The cigar is kept in mappy's (length, op) order, with sequence
+        match/mismatch ops (=/X) folded into M.
+        """
         return Read(
             read.query_sequence,
             read.reference_start,
@@ -92,8 +370,21 @@ class Bam:
             read.query_alignment_start,
             read.query_alignment_end,
             read.is_reverse,
+            tuple(
+                (length, 0 if op in (7, 8) else op)
+                for op, length in read.cigartuples
+            ),
         )
 
+    def open(self) -> pysam.AlignmentFile:
+        """Open the alignments for a pass over the reads"""
+        if self.stream is None:
+            return pysam.AlignmentFile(self.bam, "rb", threads=self.threads)
+        if self.stream_consumed:
+            raise Exception("Alignment stream has already been read")
+        self.stream_consumed = True
+        return self.stream
+
     @classmethod
     def from_pe_fastqs(cls, fq1, fq2):
         """Bam from paired end fastq files"""
@@ -104,17 +395,10 @@ class Bam:
         """Bam object from single ended fastq"""
         pass
 
-    def syncronise_fragments(self):
-        """Yield a fragment object constructed from either a single
-        read or a pair of mated reads
-
-        Mapping based quality thresholds (template length etc.) can
-        be applied here
-        """
-        reads_by_name = {}
-        improper_pairs = 0
-
-        self.stats = {
+    @staticmethod
+    def new_stats() -> dict[str, Any]:
+        """Empty read stats, filled in while fragments are synchronised"""
+        return {
             "unpaired_reads": 0,
             "reads1": 0,
             "reads2": 0,
@@ -124,9 +408,40 @@ class Bam:
             "template_lengths": defaultdict(int),
             "templates_that_were_too_short": defaultdict(int),
             "match_no_amplicon_sets": 0,
+            "reads_without_mate": 0,
+            "mates_evicted": 0,
         }
 
-        reads = pysam.AlignmentFile(self.bam, "rb")
+    def keep_template(self, fragment: Fragment) -> bool:
+        """Record a fragment's template length, and test it against the
+        template length threshold
+        """
+        tlen = fragment.ref_end - fragment.ref_start
+        self.stats["template_lengths"][tlen] += 1
+        if tlen < self.template_length_threshold:
+            self.stats["templates_that_were_too_short"][tlen] += 1
+            return False
+        return True
+
+    def syncronise_fragments(self):
+        """Yield a fragment object constructed from either a single
+        read or a pair of mated reads
+
+        Mapping based quality thresholds (template length etc.) can
+        be applied here
+
+        The reads can be in any order. Mates are paired up through a bounded
+        MateBuffer, which stays small for name or coordinate sorted input.
+        """
+        improper_pairs = 0
+        self.stats = Bam.new_stats()
+
+        reads = self.open()
+        sort_order = reads.header.to_dict().get("HD", {}).get("SO")
+        mates = MateBuffer(
+            coordinate_sorted=sort_order == "coordinate",
+            max_size=self.max_buffered_mates,
+        )
 
         for read in reads:
             if self.infile_is_paired is None:
@@ -153,64 +468,189 @@ class Bam:
             if not read.is_paired:
                 self.stats["unpaired_reads"] += 1
                 single_read: Fragment = SingleRead(Bam.read_from_pysam(read))
-                tlen = single_read.ref_end - single_read.ref_start
-                self.stats["template_lengths"][tlen] += 1
-                if tlen < self.template_length_threshold:
-                    self.stats["templates_that_were_too_short"][tlen] += 1
-                    continue
-                yield single_read
+                if self.keep_template(single_read):
+                    yield single_read
 
             if not read.is_proper_pair:
                 improper_pairs += 1
                 continue
 
-            if read.is_read1:
-                reads_by_name[read.query_name] = Bam.read_from_pysam(read)
+            mates.advance((read.reference_id, read.reference_start))
+            mate = mates.pop(read.query_name)
+            if mate is None:
+                mates.push(
+                    read.query_name,
+                    Bam.read_from_pysam(read),
+                    (read.next_reference_id, read.next_reference_start),
+                )
+                continue
 
-            elif read.is_read2:
-                if read.query_name not in reads_by_name:
-                    raise Exception("Bam file is not sorted by name")
-                read1 = reads_by_name[read.query_name]
-                paired_reads: Fragment = PairedReads(read1, Bam.read_from_pysam(read))
-                tlen = paired_reads.ref_end - paired_reads.ref_start
-                self.stats["template_lengths"][tlen] += 1
-                if tlen < self.template_length_threshold:
-                    self.stats["templates_that_were_too_short"][tlen] += 1
-                    continue
+            if read.is_read1:
+                paired_reads: Fragment = PairedReads(Bam.read_from_pysam(read), mate)
+            else:
+                paired_reads = PairedReads(mate, Bam.read_from_pysam(read))
+            if self.keep_template(paired_reads):
                 yield paired_reads
-                del reads_by_name[read.query_name]
+        self.stats["reads_without_mate"] = mates.dropped + len(mates)
+        self.stats["mates_evicted"] = mates.evicted
         print(f"{improper_pairs} improper pairs", file=sys.stderr)
+        print(f"{mates.dropped + len(mates)} reads without a mate", file=sys.stderr)
+        if mates.evicted:
+            print(
+                f"{mates.evicted} reads evicted from the mate buffer before their mate arrived",
+                file=sys.stderr,
+            )
+
+    def match_fragments(
+        self,
+        detector: SchemeDetector,
+        sequential: bool = False,
+        stop_when_decided: bool = True,
+        keep: Optional[list[AmpliconSet]] = None,
+    ) -> Iterator[tuple[Fragment, dict[AmpliconSet, Optional[Amplicon]]]]:
+        """Match fragments against the detector's candidate schemes in
+        batches, counting them in the detector as they go
+
+        In sequential mode the detector is checked after each batch, and
+        dropped schemes are no longer matched. Reading stops once a scheme is
+        chosen or all are dropped, unless stop_when_decided is False. Schemes
+        in keep are always matched.
+        """
+        keep = [] if keep is None else keep
+        fragments = self.syncronise_fragments()
+        batch_size = MATCH_BATCH_SIZE
+        if sequential:
+            batch_size = min(batch_size, detector.min_fragments)
+        amplicon_sets: list[AmpliconSet] = []
+        matcher = None
+        while True:
+            if sequential and stop_when_decided:
+                if detector.winner is not None or not detector.candidates:
+                    return
+            wanted = detector.candidates + [
+                s for s in keep if s not in detector.candidates
+            ]
+            if not wanted:
+                return
+            if matcher is None or wanted != amplicon_sets:
+                amplicon_sets = wanted
+                matcher = AmpliconMatcher(amplicon_sets)
+            batch = list(islice(fragments, batch_size))
+            if not batch:
+                return
+            for fragment, hits in matcher.match_fragments(batch):
+                matched = dict(zip(amplicon_sets, hits))
+                detector.push(matched)
+                yield fragment, matched
+            if sequential:
+                detector.check()
 
     def detect_amplicon_set(
-        self, amplicon_sets: list[AmpliconSet], disqualification_threshold: float = 0.5
+        self,
+        amplicon_sets: list[AmpliconSet],
+        disqualification_threshold: float = 0.5,
+        sequential: bool = False,
+        confidence: float = 0.999,
+        min_fragments: int = 1000,
     ) -> AmpliconSet:
-        """return inferred amplicon set from list of amplicon sets"""
-
-        mismatches: defaultdict[AmpliconSet, int] = defaultdict(int)
-        matches: defaultdict[AmpliconSet, int] = defaultdict(int)
-
-        for fragment in self.syncronise_fragments():
-            match_any = False
-            for amplicon_set in amplicon_sets:
-                hit = amplicon_set.match(fragment)
-                if hit:
-                    match_any = True
-                    matches[amplicon_set] += 1
-                else:
-                    mismatches[amplicon_set] += 1
-            if not match_any:
+        """return inferred amplicon set from list of amplicon sets
+
+        In sequential mode, reading stops as soon as a scheme wins with the
+        given confidence (see SchemeDetector).
+        """
+        detector = SchemeDetector(
+            amplicon_sets,
+            disqualification_threshold=disqualification_threshold,
+            confidence=confidence,
+            min_fragments=min_fragments,
+        )
+        for _, hits in self.match_fragments(detector, sequential=sequential):
+            if not any(hits.values()):
+                self.stats["match_no_amplicon_sets"] += 1
+
+        return self.choose_amplicon_set(
+            detector, disqualification_threshold=disqualification_threshold
+        )
+
+    def ingest(
+        self,
+        amplicon_sets: list[AmpliconSet],
+        target_depth: int = 1000,
+        disqualification_threshold: float = 0.5,
+        sequential: bool = False,
+        confidence: float = 0.999,
+        min_fragments: int = 1000,
+        keep: Optional[list[AmpliconSet]] = None,
+    ) -> tuple[AmpliconSet, dict[AmpliconSet, FragmentSample]]:
+        """Detect the amplicon set and downsample fragments in a single
+        traversal of the bam
+
+        Every candidate amplicon set is scored and sampled at the same time,
+        so the winner's FragmentSample can be used to build a ReadStore
+        without reading the bam again. Returns the chosen amplicon set and
+        the samples for all candidates and schemes in keep.
+
+        Schemes in keep are matched and sampled throughout, but take no part
+        in detection.
+
+        In sequential mode, schemes are dropped as soon as they are
+        disqualified or another scheme wins (see SchemeDetector), and their
+        samples are left incomplete. The remaining fragments are only matched
+        against the winner, and any schemes in keep.
+        """
+        detector = SchemeDetector(
+            amplicon_sets,
+            disqualification_threshold=disqualification_threshold,
+            confidence=confidence,
+            min_fragments=min_fragments,
+        )
+        keep = [] if keep is None else keep
+        samples: dict[AmpliconSet, FragmentSample] = {
+            amplicon_set: FragmentSample(amplicon_set, target_depth=target_depth)
+            for amplicon_set in amplicon_sets + keep
+        }
+
+        for fragment, hits in self.match_fragments(
+            detector, sequential=sequential, stop_when_decided=False, keep=keep
+        ):
+            for amplicon_set, hit in hits.items():
+                samples[amplicon_set].push(fragment, hit)
+            if not any(hits.values()):
                 self.stats["match_no_amplicon_sets"] += 1
 
+        chosen_scheme = self.choose_amplicon_set(
+            detector, disqualification_threshold=disqualification_threshold
+        )
+        return chosen_scheme, samples
+
+    def choose_amplicon_set(
+        self,
+        detector: SchemeDetector,
+        disqualification_threshold: float = 0.5,
+    ) -> AmpliconSet:
+        """Record match stats and pick the winning amplicon set from the
+        schemes the detector has not dropped
+        """
         #        self.stats["match_any_amplicon"] = match_any_amplicon
         self.stats["amplicon_scheme_set_matches"] = {}
-        for match in matches:
-            self.stats["amplicon_scheme_set_matches"][match.name] = matches[match]
+        for match in detector.amplicon_sets:
+            if detector.matches[match]:
+                self.stats["amplicon_scheme_set_matches"][match.name] = (
+                    detector.matches[match]
+                )
 
             # self.stats[
             #    "amplicon_scheme_simple_counts"
             # ] = amplicon_set_counts_to_naive_total_counts(
             #    self.stats["amplicon_scheme_set_matches"]
             # )
+        self.stats["scheme_detection"] = detector.summary()
+        matches = defaultdict(
+            int, {s: detector.matches[s] for s in detector.candidates}
+        )
+        mismatches = defaultdict(
+            int, {s: detector.mismatches[s] for s in detector.candidates}
+        )
         chosen_scheme = score(
             matches, mismatches, disqualification_threshold=disqualification_threshold
         )
@@ -225,6 +665,161 @@ class Bam:
         return chosen_scheme
 
 
+@functools.lru_cache(maxsize=8)
+def _load_aligner(ref: str, preset: str, mtime_ns: int) -> mp.Aligner:
+    aligner = mp.Aligner(ref, preset=preset)
+    if not aligner:
+        raise Exception(f"failed to load or build index for {ref}")
+    return aligner
+
+
+def load_aligner(ref: Path, preset: str) -> mp.Aligner:
+    """A mappy aligner for the reference (FASTA or .mmi index), reused while
+    the file is unchanged, so a long-running process only indexes it once
+    """
+    return _load_aligner(str(ref), preset, os.stat(ref).st_mtime_ns)
+
+
+class MappedFastqs(Bam):
+    """Reads mapped to the reference in-process with mappy, in place of a
+    bam of minimap2's output
+
+    Fragments are built directly from mappy's alignments, without starting
+    minimap2 or writing and parsing SAM. Batches of reads (or read pairs)
+    are mapped on a thread pool, as mappy releases the GIL while aligning.
+    """
+
+    def __init__(
+        self,
+        ref: Path,
+        fq1: Path,
+        fq2: Optional[Path] = None,
+        preset: Optional[str] = None,
+        threads: int = 1,
+        template_length_threshold: int = 150,
+        batch_size: int = 256,
+        index_cache: Optional[Path] = None,
+    ):
+        self.fq1: Path = fq1
+        self.fq2: Optional[Path] = fq2
+        super().__init__(
+            infile_is_paired=fq2 is not None,
+            template_length_threshold=template_length_threshold,
+            threads=threads,
+        )
+        if preset is None:
+            preset = "map-ont" if fq2 is None else "sr"
+        if index_cache is not None:
+            ref = cached_index(ref, preset, index_cache)
+        self.aligner: mp.Aligner = load_aligner(ref, preset)
+        self.batch_size: int = batch_size
+
+    def check_input(self):
+        """Raise if a reads file does not exist"""
+        for fq in [self.fq1, self.fq2]:
+            if fq is not None and not Path(fq).is_file():
+                raise Exception(f"reads file {fq} does not exist")
+
+    def read_pairs(self) -> Iterator[tuple[str, str]]:
+        """Sequences of the read pairs, raising if one file runs out of
+        reads before the other
+        """
+        assert self.fq2 is not None
+        for read1, read2 in zip_longest(
+            mp.fastx_read(str(self.fq1)), mp.fastx_read(str(self.fq2))
+        ):
+            if read1 is None or read2 is None:
+                raise Exception(
+                    f"Reads files {self.fq1} and {self.fq2} have different numbers of reads"
+                )
+            yield read1[1], read2[1]
+
+    @staticmethod
+    def read_from_mappy(seq: str, hit: mp.Alignment) -> Read:
+        """Pack a mappy alignment into a viridian Read object
+
+        Like pysam, the sequence and query coordinates are given on the
+        reference strand.
+        """
+        qry_start, qry_end = hit.q_st, hit.q_en
+        if hit.strand < 0:
+            seq = revcomp(seq)
+            qry_start, qry_end = len(seq) - hit.q_en, len(seq) - hit.q_st
+        return Read(
+            seq,
+            hit.r_st,
+            hit.r_en,
+            qry_start,
+            qry_end,
+            hit.strand < 0,
+            tuple((length, op) for length, op in hit.cigar),
+        )
+
+    def syncronise_fragments(self):
+        """Map the reads, yielding a fragment for each read or proper pair"""
+        improper_pairs = 0
+        self.stats = Bam.new_stats()
+
+        reads: Iterator[tuple[str, Optional[str]]]
+        if self.fq2 is None:
+            reads = ((seq, None) for _, seq, _ in mp.fastx_read(str(self.fq1)))
+        else:
+            reads = self.read_pairs()
+
+        local = threading.local()
+
+        def map_batch(batch):
+            if not hasattr(local, "buf"):
+                local.buf = mp.ThreadBuffer()
+            return [
+                (seq1, seq2, list(self.aligner.map(seq1, seq2=seq2, buf=local.buf)))
+                for seq1, seq2 in batch
+            ]
+
+        for seq1, seq2, hits in map_batches(
+            map_batch, reads, threads=self.threads, batch_size=self.batch_size
+        ):
+            # mappy also marks supplementary alignments of chimeric reads as
+            # primary, but they come after the primary alignment, which is
+            # the one the minimap2 path uses
+            primary: dict[int, mp.Alignment] = {}
+            for hit in hits:
+                if hit.is_primary:
+                    primary.setdefault(hit.read_num, hit)
+            seqs = [seq1] if seq2 is None else [seq1, seq2]
+            for read_num, seq in enumerate(seqs, start=1):
+                self.stats["total_reads"] += 1
+                if seq2 is not None:
+                    self.stats[f"reads{read_num}"] += 1
+                if read_num in primary:
+                    self.stats["read_lengths"][len(seq)] += 1
+                    self.stats["mapped"] += 1
+
+            fragment: Fragment
+            if seq2 is None:
+                if 1 not in primary:
+                    continue
+                self.stats["unpaired_reads"] += 1
+                fragment = SingleRead(MappedFastqs.read_from_mappy(seq1, primary[1]))
+            else:
+                if (
+                    1 not in primary
+                    or 2 not in primary
+                    or primary[1].ctg != primary[2].ctg
+                    or primary[1].strand == primary[2].strand
+                ):
+                    improper_pairs += 1
+                    continue
+                fragment = PairedReads(
+                    MappedFastqs.read_from_mappy(seq1, primary[1]),
+                    MappedFastqs.read_from_mappy(seq2, primary[2]),
+                )
+            if self.keep_template(fragment):
+                yield fragment
+
+        print(f"{improper_pairs} improper pairs", file=sys.stderr)
+
+
 class ReadStore:
     """The internal datastructure for storing reads by amplicon"""
 
@@ -234,8 +829,16 @@ class ReadStore:
         bam: Bam,
         target_depth: int = 1000,
         cylon_target_depth_factor: int = 200,
+        sample: Optional[FragmentSample] = None,
     ):
-        self.amplicons: defaultdict[Amplicon, list[Fragment]] = defaultdict(list)
+        """Build the readstore from a FragmentSample of the amplicon set, or
+        by reading fragments from the bam if no sample is given
+        """
+        # sampled fragments are packed by amplicon into a columnar store
+        self.store: FragmentStore = FragmentStore()
+        self.amplicon_ids: dict[Amplicon, int] = {
+            amplicon: i for i, amplicon in enumerate(amplicon_set)
+        }
         self.reads_per_amplicon: defaultdict[Amplicon, int] = defaultdict(int)
         self.amplicon_set: AmpliconSet = amplicon_set
         self.reads_all_paired: Optional[bool] = bam.infile_is_paired
@@ -289,13 +892,20 @@ class ReadStore:
             if amplicon.end > self.end_pos:
                 self.end_pos = amplicon.end
 
-        for fragment in bam.syncronise_fragments():
-            self.count_fragment(fragment)
-
-        random.seed(42)
-        for fragment in bam.syncronise_fragments():
+        if sample is None:
             # truncate number of reads to target count per amplicon
-            self.push_fragment(fragment)
+            sample = FragmentSample(amplicon_set, target_depth=target_depth)
+            for fragment, (hit,) in map_batches(
+                AmpliconMatcher([amplicon_set]).match_fragments,
+                bam.syncronise_fragments(),
+                batch_size=MATCH_BATCH_SIZE,
+            ):
+                sample.push(fragment, hit)
+        elif sample.amplicon_set != amplicon_set:
+            raise Exception(
+                f"Fragment sample is from amplicon set {sample.amplicon_set.name}, not {amplicon_set.name}"
+            )
+        self.load_sample(sample)
 
         for amplicon in self.amplicon_set:
 
@@ -338,11 +948,6 @@ class ReadStore:
                 "right_primer_start": p2_start,
             }
 
-        for amplicon in self.amplicons:
-            # we still want to randomise the order of the downsampled
-            # amplicons. Cylon will further downsample from these
-            # lists
-            random.shuffle(self.amplicons[amplicon])
         self.summarise_amplicons()
 
     @staticmethod
@@ -385,59 +990,97 @@ class ReadStore:
     def __iter__(self):
         raise NotImplementedError
 
-    def __getitem__(self, amplicon: Amplicon) -> list[Fragment]:
+    def __getitem__(self, amplicon: Amplicon) -> Sequence[Fragment]:
         """Given an amplicon, returns list of Fragments"""
-        return self.amplicons[amplicon]
-
-    def fetch(self, start: Index0, end: Index0):
-        """Fetch reads from a specific range of positions"""
-        raise NotImplementedError
-
-    def count_fragment(self, fragment: Fragment):
-        """Update internal amplicon stats summary"""
-        amplicon = self.amplicon_set.match(fragment)
-        if not amplicon:
-            self.unmatched_reads += 1
-            return
-
-        self.reads_per_amplicon[amplicon] += 1
-
-        self.summary[amplicon.name][
-            "total_mapped_bases"
-        ] += fragment.total_mapped_bases()
-        self.summary[amplicon.name]["total_depth"] += 1
-
-    def push_fragment(self, fragment: Fragment):
-        """Insert fragment into the readstore
+        if amplicon not in self.amplicon_ids:
+            return StoredFragments(self.store, np.empty(0, dtype=np.int64))
+        return StoredFragments(
+            self.store, self.store.select(self.amplicon_ids[amplicon])
+        )
 
-        This matches the fragment to the amplicon
+    @property
+    def amplicons(self) -> dict[Amplicon, Sequence[Fragment]]:
+        """Sampled fragments of every amplicon"""
+        return {amplicon: self[amplicon] for amplicon in self.amplicon_ids}
+
+    @amplicons.setter
+    def amplicons(self, fragments: dict[Amplicon, list[Fragment]]):
+        """Replace the sampled fragments of the readstore"""
+        self.store = FragmentStore()
+        for amplicon, amplicon_fragments in fragments.items():
+            for fragment in amplicon_fragments:
+                self.store.append(fragment, self.amplicon_id(amplicon))
+
+    def amplicon_id(self, amplicon: Amplicon) -> int:
+        """Group id of an amplicon in the fragment store"""
+        if amplicon not in self.amplicon_ids:
+            self.amplicon_ids[amplicon] = len(self.amplicon_ids)
+        return self.amplicon_ids[amplicon]
+
+    def fetch(self, start: Index0, end: Index0) -> Sequence[Fragment]:
+        """Fetch fragments with a read overlapping a range of positions
+        (0-based, end exclusive), from every amplicon
         """
-        amplicon: Optional[Amplicon] = self.amplicon_set.match(fragment)
-        if amplicon is None:
-            return
+        return StoredFragments(self.store, self.store.overlapping(start, end))
 
-        frags = self.reads_per_amplicon[amplicon]
-        sample_rate = self.target_depth / frags
-        if frags < self.target_depth or random.random() < sample_rate:
-            p1, p2 = amplicon.match_primers(fragment)
-            if p1 is not None:
-                self.primer_histogram[amplicon]["left"][p1] += 1
-            if p2 is not None:
-                self.primer_histogram[amplicon]["right"][p2] += 1
-
-            self.amplicons[amplicon].append(fragment)
-            self.summary[amplicon.name][
-                "sampled_bases"
-            ] += fragment.total_mapped_bases()
-            self.summary[amplicon.name]["sampled_depth"] += 1
+    def load_sample(self, sample: FragmentSample):
+        """Take the per-amplicon counts and downsampled fragments from a
+        FragmentSample, which is cleared afterwards. Fragments are copied
+        from the sample's store without being rebuilt
+        """
+        self.unmatched_reads += sample.unmatched_reads
+        for amplicon, count in sample.reads_per_amplicon.items():
+            self.reads_per_amplicon[amplicon] += count
+            self.summary[amplicon.name]["total_mapped_bases"] += sample.mapped_bases[
+                amplicon
+            ]
+            self.summary[amplicon.name]["total_depth"] += count
+
+        for amplicon, reservoir in sample.slots.items():
+            # we still want to randomise the order of the downsampled
+            # amplicons. Cylon will further downsample from these
+            # lists
+            reservoir = list(reservoir)
+            sample.random.shuffle(reservoir)
+            for i in reservoir:
+                self.push_stored(sample.store, i, amplicon)
+        sample.clear()
+
+    def push_stored(self, store: FragmentStore, i: int, amplicon: Amplicon):
+        """Insert fragment i of another FragmentStore into the readstore, as
+        push_fragment does for a Fragment
+        """
+        p1, p2 = amplicon.match_primers_to_span(*store.span(i))
+        if p1 is not None:
+            self.primer_histogram[amplicon]["left"][p1] += 1
+        if p2 is not None:
+            self.primer_histogram[amplicon]["right"][p2] += 1
+
+        self.store.copy_from(store, i, self.amplicon_id(amplicon))
+        self.summary[amplicon.name]["sampled_bases"] += store.mapped_bases(i)
+        self.summary[amplicon.name]["sampled_depth"] += 1
+
+    def push_fragment(self, fragment: Fragment, amplicon: Amplicon):
+        """Insert a sampled fragment into the readstore"""
+        p1, p2 = amplicon.match_primers(fragment)
+        if p1 is not None:
+            self.primer_histogram[amplicon]["left"][p1] += 1
+        if p2 is not None:
+            self.primer_histogram[amplicon]["right"][p2] += 1
+
+        self.store.append(fragment, self.amplicon_id(amplicon))
+        self.summary[amplicon.name]["sampled_bases"] += fragment.total_mapped_bases()
+        self.summary[amplicon.name]["sampled_depth"] += 1
 
     def summarise_amplicons(self):
         """normalise the bases per amplicons and such"""
-        depth_sum = 0
-        for amplicon in self.amplicons:
-            self.amplicon_stats[amplicon] = {False: 0, True: 0}
-            for fragment in self.amplicons[amplicon]:
-                self.amplicon_stats[amplicon][fragment.strand] += 1
+        for amplicon, i in self.amplicon_ids.items():
+            strands = self.store.strands(self.store.select(i))
+            forward = int(np.count_nonzero(strands))
+            self.amplicon_stats[amplicon] = {
+                False: len(strands) - forward,
+                True: forward,
+            }
 
     def reads_to_fastas(
         self, amplicon: Amplicon, outfile: Path, target_bases: int
@@ -9,9 +9,72 @@ from typing import Optional, Any
 # import tempfile
 import json
 
-from viridian_workflow import readstore, self_qc
+from viridian_workflow import readstore, self_qc, utils
 from viridian_workflow.subtasks import Cylon, Minimap, Varifier
-from viridian_workflow.primers import AmpliconSet
+from viridian_workflow.subtasks.minimap import SAMTOOLS_COMPRESSION_LEVEL
+from viridian_workflow.primers import AmpliconSet, PrimerIndex
+
+
+def allocate_threads(threads: int) -> dict[str, int]:
+    """Divide a thread budget between the pipeline stages
+
+    Stages that run one after another can each use the whole budget.
+    minimap2's output is streamed as uncompressed SAM, so nothing needs
+    decompressing while it runs. The BGZF bam kept with --keep_bam is only
+    read once minimap2 has finished, and pysam gains little from more than
+    a few decompression threads. cylon does not take a thread count.
+    """
+    threads = max(1, threads)
+    return {
+        "minimap2": threads,
+        "bam_decompression": min(4, threads),
+        "mappy": threads,
+        "cylon": 1,
+        "varifier": threads,
+        "self_qc": threads,
+    }
+
+
+def failed_amplicons(reads: readstore.ReadStore, min_depth: int) -> list[str]:
+    """Names of amplicons with fewer than min_depth fragments. Self-QC would
+    mask most of their consensus anyway, so they are counted as failed
+    before assembly
+    """
+    return [
+        amplicon.name
+        for amplicon in reads.amplicon_set
+        if reads.summary[amplicon.name]["total_depth"] < min_depth
+    ]
+
+
+def percent_n(fasta: Path) -> float:
+    """Percent of the sequence in a single-sequence FASTA that is N"""
+    seq = utils.load_single_seq_fasta(fasta).seq.upper()
+    return 100 * seq.count("N") / len(seq) if len(seq) > 0 else 100.0
+
+
+def primer_candidates(
+    fqs: list[Path],
+    candidate_sets: list[AmpliconSet],
+    results: dict[str, Any],
+    progress: list[dict[str, Any]],
+    profile_dir: Optional[Path] = None,
+    max_reads: int = 10000,
+) -> list[AmpliconSet]:
+    """Narrow the candidate schemes to the one whose primers start the most
+    reads, checking only the first reads of each fastq. If no scheme is a
+    clear winner, all candidates are kept for detection from mapped reads
+    """
+    with utils.stage("primer_detection", progress, profile_dir):
+        winner, summary = PrimerIndex(candidate_sets).detect(
+            utils.read_seqs(fqs, max_reads)
+        )
+    results["Primer_detection"] = summary
+    print(
+        f"Scheme detected from primers in reads: {summary['chosen_scheme']}",
+        file=sys.stderr,
+    )
+    return candidate_sets if winner is None else [winner]
 
 
 def run_pipeline(
@@ -23,6 +86,7 @@ def run_pipeline(
     force_amp_scheme: Optional[AmpliconSet] = None,
     keep_intermediate: bool = False,
     keep_bam: bool = False,
+    bam_compression_level: Optional[int] = None,
     sample_name: str = "sample",
     frs_threshold: float = 0.1,
     self_qc_depth: int = 20,
@@ -31,6 +95,13 @@ def run_pipeline(
     dump_tsv: bool = False,
     command_line_args: Optional[dict[str, Any]] = None,
     force_consensus: Optional[Path] = None,
+    threads: int = 1,
+    liftover: bool = False,
+    mapper: str = "minimap2",
+    index_cache: Optional[Path] = None,
+    sequential_detection: bool = False,
+    primer_detection: bool = False,
+    profile: bool = False,
     global_log: Optional[dict[str, Any]] = {},  # global pipeline log dictionary (bad)
 ):
     work_dir = Path(work_dir)
@@ -42,29 +113,103 @@ def run_pipeline(
 
     results: dict[str, Any] = {}
 
+    # every stage records its wall time, CPU time and peak RSS here. When
+    # reads are mapped as they are read (streaming minimap2's output, or with
+    # mappy), amplicon_detection includes the time spent mapping. mappy's
+    # index is loaded in its own mappy_index stage
+    progress: list[dict[str, Any]] = global_log["Summary"]["Progress"]
+    # with profile, each in-process stage is profiled into this directory
+    profile_dir: Optional[Path] = work_dir / "profile" if profile else None
+
+    thread_budget: dict[str, int] = allocate_threads(threads)
+    global_log["Summary"]["Threads"] = thread_budget
+
     # generate name-sorted bam from fastqs
+    fq2: Optional[Path] = None
     if platform == "illumina":
         fq1, fq2 = fqs
-        minimap = Minimap(work_dir / "name_sorted.bam", ref, fq1, fq2=fq2, sort=False)
     elif platform == "ont":
-        fq = fqs[0]
-        minimap = Minimap(work_dir / "name_sorted.bam", ref, fq, sort=False)
+        fq1 = fqs[0]
     elif platform == "iontorrent":
         raise NotImplementedError
     else:
         print(f"Platform {platform} is not supported.", file=sys.stderr)
         exit(1)
 
-    unsorted_bam: Path = minimap.run()
-    global_log["Summary"]["Progress"].append(minimap.log)
-
-    # add minimap task log to result log
-    # log["minimap"] = minimap.log
-
-    # pre-process input bam
-    bam: readstore.Bam = readstore.Bam(unsorted_bam)
-    # detect amplicon set
-    amplicon_set: AmpliconSet = bam.detect_amplicon_set(amplicon_sets)
+    # detect amplicon set and downsample reads in a single pass over the
+    # alignments. Unless the bam is kept, they are read straight from
+    # minimap2's output as it is produced, or mapped in-process with mappy
+    candidate_sets: list[AmpliconSet] = list(amplicon_sets)
+    amplicon_set: AmpliconSet
+    bam: readstore.Bam
+    # a forced scheme is matched and sampled for the readstore, but is not a
+    # candidate, so it cannot win detection or be dropped by it
+    keep = None if force_amp_scheme is None else [force_amp_scheme]
+    # a forced scheme does not need detecting
+    primer_detection = primer_detection and force_amp_scheme is None
+    if mapper == "mappy" and not keep_bam:
+        with utils.stage("mappy_index", progress, profile_dir):
+            bam = readstore.MappedFastqs(
+                ref,
+                fq1,
+                fq2=fq2,
+                threads=thread_budget["mappy"],
+                index_cache=index_cache,
+            )
+        if primer_detection:
+            candidate_sets = primer_candidates(
+                fqs, candidate_sets, results, progress, profile_dir
+            )
+        with utils.stage("amplicon_detection", progress, profile_dir):
+            amplicon_set, samples = bam.ingest(
+                candidate_sets, sequential=sequential_detection, keep=keep
+            )
+    elif mapper in ("mappy", "minimap2"):
+        minimap = Minimap(
+            work_dir / "name_sorted.bam",
+            ref,
+            fq1,
+            fq2=fq2,
+            threads=thread_budget["minimap2"],
+            sort=False,
+            index_cache=index_cache,
+            # only used for the bam kept with keep_bam
+            compression_level=(
+                SAMTOOLS_COMPRESSION_LEVEL
+                if bam_compression_level is None
+                else bam_compression_level
+            ),
+        )
+        if keep_bam:
+            if primer_detection:
+                candidate_sets = primer_candidates(
+                    fqs, candidate_sets, results, progress, profile_dir
+                )
+            unsorted_bam: Path = minimap.run()
+            bam = readstore.Bam(
+                unsorted_bam, threads=thread_budget["bam_decompression"]
+            )
+            with utils.stage("amplicon_detection", progress, profile_dir):
+                amplicon_set, samples = bam.ingest(
+                    candidate_sets, sequential=sequential_detection, keep=keep
+                )
+        else:
+            with minimap.stream() as alignments:
+                # minimap2 loads its index while the primers are counted, but
+                # stops once its output pipe is full, so mapping does not
+                # start until ingestion reads the alignments
+                if primer_detection:
+                    candidate_sets = primer_candidates(
+                        fqs, candidate_sets, results, progress, profile_dir
+                    )
+                bam = readstore.Bam(stream=alignments)
+                with utils.stage("amplicon_detection", progress, profile_dir):
+                    amplicon_set, samples = bam.ingest(
+                        candidate_sets, sequential=sequential_detection, keep=keep
+                    )
+        progress.append(minimap.log)
+    else:
+        raise Exception(f"Mapper {mapper} is not supported")
     results["Amplicons"] = {
         "scheme": amplicon_set.name,
         "total_amplicons": len(amplicon_set.amplicons),
@@ -74,17 +219,20 @@ def run_pipeline(
 
     # construct readstore
     # this subsamples the reads
-    reads = (
-        readstore.ReadStore(amplicon_set, bam)
-        if force_amp_scheme is None
-        else readstore.ReadStore(force_amp_scheme, bam)
-    )
+    with utils.stage("readstore", progress, profile_dir, trace_memory=True):
+        scheme = amplicon_set if force_amp_scheme is None else force_amp_scheme
+        reads = readstore.ReadStore(scheme, bam, sample=samples.pop(scheme))
+        # the other candidates' samples hold their sampled fragments, which
+        # are not needed once the readstore is built
+        samples.clear()
 
     # log["amplicons"] = reads.summary
     results["Coverage"] = {
         "total_reads": bam.stats["total_reads"],
         #        "Total_fragments": 0,  # TODO
         "Reference_coverage": bam.stats["mapped"],
+        # reads whose mate may have been lost from a full mate buffer
+        "Mates_evicted": bam.stats["mates_evicted"],
         #        "Reference_length": 0,  # TODO
         #        "Average_amplicon_depth": 0,  # TODO
     }
@@ -97,6 +245,16 @@ def run_pipeline(
             for primer, count in reads.primer_histogram[amplicon][d].items():
                 results["Primers"][amplicon.name][d][primer.name] = count
 
+    # stop before assembly if too many amplicons have no useful reads
+    failed = failed_amplicons(reads, self_qc_depth)
+    results["Amplicons"]["Failed_amplicons"] = failed
+    percent_failed = 100 * len(failed) / len(reads.amplicon_set.amplicons)
+    if percent_failed > max_percent_amps_fail:
+        raise utils.PipelineAbort(
+            f"{percent_failed:.1f}% of amplicons failed (fewer than {self_qc_depth} reads), more than the maximum of {max_percent_amps_fail}%",
+            results,
+        )
+
     # branch on whether to run cylon or use external assembly ("cuckoo mode")
     consensus: Optional[Path] = None
 
@@ -108,16 +266,25 @@ def run_pipeline(
     else:
         # save reads for cylon assembly
         amp_dir = work_dir / "amplicons"
-        manifest_data = reads.make_reads_dir_for_cylon(amp_dir)
+        with utils.stage("amplicon_reads", progress, profile_dir):
+            manifest_data = reads.make_reads_dir_for_cylon(amp_dir)
         results["Amplicons"]["Successful_amplicons"] = len(manifest_data)
 
         # run cylon
         cylon = Cylon(work_dir, platform, ref, amp_dir, manifest_data, reads.cylon_json)
         consensus = cylon.run()
-        global_log["Summary"]["Progress"].append(cylon.log)
+        progress.append(cylon.log)
 
     # satify type bounds and ensure the readstore was properly constructed
     assert consensus is not None
+
+    # stop before varifier and self-QC if the consensus is mostly N
+    results["Consensus_N_percent"] = percent_n(consensus)
+    if results["Consensus_N_percent"] > consensus_max_n_percent:
+        raise utils.PipelineAbort(
+            f"Consensus is {results['Consensus_N_percent']:.1f}% N, more than the maximum of {consensus_max_n_percent}%",
+            results,
+        )
     assert reads.start_pos is not None
     assert reads.end_pos is not None
 
@@ -128,19 +295,24 @@ def run_pipeline(
         consensus,
         min_coord=reads.start_pos,
         max_coord=reads.end_pos,
+        threads=thread_budget["varifier"],
     )
     vcf, msa, varifier_consensus = varifier.run()
-    global_log["Summary"]["Progress"].append(varifier.log)
+    progress.append(varifier.log)
 
-    pileup = self_qc.Pileup(
-        varifier_consensus,
-        reads,
-        msa=msa,
-        config=self_qc.Config(frs_threshold, self_qc_depth),
-    )
+    with utils.stage("self_qc", progress, profile_dir, trace_memory=True):
+        pileup = self_qc.Pileup(
+            varifier_consensus,
+            reads,
+            msa=msa,
+            config=self_qc.Config(frs_threshold, self_qc_depth),
+            threads=thread_budget["self_qc"],
+            liftover=liftover,
+        )
 
     # masked fasta output
-    masked_fasta: str = pileup.mask()
+    with utils.stage("masking", progress, profile_dir):
+        masked_fasta: str = pileup.mask()
     # log["self_qc"] = pileup.log
     # log["qc"] = pileup.summary
 
@@ -149,6 +321,7 @@ def run_pipeline(
         "Total_masked_incl_self_qc": pileup.summary["total_masked"]
         - pileup.summary["already_masked"],
         "Filters": pileup.summary["Filters"],
+        "Remapping": pileup.summary["Remapping"],
     }
 
     results["Consensus"] = pileup.consensus_seq
@@ -162,17 +335,18 @@ def run_pipeline(
         print(masked_fasta, file=fasta_out)
 
     # annotate vcf
-    annotated_vcf = pileup.annotate_vcf(vcf)
-
-    # dump tsv
-    if dump_tsv:
-        _ = pileup.dump_tsv(work_dir / "all_stats.tsv", amplicon_set)
-
-    with open(work_dir / "final.vcf", "w", encoding="utf-8") as vcf_out:
-        header, records = annotated_vcf
-        for h in header:
-            print(h, file=vcf_out)
-        for rec in records:
-            print("\t".join(map(str, rec)), file=vcf_out)
+    with utils.stage("vcf_annotation", progress, profile_dir):
+        annotated_vcf = pileup.annotate_vcf(vcf)
+
+        # dump tsv
+        if dump_tsv:
+            _ = pileup.dump_tsv(work_dir / "all_stats.tsv", amplicon_set)
+
+        with open(work_dir / "final.vcf", "w", encoding="utf-8") as vcf_out:
+            header, records = annotated_vcf
+            for h in header:
+                print(h, file=vcf_out)
+            for rec in records:
+                print("\t".join(map(str, rec)), file=vcf_out)
 
     return results
@@ -7,16 +7,19 @@ are mapped to the 'consensus', which is compared to the reference.
 from __future__ import annotations
 
 import sys
+import threading
 
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import Callable, Optional, Any
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional, Any
 from pathlib import Path
 
 import mappy as mp  # type: ignore
+import numpy as np
 
-from viridian_workflow.utils import Index0, Index1, in_range
-from viridian_workflow.primers import Amplicon, AmpliconSet
+from viridian_workflow.utils import Index0, Index1, in_range, map_batches
+from viridian_workflow.primers import Amplicon, AmpliconSet, Primer
+from viridian_workflow.reads import Read
 from viridian_workflow.readstore import ReadStore
 
 
@@ -97,6 +100,33 @@ class EvaluatedStats:
                         self.total.alts += count
                         self.calls_by_amplicon[amplicon].alts += count
 
+    @classmethod
+    def from_counts(
+        cls,
+        base: str,
+        aux_reference_pos: Index0,
+        reference_base: str,
+        depth: int,
+        total: Calls,
+        primer_calls: Calls,
+        primer_calls_ignored: Calls,
+        calls_by_amplicon: dict[Amplicon, Calls],
+        alt_bases: defaultdict[str, int],
+    ) -> EvaluatedStats:
+        """Position stats that have already been reduced from PileupCounts"""
+        stats = cls.__new__(cls)
+        stats.base = base
+        stats.aux_reference_pos = aux_reference_pos
+        stats.reference_base = reference_base
+        stats.depth = depth
+        stats.total = total
+        stats.primer_calls = primer_calls
+        stats.primer_calls_ignored = primer_calls_ignored
+        stats.calls_by_amplicon = calls_by_amplicon
+        stats.multiple_amplicon_support = len(calls_by_amplicon) > 1
+        stats.alt_bases = alt_bases
+        return stats
+
     def evaluate(
         self, filters: dict[str, tuple[Filter, FilterMsg]]
     ) -> tuple[bool, dict[str, str]]:
@@ -206,6 +236,197 @@ class Stats:
         self.baseprofiles[profile.amplicon][profile] += 1
 
 
+# base calls are encoded as indices into BASES in pileup count arrays;
+# anything that is not one of these is counted as an N
+BASES: str = "ACGTN-"
+BASE_LOOKUP: np.ndarray = np.full(256, BASES.index("N"), dtype=np.int8)
+for _code, _base in enumerate(BASES):
+    BASE_LOOKUP[ord(_base)] = _code
+
+
+def encode_bases(seq: str) -> np.ndarray:
+    """Encode a string of base calls as indices into BASES"""
+    return BASE_LOOKUP[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+
+
+class PileupCounts:
+    """Base call counts over the consensus, per amplicon
+
+    Each amplicon has a dense count array indexed by (consensus position,
+    base, in_primer, forward strand). The position axis only spans the
+    window of consensus positions that the amplicon's reads aligned to, so
+    the total size stays proportional to the genome length rather than
+    genome length times the number of amplicons.
+
+    Calls are staged as flat indices and added to an amplicon's counts with
+    a single np.bincount when another amplicon is added, when enough calls
+    are staged, or when the counts are evaluated. A read's calls can be
+    given a weight, to count identical reads at once.
+    """
+
+    CELLS: int = len(BASES) * 2 * 2
+
+    def __init__(self, length: int, batch_size: int = 1 << 20):
+        self.length: int = length
+        self.batch_size: int = batch_size
+        self.windows: dict[Amplicon, tuple[int, np.ndarray]] = {}
+
+        self._amplicon: Optional[Amplicon] = None
+        self._positions: list[np.ndarray] = []
+        self._codes: list[np.ndarray] = []
+        self._weights: list[np.ndarray] = []
+        self._weighted: bool = False
+        self._staged: int = 0
+
+    def add(
+        self,
+        amplicon: Amplicon,
+        positions: np.ndarray,
+        bases: np.ndarray,
+        in_primer: np.ndarray,
+        forward_strand: bool,
+        weight: int = 1,
+    ):
+        """Count base calls (encoded with encode_bases) of one read at
+        0-based consensus positions, weight times
+        """
+        if amplicon != self._amplicon:
+            self.flush()
+            self._amplicon = amplicon
+        codes = (bases.astype(np.int64) * 2 + in_primer) * 2 + int(forward_strand)
+        self._positions.append(positions)
+        self._codes.append(codes)
+        self._weights.append(np.full(len(positions), weight, dtype=np.int64))
+        self._weighted |= weight != 1
+        self._staged += len(positions)
+        if self._staged >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Add staged calls to the current amplicon's counts"""
+        if self._amplicon is None or self._staged == 0:
+            return
+        positions = np.concatenate(self._positions)
+        codes = np.concatenate(self._codes)
+        weights = np.concatenate(self._weights) if self._weighted else None
+        self._positions, self._codes, self._weights = [], [], []
+        self._weighted, self._staged = False, 0
+
+        start, end = int(positions.min()), int(positions.max()) + 1
+        if self._amplicon in self.windows:
+            offset, counts = self.windows[self._amplicon]
+            if start < offset or end > offset + len(counts):
+                # grow the window to cover the new positions
+                new_offset = min(start, offset)
+                grown = np.zeros(
+                    (max(end, offset + len(counts)) - new_offset, *counts.shape[1:]),
+                    dtype=counts.dtype,
+                )
+                grown[offset - new_offset : offset - new_offset + len(counts)] = counts
+                offset, counts = new_offset, grown
+        else:
+            offset = start
+            counts = np.zeros((end - start, len(BASES), 2, 2), dtype=np.int32)
+
+        flat = (positions - offset) * self.CELLS + codes
+        added = np.bincount(flat, weights=weights, minlength=counts.size)
+        counts += added.astype(counts.dtype).reshape(counts.shape)
+        self.windows[self._amplicon] = (offset, counts)
+
+    def evaluate(
+        self,
+        consensus_seq: str,
+        aux_reference_positions: list[Index0],
+        reference_bases: list[str],
+    ) -> list[EvaluatedStats]:
+        """Reduce the counts to EvaluatedStats for every consensus position"""
+        self.flush()
+        length = self.length
+        consensus_codes = encode_bases(consensus_seq).astype(np.int64)
+        # bases that cannot be called never match a read's call
+        consensus_codes[
+            ~np.isin(
+                np.frombuffer(consensus_seq.encode("ascii"), dtype=np.uint8),
+                np.frombuffer(BASES.encode("ascii"), dtype=np.uint8),
+            )
+        ] = -1
+
+        depth = np.zeros(length, dtype=np.int64)
+        amplicons_present = np.zeros(length, dtype=np.int64)
+        base_counts = np.zeros((length, len(BASES)), dtype=np.int64)
+
+        # per amplicon: calls by (position, base, in_primer)
+        reduced: list[tuple[Amplicon, int, np.ndarray]] = []
+        for amplicon, (offset, counts) in self.windows.items():
+            end = min(offset + len(counts), length)
+            calls = counts[: end - offset].sum(axis=3)
+            reduced.append((amplicon, offset, calls))
+            calls_per_base = calls.sum(axis=2)
+            base_counts[offset:end] += calls_per_base
+            amplicon_depth = calls_per_base.sum(axis=1)
+            depth[offset:end] += amplicon_depth
+            amplicons_present[offset:end] += amplicon_depth > 0
+
+        multiple_amplicon_support = amplicons_present > 1
+
+        total_refs = np.zeros(length, dtype=np.int64)
+        total_alts = np.zeros(length, dtype=np.int64)
+        primer_refs = np.zeros(length, dtype=np.int64)
+        primer_alts = np.zeros(length, dtype=np.int64)
+        ignored_refs = np.zeros(length, dtype=np.int64)
+        ignored_alts = np.zeros(length, dtype=np.int64)
+        calls_by_amplicon: list[dict[Amplicon, Calls]] = [{} for _ in range(length)]
+
+        for amplicon, offset, calls in reduced:
+            end = offset + len(calls)
+            is_ref = (
+                np.arange(len(BASES))[None, :] == consensus_codes[offset:end, None]
+            )
+            clean, primer = calls[:, :, 0], calls[:, :, 1]
+            clean_refs = (clean * is_ref).sum(axis=1)
+            clean_alts = clean.sum(axis=1) - clean_refs
+            amp_primer_refs = (primer * is_ref).sum(axis=1)
+            amp_primer_alts = primer.sum(axis=1) - amp_primer_refs
+
+            ignored = multiple_amplicon_support[offset:end]
+            amp_refs = clean_refs + np.where(ignored, 0, amp_primer_refs)
+            amp_alts = clean_alts + np.where(ignored, 0, amp_primer_alts)
+
+            total_refs[offset:end] += amp_refs
+            total_alts[offset:end] += amp_alts
+            primer_refs[offset:end] += amp_primer_refs
+            primer_alts[offset:end] += amp_primer_alts
+            ignored_refs[offset:end] += np.where(ignored, amp_primer_refs, 0)
+            ignored_alts[offset:end] += np.where(ignored, amp_primer_alts, 0)
+
+            for i in np.flatnonzero(calls.sum(axis=(1, 2))):
+                calls_by_amplicon[offset + i][amplicon] = Calls(
+                    int(amp_refs[i]), int(amp_alts[i])
+                )
+
+        evaluated = []
+        for i, base in enumerate(consensus_seq):
+            alt_bases: defaultdict[str, int] = defaultdict(int)
+            for code in np.flatnonzero(base_counts[i]):
+                alt_bases[BASES[code]] = int(base_counts[i, code])
+            evaluated.append(
+                EvaluatedStats.from_counts(
+                    base,
+                    aux_reference_positions[i],
+                    reference_bases[i],
+                    depth=int(depth[i]),
+                    total=Calls(int(total_refs[i]), int(total_alts[i])),
+                    primer_calls=Calls(int(primer_refs[i]), int(primer_alts[i])),
+                    primer_calls_ignored=Calls(
+                        int(ignored_refs[i]), int(ignored_alts[i])
+                    ),
+                    calls_by_amplicon=calls_by_amplicon[i],
+                    alt_bases=alt_bases,
+                )
+            )
+        return evaluated
+
+
 Filter = Callable[[EvaluatedStats], bool]
 FilterMsg = Callable[[EvaluatedStats], str]
 
@@ -214,66 +435,106 @@ class Msa:
     def __init__(self, msa: Path):
         """Construct translation tables for mapping 1-based genomic coordinates
         between two complete sequences
+
+        The tables are int32 arrays indexed by 1-based position. Positions
+        that fall in a gap map to the preceding position of the other
+        sequence, or 0 if there is none.
         """
-        self._ref_to_consensus: dict[Index1, Index1] = {}
-        self._consensus_to_ref: dict[Index1, Index1] = {}
-        self.msa: list[tuple[tuple[Index1, str], tuple[Index1, str]]] = []
-        self.ref: list[str] = []
-        self.cons: list[str] = []
-
-        with open(msa) as msa_fd:
-            ref_seq = msa_fd.readline().strip()  # reference
-            con_seq = msa_fd.readline().strip()  # consensus
-
-            if len(msa_fd.readline()) > 0:
-                raise Exception("Invalid multiple sequence alignment file")
-
-            if len(con_seq) != len(ref_seq):
-                raise Exception("Both sequences in MSA must be same length")
-
-            # this is valid for testing when the consensus is complete
-            # but some of the unittests break this assumption
-            # assert con_seq.replace("-", "") == self.consensus_seq
-
-            ref_pos = 0
-            con_pos = 0
-
-            for con_base, ref_base in zip(con_seq, ref_seq):
-                if con_base == "-" and ref_base != "-":
-                    ref_pos += 1
-                    self._ref_to_consensus[Index1(ref_pos)] = Index1(con_pos)
-                    self.ref.append(ref_base)
-
-                elif ref_base == "-" and con_base != "-":
-                    con_pos += 1
-                    self._consensus_to_ref[Index1(con_pos)] = Index1(ref_pos)
-                    self.cons.append(con_base)
-
-                elif con_base != "-" and ref_base != "-":
-                    ref_pos += 1
-                    con_pos += 1
-                    self._ref_to_consensus[Index1(ref_pos)] = Index1(con_pos)
-                    self._consensus_to_ref[Index1(con_pos)] = Index1(ref_pos)
-                    self.ref.append(ref_base)
-                    self.cons.append(con_base)
-
-                self.msa.append(
-                    ((Index1(ref_pos), ref_base), (Index1(con_pos), con_base))
-                )
+        with open(msa, "rb") as msa_fd:
+            lines = msa_fd.read().splitlines(keepends=True)
+
+        if len(lines) > 2:
+            raise Exception("Invalid multiple sequence alignment file")
+        lines += [b"", b""]
+        ref_seq = lines[0].strip()  # reference
+        con_seq = lines[1].strip()  # consensus
+
+        if len(con_seq) != len(ref_seq):
+            raise Exception("Both sequences in MSA must be same length")
+
+        # this is valid for testing when the consensus is complete
+        # but some of the unittests break this assumption
+        # assert con_seq.replace("-", "") == self.consensus_seq
+
+        ref_columns = np.frombuffer(ref_seq, dtype=np.uint8)
+        con_columns = np.frombuffer(con_seq, dtype=np.uint8)
+        in_ref = ref_columns != ord("-")
+        in_con = con_columns != ord("-")
+
+        # 1-based position reached in each sequence at every column
+        self.ref_positions: np.ndarray = np.cumsum(in_ref, dtype=np.int32)
+        self.con_positions: np.ndarray = np.cumsum(in_con, dtype=np.int32)
+        self.ref_bases: bytes = ref_seq
+        self.con_bases: bytes = con_seq
+
+        self.ref: str = ref_columns[in_ref].tobytes().decode("ascii")
+        self.cons: str = con_columns[in_con].tobytes().decode("ascii")
+
+        self._ref_to_consensus: np.ndarray = np.zeros(len(self.ref) + 1, np.int32)
+        self._ref_to_consensus[self.ref_positions[in_ref]] = self.con_positions[in_ref]
+        self._consensus_to_ref: np.ndarray = np.zeros(len(self.cons) + 1, np.int32)
+        self._consensus_to_ref[self.con_positions[in_con]] = self.ref_positions[in_con]
+
+        # reference positions (0-based) next to a column where exactly one of
+        # the sequences has a gap, counted cumulatively for range queries
+        indels = self.ref_positions[in_ref != in_con]
+        near_indel = np.zeros(len(self.ref) + 1, dtype=np.int32)
+        near_indel[np.maximum(indels - 1, 0)] = 1
+        near_indel[indels] = 1
+        self._indel_counts: np.ndarray = np.concatenate(
+            [[0], np.cumsum(near_indel[: len(self.ref)])]
+        )
+
+    @property
+    def msa(self) -> list[tuple[tuple[Index1, str], tuple[Index1, str]]]:
+        """The (position, base) pairs of both sequences at every column"""
+        return [
+            (
+                (Index1(int(ref_pos)), chr(ref_base)),
+                (Index1(int(con_pos)), chr(con_base)),
+            )
+            for ref_pos, ref_base, con_pos, con_base in zip(
+                self.ref_positions, self.ref_bases, self.con_positions, self.con_bases
+            )
+        ]
 
     def ref_to_consensus(self, p: Index1) -> Index1:
-        if p in self._ref_to_consensus:
-            return self._ref_to_consensus[p]
+        if 0 < p < len(self._ref_to_consensus):
+            return Index1(int(self._ref_to_consensus[p]))
         return Index1(0)
 
     def consensus_to_ref(self, p: Index1) -> Index1:
-        if p in self._consensus_to_ref:
-            return self._consensus_to_ref[p]
+        if 0 < p < len(self._consensus_to_ref):
+            return Index1(int(self._consensus_to_ref[p]))
         return Index1(0)
 
+    def has_indel(self, start: Index0, end: Index0) -> bool:
+        """Test whether there is an indel between the reference and the
+        consensus in a range of reference positions (0-based, end exclusive)
+        """
+        start = Index0(min(max(start, 0), len(self.ref)))
+        end = Index0(min(max(end, 0), len(self.ref)))
+        return bool(self._indel_counts[end] > self._indel_counts[start])
+
+    def ref_to_consensus_array(self, ps: np.ndarray) -> np.ndarray:
+        """Translate an array of 1-based reference positions"""
+        return self._translate(self._ref_to_consensus, ps)
+
+    def consensus_to_ref_array(self, ps: np.ndarray) -> np.ndarray:
+        """Translate an array of 1-based consensus positions"""
+        return self._translate(self._consensus_to_ref, ps)
+
+    @staticmethod
+    def _translate(table: np.ndarray, ps: np.ndarray) -> np.ndarray:
+        ps = np.asarray(ps)
+        valid = (ps > 0) & (ps < len(table))
+        return np.where(valid, table[np.where(valid, ps, 0)], 0)
+
 
 class Pileup:
-    """A pileup is an array of Stats objects indexed by position in a sequence"""
+    """A pileup is an array of EvaluatedStats objects indexed by position in a
+    sequence, reduced from per-amplicon base call counts
+    """
 
     def __init__(
         self,
@@ -283,13 +544,17 @@ class Pileup:
         config: Config = default_config,
         minimap_presets: Optional[str] = None,
         seq: Optional[str] = None,  # Only for legacy tests
+        threads: int = 1,
+        liftover: bool = False,
     ):
         self.config: Config = config
         self.seq: list[EvaluatedStats] = []
 
         # remap readstore to consensus sequence
 
-        aligner = mp.Aligner(str(consensus_fasta), preset=minimap_presets, n_threads=1)
+        aligner = mp.Aligner(
+            str(consensus_fasta), preset=minimap_presets, n_threads=threads
+        )
         if seq is None:
             if len(aligner.seq_names) != 1:
                 Exception(
@@ -308,18 +573,14 @@ class Pileup:
 
         self.msa: Msa = Msa(msa)
 
-        _pileup: list[Stats] = []
-
-        for i, base in enumerate(self.consensus_seq):
-            p: Index1 = Index1(i + 1)
-            ref_pos: Index0 = Index0(self.msa.consensus_to_ref(p) - 1)
-            _pileup.append(
-                Stats(
-                    ref_pos,
-                    base,
-                    self.msa.ref[ref_pos],
-                )
-            )
+        # 0-based reference position of each consensus position
+        self.reference_positions: np.ndarray = (
+            self.msa.consensus_to_ref_array(
+                np.arange(1, len(self.consensus_seq) + 1)
+            ).astype(np.int64)
+            - 1
+        )
+        self.counts: PileupCounts = PileupCounts(len(self.consensus_seq))
 
         self.filters: dict[str, tuple[Filter, FilterMsg]] = {
             "low_depth": (
@@ -342,69 +603,118 @@ class Pileup:
         for f in self.filters:
             self.summary["Filters"][f] = 0
 
-        for amplicon, fragments in readstore.amplicons.items():
-            for fragment in fragments:
-                l_primer, r_primer = amplicon.match_primers(fragment)
-                primers = [
-                    primer for primer in [l_primer, r_primer] if primer is not None
-                ]
-                for read in fragment.reads:
-                    alns = aligner.map(read.seq)  # remap to consensus
-                    alignment = None
-                    for x in alns:
-                        # test that the re-alignment is still within the
-                        # original amplicon call
-                        if x.is_primary and in_range(  # this is always true with mappy
-                            (Index0(amplicon.start - 10), Index0(amplicon.end + 10)),
-                            Index0(self.msa.consensus_to_ref(Index1(x.r_st + 1)) - 1),
-                        ):
-                            alignment = x
-
-                    if alignment is None:
-                        continue
-
-                    assert alignment.q_en > alignment.q_st
-                    assert alignment.r_en > alignment.r_st
-
-                    aln: list[tuple[Index0, str]] = parse_cigar(read.seq, alignment)
-
-                    # testing for indel conditions:
-                    # ex = "".join(map(lambda x: x[1] if len(x[1]) == 1 else x[1], aln))
-                    # c = consensus_seq[alignment.r_st : alignment.r_en]
-
-                    for consensus_pos, call in aln:
-                        reference_pos = Index0(
-                            self.msa.consensus_to_ref(Index1(consensus_pos + 1)) - 1
-                        )
-                        if consensus_pos >= len(self.consensus_seq):
-                            print(
-                                f"consensus pos out of bounds: {consensus_pos} >= {len(self.consensus_seq)}",
-                                file=sys.stderr,
-                            )
-                            continue
-
-                        in_primer = any(
-                            [
-                                in_range(
-                                    (primer.ref_start, primer.ref_end), reference_pos
-                                )
-                                for primer in primers
-                            ]
-                        )
-
-                        _pileup[consensus_pos].update(
-                            BaseProfile(
-                                call,
-                                in_primer,
-                                read.is_reverse,
-                                amplicon,
-                            )
-                        )
+        self.summary["Remapping"] = {"lifted_over": 0}
+        reads = reads_to_remap(readstore)
+        if liftover:
+            reads = self.liftover_reads(reads)
+
+        # identical reads are only mapped once, and counted with a weight
+        collapsed = collapse_reads(reads)
+        remapped = remap_reads(aligner, self.msa, collapsed, threads=threads)
+        for amplicon, seq, alignment in remapped:
+            if alignment is None:
+                continue
+
+            assert alignment.q_en > alignment.q_st
+            assert alignment.r_en > alignment.r_st
+
+            consensus_positions, calls = parse_cigar_arrays(seq, alignment)
+            for (primers, is_reverse), weight in collapsed[(amplicon, seq)].items():
+                self.add_calls(
+                    amplicon,
+                    list(primers),
+                    not is_reverse,
+                    consensus_positions,
+                    calls,
+                    weight=weight,
+                )
+
+        remapped_reads = sum(sum(c.values()) for c in collapsed.values())
+        self.summary["Remapping"]["remapped"] = remapped_reads
+        self.summary["Remapping"]["distinct_sequences"] = len(collapsed)
+        self.summary["Remapping"]["cache_hits"] = remapped_reads - len(collapsed)
+        self.summary["Remapping"]["cache_hit_rate"] = (
+            (remapped_reads - len(collapsed)) / remapped_reads
+            if remapped_reads > 0
+            else 0.0
+        )
 
         # Finalise the pileup object by evaluating bases
+        self.seq = self.counts.evaluate(
+            self.consensus_seq,
+            [Index0(int(pos)) for pos in self.reference_positions],
+            [self.msa.ref[pos] for pos in self.reference_positions],
+        )
+
+    def add_calls(
+        self,
+        amplicon: Amplicon,
+        primers: list[Primer],
+        forward_strand: bool,
+        consensus_positions: np.ndarray,
+        calls: np.ndarray,
+        weight: int = 1,
+    ):
+        """Count the base calls of a read aligned to the consensus, weight
+        times
+        """
+        if len(consensus_positions) == 0:
+            return
+
+        in_bounds = consensus_positions < len(self.consensus_seq)
+        if not in_bounds.all():
+            print(
+                f"consensus pos out of bounds: {consensus_positions.max()} >= {len(self.consensus_seq)}",
+                file=sys.stderr,
+            )
+            consensus_positions = consensus_positions[in_bounds]
+            calls = calls[in_bounds]
+
+        reference_positions = self.reference_positions[consensus_positions]
+        in_primer = np.zeros(len(consensus_positions), dtype=bool)
+        for primer in primers:
+            in_primer |= (primer.ref_start <= reference_positions) & (
+                reference_positions < primer.ref_end
+            )
+
+        self.counts.add(
+            amplicon,
+            consensus_positions,
+            calls,
+            in_primer,
+            forward_strand,
+            weight=weight,
+        )
+
+    def liftover_reads(
+        self, reads: Iterable[tuple[Amplicon, list[Primer], Read]]
+    ) -> Iterator[tuple[Amplicon, list[Primer], Read]]:
+        """Count reads by projecting their original alignment to the
+        reference through the MSA, instead of remapping them
+
+        Reads without a cigar, or that overlap an indel between the reference
+        and the consensus, are passed through to be remapped.
+        """
+        for amplicon, primers, read in reads:
+            if read.cigar is None or self.msa.has_indel(read.ref_start, read.ref_end):
+                yield amplicon, primers, read
+                continue
 
-        for stat in _pileup:
-            self.seq.append(EvaluatedStats(stat))
+            reference_positions, calls = parse_cigar_arrays(
+                read.seq, ReferenceAlignment(read.ref_start, read.cigar, read.qry_start)
+            )
+            consensus_positions = (
+                self.msa.ref_to_consensus_array(reference_positions + 1) - 1
+            )
+            mapped = consensus_positions >= 0
+            self.summary["Remapping"]["lifted_over"] += 1
+            self.add_calls(
+                amplicon,
+                primers,
+                not read.is_reverse,
+                consensus_positions[mapped],
+                calls[mapped],
+            )
 
     def __getitem__(self, pos: Index0) -> EvaluatedStats:
         if pos > len(self.seq):
@@ -566,6 +876,86 @@ class Pileup:
         return header, records
 
 
+def reads_to_remap(
+    readstore: ReadStore,
+) -> Iterator[tuple[Amplicon, list[Primer], Read]]:
+    """Every read in the readstore, with its amplicon and the primers its
+    fragment was matched to
+    """
+    for amplicon, fragments in readstore.amplicons.items():
+        for fragment in fragments:
+            l_primer, r_primer = amplicon.match_primers(fragment)
+            primers = [primer for primer in [l_primer, r_primer] if primer is not None]
+            for read in fragment.reads:
+                yield amplicon, primers, read
+
+
+def collapse_reads(
+    reads: Iterable[tuple[Amplicon, list[Primer], Read]],
+) -> dict[tuple[Amplicon, str], dict[tuple[tuple[Primer, ...], bool], int]]:
+    """Group identical reads by amplicon and sequence, counting how many
+    have each combination of primers and strand
+
+    Amplicon sequencing gives many reads with the same sequence, which all
+    remap the same way, so each group only needs to be aligned once.
+    """
+    collapsed: dict[
+        tuple[Amplicon, str], dict[tuple[tuple[Primer, ...], bool], int]
+    ] = defaultdict(lambda: defaultdict(int))
+    for amplicon, primers, read in reads:
+        collapsed[(amplicon, read.seq)][(tuple(primers), read.is_reverse)] += 1
+    return collapsed
+
+
+def remap_read(
+    aligner: mp.Aligner,
+    msa: Msa,
+    amplicon: Amplicon,
+    seq: str,
+    buf: Optional[mp.ThreadBuffer] = None,
+) -> Optional[Any]:
+    """Map a read to the consensus, returning the primary alignment if it
+    still falls within the read's original amplicon
+    """
+    alignment = None
+    for x in aligner.map(seq, buf=buf):  # remap to consensus
+        # test that the re-alignment is still within the
+        # original amplicon call
+        if x.is_primary and in_range(  # this is always true with mappy
+            (Index0(amplicon.start - 10), Index0(amplicon.end + 10)),
+            Index0(msa.consensus_to_ref(Index1(x.r_st + 1)) - 1),
+        ):
+            alignment = x
+    return alignment
+
+
+def remap_reads(
+    aligner: mp.Aligner,
+    msa: Msa,
+    reads: Iterable[tuple[Amplicon, str]],
+    threads: int = 1,
+    batch_size: int = 256,
+) -> Iterator[tuple[Amplicon, str, Optional[Any]]]:
+    """Remap read sequences to the consensus, yielding their alignments in
+    the same order as the input
+
+    With more than one thread, batches of reads are mapped by a thread pool
+    (mappy releases the GIL while aligning), each worker with its own
+    ThreadBuffer.
+    """
+    local = threading.local()
+
+    def remap_batch(batch):
+        if not hasattr(local, "buf"):
+            local.buf = mp.ThreadBuffer()
+        return [
+            (amplicon, seq, remap_read(aligner, msa, amplicon, seq, buf=local.buf))
+            for amplicon, seq in batch
+        ]
+
+    return map_batches(remap_batch, reads, threads=threads, batch_size=batch_size)
+
+
 def parse_cigar(query: str, alignment: Any) -> list[tuple[Index0, str]]:
     """Interpret cigar string and query sequence in reference
     coords from mappy (count, op)
@@ -630,3 +1020,46 @@ def parse_cigar(query: str, alignment: Any) -> list[tuple[Index0, str]]:
             raise Exception(f"invalid cigar op {op}")
 
     return positions
+
+
+class ReferenceAlignment(NamedTuple):
+    """The parts of a read's original alignment used by parse_cigar"""
+
+    r_st: Index0
+    cigar: tuple[tuple[int, int], ...]
+    q_st: Index0
+
+
+def parse_cigar_arrays(query: str, alignment: Any) -> tuple[np.ndarray, np.ndarray]:
+    """Vectorised parse_cigar
+
+    Returns two arrays: the 0-based consensus position of every query
+    basecall, and the calls encoded as indices into BASES. Each cigar op is
+    expanded as a run with np.repeat/np.arange rather than base by base.
+    """
+    cigar = np.asarray(alignment.cigar, dtype=np.int64).reshape(-1, 2)
+    counts, ops = cigar[:, 0], cigar[:, 1]
+    if len(ops) and ops.max() > 5:
+        raise Exception(f"invalid cigar op {ops.max()}")
+
+    is_match = ops == 0
+    consumes_query = is_match | (ops == 1)
+    q_steps = np.where(consumes_query, counts, 0)
+    q_starts = alignment.q_st + np.cumsum(q_steps) - q_steps
+
+    # match runs stop at the end of the query
+    lengths = np.where(
+        is_match,
+        np.clip(len(query) - q_starts, 0, counts),
+        np.where(ops == 2, counts, 0),
+    )
+    r_starts = alignment.r_st + np.cumsum(lengths) - lengths
+
+    run = np.repeat(np.arange(len(ops)), lengths)
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = r_starts[run] + within
+
+    calls = np.full(len(positions), BASES.index("-"), dtype=np.int8)
+    matched = is_match[run]
+    calls[matched] = encode_bases(query)[(q_starts[run] + within)[matched]]
+    return positions, calls
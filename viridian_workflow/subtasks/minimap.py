@@ -2,12 +2,53 @@
 """
 from __future__ import annotations
 
+import hashlib
+import os
 import sys
 import subprocess
-from typing import Optional
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
 from pathlib import Path
+
+import mappy as mp  # type: ignore
+import pysam  # type: ignore
+
+from viridian_workflow.utils import resource_usage
 from .task import Task
 
+# what samtools uses when no compression level is given
+SAMTOOLS_COMPRESSION_LEVEL = 6
+
+
+def cached_index(ref_genome: Path, preset: str, cache_dir: Path) -> Path:
+    """Path to a minimap2 index (.mmi) of the reference for a preset,
+    building it in the cache directory if it is not there yet
+
+    Indexes are named by a hash of the reference's contents, so a changed
+    reference gets a new index. The .mmi file can be given to the minimap2
+    program or to mappy in place of the FASTA.
+    """
+    with open(ref_genome, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    index = Path(cache_dir) / f"{digest}.{preset}.mmi"
+    if index.exists():
+        return index
+
+    # build to a temporary file and rename it, so that concurrent runs never
+    # see a partly written index
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    fd, tmp_index = tempfile.mkstemp(dir=cache_dir, suffix=".mmi.tmp")
+    os.close(fd)
+    try:
+        if not mp.Aligner(str(ref_genome), preset=preset, fn_idx_out=tmp_index):
+            raise Exception(f"failed to build minimap2 index of {ref_genome}")
+        os.replace(tmp_index, index)
+    finally:
+        if os.path.exists(tmp_index):
+            os.unlink(tmp_index)
+    return index
+
 
 class Minimap(Task):
     def __init__(
@@ -20,10 +61,17 @@ class Minimap(Task):
         sample_name: str = "sample",
         minimap_x_opt: Optional[str] = None,
         sort: bool = True,
+        index_cache: Optional[Path] = None,
+        compression_level: Optional[int] = None,
     ):
+        """Unsorted output is SAM, unless a compression level is given, in
+        which case it is a bam. A low level (0 for uncompressed, or 1) is
+        quicker to write and read back when the bam is only an intermediate.
+        """
 
         self.output: Path = Path(bam)
         self.sort: bool = sort
+        self.compression_level: Optional[int] = compression_level
         self.cmd: list[str] = [
             "minimap2",
             "-R",
@@ -43,30 +91,80 @@ class Minimap(Task):
                 minimap_x_opt = "-x sr"
             self.cmd.extend(minimap_x_opt.split())
             reads_list = [str(fq1), str(fq2)]
+
+        # a cached index only matches the reference for a bare preset, as
+        # other options may change how the index is built
+        x_opts = minimap_x_opt.split()
+        if index_cache is not None and len(x_opts) == 2 and x_opts[0] == "-x":
+            ref_genome = cached_index(ref_genome, x_opts[1], index_cache)
         self.cmd.append(str(ref_genome))
         self.cmd.extend(reads_list)
         super(Minimap, self).__init__(name="minimap")
 
     def run(self):
-        if self.sort:
-            sort_cmd = ["samtools", "sort", "-o", self.output]
-            map_proc = subprocess.Popen(
-                " ".join(self.cmd), shell=True, stdout=subprocess.PIPE
-            )
-            sort_proc = subprocess.Popen(sort_cmd, stdin=map_proc.stdout)
-            sort_proc.wait()
-            if sort_proc.returncode:
-                raise Exception("minimap2 subprocess failed")
-            subprocess.Popen(["samtools", "index", self.output]).wait()
+        with resource_usage(self.log):
+            if self.sort:
+                sort_cmd = ["samtools", "sort", "-o", self.output]
+                if self.compression_level is not None:
+                    sort_cmd += ["-l", str(self.compression_level)]
+                map_proc = subprocess.Popen(
+                    " ".join(self.cmd), shell=True, stdout=subprocess.PIPE
+                )
+                sort_proc = subprocess.Popen(sort_cmd, stdin=map_proc.stdout)
+                # so that minimap2 gets SIGPIPE if samtools exits early
+                map_proc.stdout.close()
+                sort_proc.wait()
+                # reap minimap2 too, so its usage is counted
+                map_proc.wait()
+                if map_proc.returncode or sort_proc.returncode:
+                    raise Exception("minimap2 subprocess failed")
+                subprocess.Popen(["samtools", "index", self.output]).wait()
 
-        else:
-            with open(self.output, "w") as out_fd:
-                print(f"running: {' '.join([str(c) for c in self.cmd])}", sys.stderr)
-                map_proc = subprocess.Popen(self.cmd, stdout=out_fd)
+            elif self.compression_level is not None:
+                print(
+                    f"running: {' '.join([str(c) for c in self.cmd])}", file=sys.stderr
+                )
+                view_cmd = ["samtools", "view", "-b", "-l", str(self.compression_level)]
+                map_proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
+                view_proc = subprocess.Popen(
+                    [*view_cmd, "-o", self.output, "-"], stdin=map_proc.stdout
+                )
+                map_proc.stdout.close()
+                view_proc.wait()
                 map_proc.wait()
-                if map_proc.returncode:
+                if map_proc.returncode or view_proc.returncode:
                     raise Exception("minimap2 subprocess failed")
 
+            else:
+                with open(self.output, "w") as out_fd:
+                    print(
+                        f"running: {' '.join([str(c) for c in self.cmd])}",
+                        file=sys.stderr,
+                    )
+                    map_proc = subprocess.Popen(self.cmd, stdout=out_fd)
+                    map_proc.wait()
+                    if map_proc.returncode:
+                        raise Exception("minimap2 subprocess failed")
+
         self.check_output()
         self.log["Success"] = True
         return self.output
+
+    @contextmanager
+    def stream(self) -> Iterator[pysam.AlignmentFile]:
+        """Run minimap2, reading its alignments as they are produced instead
+        of writing them to a bam file first
+        """
+        print(f"running: {' '.join([str(c) for c in self.cmd])}", file=sys.stderr)
+        with resource_usage(self.log):
+            map_proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
+            try:
+                with pysam.AlignmentFile(map_proc.stdout, "r") as alignments:
+                    yield alignments
+            finally:
+                map_proc.stdout.close()
+                map_proc.wait()
+
+        if map_proc.returncode:
+            raise Exception("minimap2 subprocess failed")
+        self.log["Success"] = True
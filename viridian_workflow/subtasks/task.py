@@ -4,10 +4,11 @@ External pipeline process wrapper
 from __future__ import annotations
 
 import subprocess
-import time
-from typing import Union
+from typing import Any, Union
 from pathlib import Path
 
+from viridian_workflow.utils import resource_usage
+
 
 class Task:
     """A prototype Task
@@ -25,7 +26,7 @@ class Task:
         else:
             self.name = name
 
-        self.log: dict[str, str] = {
+        self.log: dict[str, Any] = {
             "Task": self.name,
             "Success": False,
             "error": None,
@@ -45,24 +46,20 @@ class Task:
         """Launch a pipeline task"""
         cmd = [str(c) for c in self.cmd]
 
-        self.start_time = time.time()
-        self.log["start"] = time.strftime("%H:%M:%S", time.gmtime(self.start_time))
-
-        stdout_fd = subprocess.PIPE
-        if stdout:
-            stdout_fd = open(stdout, "w", encoding="utf-8")
-        result = subprocess.run(
-            cmd,
-            shell=False,
-            stderr=subprocess.PIPE,
-            stdout=stdout_fd,
-            universal_newlines=True,
-            check=True,
-        )
-        if stdout:
-            stdout_fd.close()
-
-        self.log["end"] = time.strftime("%H:%M:%S", time.gmtime(time.time()))
+        with resource_usage(self.log):
+            stdout_fd = subprocess.PIPE
+            if stdout:
+                stdout_fd = open(stdout, "w", encoding="utf-8")
+            result = subprocess.run(
+                cmd,
+                shell=False,
+                stderr=subprocess.PIPE,
+                stdout=stdout_fd,
+                universal_newlines=True,
+                check=True,
+            )
+            if stdout:
+                stdout_fd.close()
 
         if not ignore_error and result.returncode != 0:
             self.log["error"] = result.stderr
@@ -21,6 +21,7 @@ class Varifier(Task):
         max_coord: Optional[Index0] = None,
         sanitise_gaps: bool = True,
         hp_min_fix_length: Optional[int] = 6,
+        threads: int = 1,
     ):
         """Initialise varifier task"""
         vcf = outdir / "04.truth.vcf"
@@ -38,6 +39,9 @@ class Varifier(Task):
         if hp_min_fix_length is not None:
             self.options += ["--hp_min_fix_length", str(hp_min_fix_length)]
 
+        if threads > 1:
+            self.options += ["--cpus", str(threads)]
+
         self.cmd = [
             "varifier",
             "make_truth_vcf",
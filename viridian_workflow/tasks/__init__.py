@@ -1,9 +1,16 @@
 """
 Workflow tasks that are invoked by the arg parser
 """
+from importlib import import_module
 
 __all__ = [
+    "run_batch",
     "run_one_sample",
+    "serve",
 ]
 
-from viridian_workflow.tasks import run_one_sample
+
+def __getattr__(name):
+    if name in __all__:
+        return import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
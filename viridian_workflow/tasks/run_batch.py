@@ -0,0 +1,160 @@
+"""Run the pipeline on a batch of samples with a process pool
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import logging
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+from viridian_workflow import utils
+from viridian_workflow.primers import AmpliconSet
+from viridian_workflow.tasks.run_one_sample import load_amplicon_sets, run_sample
+
+REQUIRED_COLUMNS = {"Name", "Tech", "Reads1"}
+
+# amplicon sets loaded once by the parent process and handed to each worker
+# when it starts, rather than with every sample
+_amplicon_sets: list[AmpliconSet] = []
+_chosen_amplicon_set: Optional[AmpliconSet] = None
+
+
+def load_sample_sheet(fn: Path) -> list[dict[str, Optional[str]]]:
+    """Load a tab-delimited sample sheet with columns Name, Tech and Reads1,
+    and optionally Reads2 (for illumina) and Consensus (for cuckoo mode)
+    """
+    samples = []
+    with open(fn, encoding="utf-8") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        assert reader.fieldnames is not None
+        missing_cols_set = REQUIRED_COLUMNS.difference(set(reader.fieldnames))
+        if len(missing_cols_set) > 0:
+            missing_cols: str = ",".join(sorted(list(missing_cols_set)))
+            raise Exception(
+                f"Sample sheet missing these columns: {missing_cols}. Got these columns: {reader.fieldnames}"
+            )
+        for row in reader:
+            samples.append({k: v if v else None for k, v in row.items()})
+
+    names = [sample["Name"] for sample in samples]
+    if None in names or len(set(names)) != len(names):
+        raise Exception("Sample names in the sample sheet must be present and unique")
+    # each sample's output directory is named after it
+    for name in names:
+        assert name is not None
+        if "/" in name or name in (".", ".."):
+            raise Exception(f"Sample name {name} cannot be a directory name")
+    return samples
+
+
+def sample_options(
+    options: argparse.Namespace, sample: dict[str, Optional[str]], threads: int
+) -> argparse.Namespace:
+    """Options for running one sample of the batch, in its own directory
+    inside the batch output directory
+    """
+    sample_opts = argparse.Namespace(**vars(options))
+    sample_opts.sample_name = sample["Name"]
+    sample_opts.outdir = str(Path(options.outdir) / str(sample["Name"]))
+    sample_opts.tech = sample["Tech"]
+    sample_opts.threads = threads
+    sample_opts.consensus = sample.get("Consensus")
+    if sample["Tech"] == "ont":
+        sample_opts.reads = sample["Reads1"]
+        sample_opts.reads1 = sample_opts.reads2 = None
+    else:
+        sample_opts.reads = None
+        sample_opts.reads1 = sample["Reads1"]
+        sample_opts.reads2 = sample.get("Reads2")
+    return sample_opts
+
+
+def init_worker(
+    amplicon_sets: list[AmpliconSet], chosen_amplicon_set: Optional[AmpliconSet]
+):
+    """Keep the batch's amplicon sets in a worker process"""
+    global _amplicon_sets, _chosen_amplicon_set
+    _amplicon_sets = amplicon_sets
+    _chosen_amplicon_set = chosen_amplicon_set
+
+
+def run_batch_sample(options: argparse.Namespace) -> dict[str, Any]:
+    """Run one sample in a worker process, returning its summary"""
+    work_dir = Path(options.outdir)
+    start_time = time.time()
+    summary: dict[str, Any] = {"Outdir": str(work_dir)}
+    try:
+        work_dir.mkdir()
+        fq1, fq2 = utils.check_tech_and_reads_opts_and_get_reads(options)
+        log = run_sample(
+            options,
+            work_dir,
+            fq1,
+            fq2,
+            _amplicon_sets,
+            _chosen_amplicon_set,
+            force_consensus=options.consensus,
+        )
+    except Exception as e:
+        summary["Success"] = False
+        summary["error"] = str(e)
+    else:
+        summary["Success"] = log["Summary"]["Success"]
+        if "Failure" in log["Summary"]:
+            summary["error"] = log["Summary"]["Failure"]
+        results = log.get("Results", {})
+        summary["Amplicon_scheme"] = results.get("Amplicons", {}).get("scheme")
+    summary["run_time"] = time.time() - start_time
+    return summary
+
+
+def run(options):
+    if options.force:
+        logging.info(f"--force option used, so deleting {options.outdir} if it exists")
+        subprocess.check_output(f"rm -rf {options.outdir}", shell=True)
+
+    outdir = Path(options.outdir)
+    if outdir.exists():
+        raise Exception(f"Output directory {outdir} already exists")
+
+    samples = load_sample_sheet(options.sample_sheet)
+    amplicon_sets, chosen_amplicon_set = load_amplicon_sets(options)
+    outdir.mkdir()
+
+    # each worker runs one sample at a time, with an equal share of threads
+    workers = max(1, min(options.workers, len(samples)))
+    threads = max(1, options.threads // workers)
+    start_time = time.time()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(amplicon_sets, chosen_amplicon_set),
+    ) as pool:
+        sample_summaries = list(
+            pool.map(
+                run_batch_sample,
+                [sample_options(options, sample, threads) for sample in samples],
+            )
+        )
+
+    summary: dict[str, Any] = {
+        "workers": workers,
+        "threads_per_sample": threads,
+        "run_time": time.time() - start_time,
+        "Succeeded": sum(s["Success"] for s in sample_summaries),
+        "Failed": sum(not s["Success"] for s in sample_summaries),
+        "Samples": {
+            sample["Name"]: sample_summary
+            for sample, sample_summary in zip(samples, sample_summaries)
+        },
+    }
+    with open(outdir / "summary.json", "w") as json_out:
+        json.dump(summary, json_out, indent=2)
+    logging.info(
+        f"Finished batch: {summary['Succeeded']} samples succeeded, {summary['Failed']} failed"
+    )
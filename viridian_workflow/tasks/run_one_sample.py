@@ -6,7 +6,7 @@ import socket
 import time
 import subprocess
 from pathlib import Path
-from viridian_workflow import utils, primers, amplicon_schemes
+from viridian_workflow import utils, amplicon_schemes
 from viridian_workflow.run import run_pipeline
 
 
@@ -17,26 +17,6 @@ def cuckoo(options):
 def run(options, force_consensus=None):
     fq1, fq2 = utils.check_tech_and_reads_opts_and_get_reads(options)
 
-    log: dict[str, Any] = {}
-    log["Summary"] = {}
-    log["Summary"]["command"] = " ".join(sys.argv)
-    log["Summary"]["Version"] = ""
-    log["Summary"]["Finished_running"] = False
-    log["Summary"]["Success"] = False
-    log["Summary"]["Progress"] = []
-    log["Summary"]["cwd"] = os.getcwd()
-    log["Summary"]["hostname"] = socket.gethostname()
-    start_time = time.time()
-    log["Summary"]["start_time"] = time.strftime(
-        "%Y-%m-%dT%H:%M:%S", time.gmtime(start_time)
-    )
-
-    log["Summary"]["options"] = {}
-    for option, setting in options.__dict__.items():
-        if option == "func":
-            continue
-        log["Summary"]["options"][str(option)] = setting
-
     if options.force:
         logging.info(f"--force option used, so deleting {options.outdir} if it exists")
         subprocess.check_output(f"rm -rf {options.outdir}", shell=True)
@@ -46,13 +26,22 @@ def run(options, force_consensus=None):
         raise Exception(f"Output directory {work_dir} already exists")
     work_dir.mkdir()
 
-    # New function run.run_pipeline wants a list of fastq files
-    fqs = [
+    amplicon_sets, chosen_amplicon_set = load_amplicon_sets(options)
+    run_sample(
+        options,
+        work_dir,
         fq1,
-    ]
-    if fq2 is not None:
-        fqs = [fq1, fq2]
+        fq2,
+        amplicon_sets,
+        chosen_amplicon_set,
+        force_consensus=force_consensus,
+    )
+
 
+def load_amplicon_sets(options):
+    """Load the amplicon schemes to choose from, and the forced scheme if
+    there is one
+    """
     # Build the index of built-in schemes, possibly subsetted
     data_dir = Path(amplicon_schemes.__file__).resolve().parent / "amplicon_scheme_data"
     amplicon_index = amplicon_schemes.load_amplicon_index(
@@ -69,8 +58,8 @@ def run(options, force_consensus=None):
             raise Exception("Can only force amplicon scheme from built-in options")
 
         if options.force_amp_scheme in amplicon_index:
-            chosen_amplicon_set = primers.AmpliconSet.from_tsv(
-                amplicon_index[options.force_amp_scheme], name=options.force_amp_scheme
+            chosen_amplicon_set = amplicon_schemes.load_amplicon_set(
+                amplicon_index[options.force_amp_scheme], options.force_amp_scheme
             )
         else:
             raise Exception(
@@ -87,9 +76,50 @@ def run(options, force_consensus=None):
             amplicon_index = load_amplicon_index(options.amp_schemes_tsv)
 
     amplicon_sets = [
-        primers.AmpliconSet.from_tsv(tsv, name=name)
+        amplicon_schemes.load_amplicon_set(tsv, name)
         for name, tsv in amplicon_index.items()
     ]
+    return amplicon_sets, chosen_amplicon_set
+
+
+def run_sample(
+    options,
+    work_dir,
+    fq1,
+    fq2,
+    amplicon_sets,
+    chosen_amplicon_set,
+    force_consensus=None,
+):
+    """Run the pipeline on one sample, in an existing output directory.
+    Writes log.json there and returns the log
+    """
+    log: dict[str, Any] = {}
+    log["Summary"] = {}
+    log["Summary"]["command"] = " ".join(sys.argv)
+    log["Summary"]["Version"] = ""
+    log["Summary"]["Finished_running"] = False
+    log["Summary"]["Success"] = False
+    log["Summary"]["Progress"] = []
+    log["Summary"]["cwd"] = os.getcwd()
+    log["Summary"]["hostname"] = socket.gethostname()
+    start_time = time.time()
+    log["Summary"]["start_time"] = time.strftime(
+        "%Y-%m-%dT%H:%M:%S", time.gmtime(start_time)
+    )
+
+    log["Summary"]["options"] = {}
+    for option, setting in options.__dict__.items():
+        if option == "func":
+            continue
+        log["Summary"]["options"][str(option)] = setting
+
+    # New function run.run_pipeline wants a list of fastq files
+    fqs = [
+        fq1,
+    ]
+    if fq2 is not None:
+        fqs = [fq1, fq2]
 
     try:
         pipeline_results = run_pipeline(
@@ -101,6 +131,7 @@ def run(options, force_consensus=None):
             force_amp_scheme=chosen_amplicon_set,
             keep_intermediate=options.debug,
             keep_bam=options.keep_bam,
+            bam_compression_level=options.bam_compression_level,
             dump_tsv=options.dump_tsv,
             sample_name=options.sample_name,
             frs_threshold=options.frs_threshold,
@@ -109,10 +140,23 @@ def run(options, force_consensus=None):
             max_percent_amps_fail=options.max_percent_amps_fail,
             command_line_args=options,
             force_consensus=force_consensus,
+            threads=options.threads,
+            liftover=options.liftover,
+            mapper=options.mapper,
+            index_cache=options.index_cache,
+            sequential_detection=options.sequential_detection,
+            primer_detection=options.primer_detection,
+            profile=options.profile,
             global_log=log,
         )
         log["Results"] = pipeline_results
         log["Summary"]["Success"] = True
+    except utils.PipelineAbort as e:
+        # the sample failed QC, so later stages were skipped
+        log["Results"] = e.results
+        log["Summary"]["Success"] = False
+        log["Summary"]["Failure"] = str(e)
+        print(f"Pipeline stopped early: {e}", file=sys.stderr)
     except Exception as e:
         log["Summary"]["Success"] = False
         # log["Summary"]["status"] = {"Failure": str(e)}
@@ -126,3 +170,4 @@ def run(options, force_consensus=None):
         )
         log["Summary"]["run_time"] = end_time - start_time
         json.dump(log, json_out, indent=2)
+    return log
@@ -0,0 +1,102 @@
+"""Long-running server that runs samples sent to it over a UNIX socket
+
+Amplicon schemes are loaded, modules imported and (with --mapper mappy)
+the reference indexed once when the server starts, instead of for every
+sample. Each connection sends one job as a line of JSON, with the same
+fields as a row of a run_batch sample sheet:
+
+    {"Name": "s1", "Tech": "illumina", "Reads1": "s1_1.fq", "Reads2": "s1_2.fq"}
+
+The sample is written to a directory named after it inside the server's
+output directory, like run_one_sample would, and the server replies with
+a line of JSON summarising the run. Samples are run one at a time.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+from pathlib import Path
+from typing import Any, Optional
+
+from viridian_workflow import readstore
+from viridian_workflow.subtasks.minimap import cached_index
+from viridian_workflow.tasks import run_batch
+from viridian_workflow.tasks.run_one_sample import load_amplicon_sets
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Run the job sent on a connection, and reply with its summary"""
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+            if not isinstance(job, dict):
+                raise Exception("Job must be a JSON object")
+            for column in run_batch.REQUIRED_COLUMNS:
+                if not job.get(column):
+                    raise Exception(f"Job is missing {column}")
+            if "/" in job["Name"] or job["Name"] in (".", ".."):
+                raise Exception(f"Job name {job['Name']} cannot be a directory name")
+            options = run_batch.sample_options(
+                self.server.options, job, self.server.options.threads
+            )
+            logging.info(f"Running sample {job['Name']} in {options.outdir}")
+            summary = run_batch.run_batch_sample(options)
+        except Exception as e:
+            summary = {"Success": False, "error": str(e)}
+        self.wfile.write((json.dumps(summary) + "\n").encode())
+
+
+def remove_socket(socket_path: Path):
+    """Remove a socket left by a previous server, raising if the path is
+    anything other than a socket so that a mistyped --socket cannot delete
+    a file
+    """
+    if not os.path.exists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        raise Exception(f"{socket_path} exists and is not a socket")
+    os.unlink(socket_path)
+
+
+class Server(socketserver.UnixStreamServer):
+    """UNIX socket server holding the options and warm state shared by jobs"""
+
+    def __init__(self, socket_path: Path, options: Any):
+        self.options = options
+        Path(options.outdir).mkdir(parents=True, exist_ok=True)
+
+        amplicon_sets, chosen_amplicon_set = load_amplicon_sets(options)
+        run_batch.init_worker(amplicon_sets, chosen_amplicon_set)
+        if options.mapper == "mappy":
+            for preset in ["sr", "map-ont"]:
+                ref = options.ref_fasta
+                if options.index_cache is not None:
+                    ref = cached_index(ref, preset, options.index_cache)
+                readstore.load_aligner(ref, preset)
+
+        remove_socket(socket_path)
+        super().__init__(str(socket_path), JobHandler)
+
+
+def submit(socket_path: Path, job: dict[str, Optional[str]]) -> dict[str, Any]:
+    """Send a job to a running server, waiting for its summary"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        with sock.makefile("rwb") as f:
+            f.write((json.dumps(job) + "\n").encode())
+            f.flush()
+            return json.loads(f.readline())
+
+
+def run(options):
+    with Server(Path(options.socket), options) as server:
+        logging.info(f"Listening for samples on {options.socket}")
+        try:
+            server.serve_forever()
+        finally:
+            remove_socket(Path(options.socket))
@@ -4,12 +4,18 @@ Helper functions shared across modules
 from __future__ import annotations
 
 import sys
-from typing import NewType, Any, Optional
-from collections import namedtuple
+from typing import Callable, Iterable, Iterator, NewType, Any, Optional, TypeVar
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 import json
 import logging
 from operator import itemgetter
 from pathlib import Path
+import resource
+import threading
+import time
 
 import pyfastaq  # type: ignore
 
@@ -26,9 +32,22 @@ class PipelineProcessError(Exception):
     """Pipeline subprocess error"""
 
 
+class PipelineAbort(Exception):
+    """Sample failed a QC gate, so the rest of the pipeline was skipped.
+    Carries the results gathered up to that point
+    """
+
+    def __init__(self, message: str, results: dict[str, Any]):
+        super().__init__(message)
+        self.results: dict[str, Any] = results
+
+
 Index0 = NewType("Index0", int)
 Index1 = NewType("Index1", int)
 
+T = TypeVar("T")
+U = TypeVar("U")
+
 TRANSLATE_TABLE = str.maketrans("ATCGatcg", "TAGCtagc")
 
 
@@ -50,6 +69,149 @@ def in_range(interval: tuple[Index0, Index0], position: Index0) -> bool:
     return start <= position < end
 
 
+def map_batches(
+    function: Callable[[list[T]], list[U]],
+    items: Iterable[T],
+    threads: int = 1,
+    batch_size: int = 256,
+) -> Iterator[U]:
+    """Apply a function to batches of items, yielding the results in the
+    same order as the input
+
+    With more than one thread the batches are processed by a thread pool.
+    Only a few batches are in flight at once, and results are consumed in
+    submission order, so the output is the same as a serial run.
+    """
+    items = iter(items)
+    if threads <= 1:
+        while batch := list(islice(items, batch_size)):
+            yield from function(batch)
+        return
+
+    pending: deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while batch := list(islice(items, batch_size)):
+            pending.append(pool.submit(function, batch))
+            if len(pending) >= 2 * threads:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# peak RSS of the stages being measured, innermost last, so that an inner
+# stage resetting the high water mark does not hide it from outer stages
+_open_stages: list[dict[str, Any]] = []
+
+# the RSS high water mark and CPU times are for the whole process, so stages
+# in different threads cannot be measured at the same time. Nested stages in
+# one thread can
+_stages_lock = threading.RLock()
+
+
+def _peak_rss_kb() -> int:
+    """High water mark of this process's RSS, since it was last reset"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB elsewhere
+    return maxrss // 1024 if sys.platform == "darwin" else maxrss
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the RSS high water mark, where the OS allows it (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def resource_usage(log: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    """Record the wall time, CPU time and peak RSS of the enclosed code in
+    log, even if it raises
+
+    CPU times are split into this process (including its threads) and its
+    child processes. A child's usage is only counted once it has been
+    waited for. peak_rss_mb is for this stage alone where the high water mark
+    can be reset, otherwise it is the peak since the process started.
+    children_peak_rss_mb is the largest child process so far.
+
+    The measurements are process-wide, so stages must not run concurrently
+    in one process. A stage started in another thread waits until the open
+    stages have finished.
+    """
+    with _stages_lock:
+        with _measure(log):
+            yield log
+
+
+@contextmanager
+def _measure(log: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    """Measure the enclosed code for resource_usage"""
+    start = time.time()
+    wall_start = time.perf_counter()
+    self_start = resource.getrusage(resource.RUSAGE_SELF)
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    for stage in _open_stages:
+        stage["peak_rss_kb"] = max(stage["peak_rss_kb"], _peak_rss_kb())
+    stage = {"peak_rss_kb": 0, "reset": _reset_peak_rss()}
+    _open_stages.append(stage)
+    log["start"] = time.strftime("%H:%M:%S", time.gmtime(start))
+    try:
+        yield log
+    finally:
+        _open_stages.remove(stage)
+        peak_rss_kb = max(stage["peak_rss_kb"], _peak_rss_kb())
+        for outer in _open_stages:
+            outer["peak_rss_kb"] = max(outer["peak_rss_kb"], peak_rss_kb)
+        self_end = resource.getrusage(resource.RUSAGE_SELF)
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        children_maxrss = children_end.ru_maxrss
+        if sys.platform == "darwin":
+            children_maxrss //= 1024
+        log["end"] = time.strftime("%H:%M:%S", time.gmtime(time.time()))
+        log["wall_time"] = time.perf_counter() - wall_start
+        log["user_cpu"] = self_end.ru_utime - self_start.ru_utime
+        log["sys_cpu"] = self_end.ru_stime - self_start.ru_stime
+        log["children_user_cpu"] = children_end.ru_utime - children_start.ru_utime
+        log["children_sys_cpu"] = children_end.ru_stime - children_start.ru_stime
+        log["peak_rss_mb"] = peak_rss_kb / 1024
+        log["peak_rss_is_per_stage"] = stage["reset"]
+        log["children_peak_rss_mb"] = children_maxrss / 1024
+
+
+@contextmanager
+def stage(
+    name: str,
+    progress: list[dict[str, Any]],
+    profile_dir: Optional[Path] = None,
+    trace_memory: bool = False,
+) -> Iterator[dict[str, Any]]:
+    """Log an in-process pipeline stage, in the same form as a Task's log,
+    with its resource usage. If profile_dir is given, the stage is also
+    profiled into it (see profiling.profile_stage)
+    """
+    log: dict[str, Any] = {"Task": name, "Success": False, "error": None}
+    progress.append(log)
+    with resource_usage(log):
+        if profile_dir is None:
+            yield log
+        else:
+            # imported here, as profiling is rarely used
+            from viridian_workflow.profiling import profile_stage
+
+            with profile_stage(name, profile_dir, trace_memory=trace_memory):
+                yield log
+    log["Success"] = True
+
+
 def rm(filename: Path):
     """File removal wrapper"""
     filename = filename.resolve()
@@ -97,6 +259,15 @@ def load_amplicons_bed_file(infile: Path) -> list[Amplicon]:
     return amplicons
 
 
+def read_seqs(filenames: list[Path], max_reads: int) -> Iterator[str]:
+    """Sequences of up to the first max_reads reads of each FASTA/Q file"""
+    for filename in filenames:
+        for i, read in enumerate(pyfastaq.sequences.file_reader(str(filename))):
+            if i >= max_reads:
+                break
+            yield read.seq
+
+
 def load_single_seq_fasta(infile: Path) -> Any:
     """Load single fastaq sequence from a fasta"""
     seq_dict: Any = {}